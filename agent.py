@@ -7,7 +7,7 @@ import os
 from typing import Dict, List, Optional, Tuple, Set
 from datetime import datetime, timedelta
 from collections import Counter, defaultdict
-from schemas import WhiteboxTrace
+from schemas import WhiteboxTrace, blacklist_sidecar_path, flatten_log_record
 
 
 class DiagnosticAgent:
@@ -15,6 +15,7 @@ class DiagnosticAgent:
     
     def __init__(self, log_file: str = "whitebox.log"):
         self.log_file = log_file
+        self._blacklist_cache: Dict[str, List[str]] = {}
     
     def read_logs(self, time_window_minutes: int = 5, max_logs: int = 1000) -> List[WhiteboxTrace]:
         """
@@ -34,53 +35,69 @@ class DiagnosticAgent:
         
         logs = []
         # 从后往前读取，直到达到时间窗口或数量限制
+        # 每行可能是单条追踪，也可能是单请求聚合记录（展开为多条追踪）
+        reached_window = False
         for line in reversed(lines):
-            if len(logs) >= max_logs:
+            if len(logs) >= max_logs or reached_window:
                 break
                 
             line = line.strip()
             if not line:
                 continue
             try:
-                data = json.loads(line)
-                timestamp_str = data.get('timestamp', '')
-                
-                # 解析时间戳
-                try:
-                    log_time = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    # 如果日志时间早于阈值，停止读取
-                    if log_time < time_threshold:
-                        break
-                except:
-                    # 如果时间解析失败，继续处理（可能是旧格式）
-                    pass
-                
-                trace = WhiteboxTrace(
-                    request_id=data.get('request_id', ''),
-                    timestamp=timestamp_str,
-                    node=data.get('node', ''),
-                    action=data.get('action', ''),
-                    decision=data.get('decision', ''),
-                    reason_code=data.get('reason_code', ''),
-                    internal_variables=data.get('internal_variables', {}),
-                    reasoning=data.get('reasoning', ''),
-                    pCTR=data.get('pCTR'),
-                    pCVR=data.get('pCVR'),
-                    eCPM=data.get('eCPM'),
-                    latency_ms=data.get('latency_ms'),
-                    second_best_bid=data.get('second_best_bid'),
-                    actual_paid_price=data.get('actual_paid_price'),
-                    saved_amount=data.get('saved_amount')
-                )
-                logs.append(trace)
+                records = flatten_log_record(json.loads(line))
             except Exception as e:
                 print(f"Error parsing log line: {e}")
                 continue
+            
+            for data in reversed(records):
+                if len(logs) >= max_logs:
+                    break
+                try:
+                    timestamp_str = data.get('timestamp', '')
+                    
+                    # 解析时间戳
+                    try:
+                        log_time = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+                        # 如果日志时间早于阈值，停止读取
+                        if log_time < time_threshold:
+                            reached_window = True
+                            break
+                    except:
+                        # 如果时间解析失败，继续处理（可能是旧格式）
+                        pass
+                    
+                    logs.append(WhiteboxTrace.from_dict(data))
+                except Exception as e:
+                    print(f"Error parsing log line: {e}")
+                    continue
         
         # 按时间正序排列（最早的在前）
         logs.reverse()
         return logs
     
+    def resolve_blacklist(self, version: str) -> Optional[List[str]]:
+        """
+        根据追踪中的 blacklist_version 从旁路文件还原完整黑名单
+        旁路文件不存在、没有该版本，或该版本为内存映射黑名单（只存哈希，旁路文件仅记录 source）时返回 None
+        """
+        if version in self._blacklist_cache:
+            return self._blacklist_cache[version]
+        sidecar = blacklist_sidecar_path(self.log_file)
+        if not os.path.exists(sidecar):
+            return None
+        with open(sidecar, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._blacklist_cache[data['blacklist_version']] = data.get('entries')
+        return self._blacklist_cache.get(version)
+    
     def extract_region_from_log(self, log: WhiteboxTrace) -> str:
         """
         从日志中提取区域信息
@@ -107,6 +124,75 @@ class DiagnosticAgent:
         
         return region
     
+    @staticmethod
+    def _is_win_trace(log: WhiteboxTrace) -> bool:
+        """是否为中标追踪：竞价结果、ADX 最终通过，或尾部采样摘要中的竞价成功"""
+        return log.action == 'AUCTION_RESULT' or \
+            (log.node == 'ADX' and log.action == 'FINAL_DECISION' and log.decision == 'PASS') or \
+            (log.action == 'REQUEST_SUMMARY' and log.reason_code == 'AUCTION_WON')
+    
+    @staticmethod
+    def _request_anchor(traces: List[WhiteboxTrace]) -> Optional[WhiteboxTrace]:
+        """请求锚点：SSP 请求追踪；被尾部采样折叠的请求使用摘要追踪（携带 app_id 等请求字段）"""
+        return next((t for t in traces if t.node == 'SSP' or t.action == 'REQUEST_SUMMARY'), None)
+    
+    @staticmethod
+    def _request_bid_summary(traces: List[WhiteboxTrace]) -> Optional[Dict]:
+        """
+        请求的出价摘要：bid_count / max_bid / max_bid_dsp / max_bid_pctr / mean_pctr / max_ecpm
+        优先读取 BID_SUMMARY 追踪或尾部采样摘要中的同名字段（两者内容相同，保证采样前后统计一致）；
+        旧日志没有摘要时依次从 AUCTION_RESULT 的 all_bids（只含 eCPM 前 N 名）、出价追踪还原（后者没有 pCTR）；
+        没有出价时返回 None
+        """
+        for trace in traces:
+            if trace.action == 'BID_SUMMARY' or \
+                    (trace.action == 'REQUEST_SUMMARY' and 'max_bid' in trace.internal_variables):
+                return trace.internal_variables
+        for trace in traces:
+            ranked = trace.internal_variables.get('all_bids') if trace.action == 'AUCTION_RESULT' else None
+            if ranked:
+                top = max(ranked, key=lambda bid: bid.get('bid_price', 0))
+                return {'bid_count': trace.internal_variables.get('total_bids', len(ranked)),
+                        'max_bid': top.get('bid_price', 0), 'max_bid_dsp': top.get('dsp_id'),
+                        'max_bid_pctr': top.get('pctr'),
+                        'mean_pctr': sum(bid.get('pctr', 0) for bid in ranked) / len(ranked),
+                        'max_ecpm': max(bid.get('ecpm', 0) for bid in ranked)}
+        bids = [t.internal_variables.get('final_bid') or t.internal_variables.get('bid_price') or 0
+                for t in traces if t.action in ('BID_CALCULATION', 'BID_SUBMITTED')]
+        bids = [bid for bid in bids if bid > 0]
+        if not bids:
+            return None
+        return {'bid_count': len(bids), 'max_bid': max(bids), 'max_bid_dsp': None,
+                'max_bid_pctr': None, 'mean_pctr': None, 'max_ecpm': None}
+    
+    @staticmethod
+    def _group_by_request(logs: List[WhiteboxTrace]) -> Dict[str, List[WhiteboxTrace]]:
+        """按 request_id 分组（保持请求首次出现的顺序）"""
+        request_map: Dict[str, List[WhiteboxTrace]] = defaultdict(list)
+        for log in logs:
+            request_map[log.request_id].append(log)
+        return request_map
+    
+    def _unavailable_detectors(self, logs: List[WhiteboxTrace]) -> List[Dict]:
+        """
+        依赖出价信息的检测器能否运行：有请求进入竞价（AUCTION_RESULT）但没有任何请求带出价信息时
+        （例如旧版本在 verbosity="rejects" 下写出的日志），这些检测器不会报告异常，需要在诊断结果中说明
+        """
+        request_map = self._group_by_request(logs)
+        auctioned = [traces for traces in request_map.values()
+                     if any(t.action in ('AUCTION_RESULT', 'REQUEST_SUMMARY') for t in traces)]
+        if not auctioned or any(self._request_bid_summary(traces) for traces in auctioned):
+            return []
+        reason = '日志中没有出价信息（BID_SUMMARY / 出价追踪 / AUCTION_RESULT.all_bids），可能由较低的日志详细程度写出'
+        return [
+            {'detector': name, 'title': title, 'reason': reason}
+            for name, title in (
+                ('P8_HIGH_BID_LOW_WIN_RATE', '高价低胜率诊断'),
+                ('COMPETITIVENESS_MISSING', '出价竞争力分析'),
+                ('P7_LOSS_VALUATION', '损耗折算（无超时 eCPM 时的出价回退）'),
+            )
+        ]
+
     def analyze_win_rate(self, logs: List[WhiteboxTrace]) -> Tuple[float, Dict]:
         """分析中标率"""
         request_ids = set()
@@ -115,8 +201,7 @@ class DiagnosticAgent:
         for log in logs:
             request_ids.add(log.request_id)
             # 优先检查竞价结果
-            if log.action == 'AUCTION_RESULT' or \
-               (log.node == 'ADX' and log.action == 'FINAL_DECISION' and log.decision == 'PASS'):
+            if self._is_win_trace(log):
                 win_ids.add(log.request_id)
         
         total_requests = len(request_ids)
@@ -152,7 +237,7 @@ class DiagnosticAgent:
         
         for request_id, traces in request_map.items():
             # 提取区域和应用ID
-            ssp_log = next((t for t in traces if t.node == 'SSP'), None)
+            ssp_log = self._request_anchor(traces)
             if not ssp_log:
                 continue
             
@@ -165,7 +250,8 @@ class DiagnosticAgent:
             stats['total_requests'] += 1
             
             # 检查是否中标
-            auction_result = next((t for t in traces if t.action == 'AUCTION_RESULT'), None)
+            auction_result = next((t for t in traces if t.action == 'AUCTION_RESULT' or
+                                   (t.action == 'REQUEST_SUMMARY' and t.reason_code == 'AUCTION_WON')), None)
             if auction_result:
                 stats['win_count'] += 1
                 if auction_result.eCPM:
@@ -228,9 +314,20 @@ class DiagnosticAgent:
                 'percentage': percentage
             }
         
+        # 过滤漏斗：请求在哪个阶段被拒绝（pre_bid 的请求没有向 DSP 扇出）
+        stage_counter: Dict[str, Counter] = defaultdict(Counter)
+        for log in reject_logs:
+            stage = log.internal_variables.get('filter_stage') if log.action == 'FINAL_DECISION' else None
+            if stage:
+                stage_counter[stage][log.reason_code] += 1
+        
         return {
             'total_rejects': total_rejects,
-            'distribution': reason_distribution
+            'distribution': reason_distribution,
+            'by_stage': {
+                stage: {'count': sum(reasons.values()), 'reasons': dict(reasons)}
+                for stage, reasons in stage_counter.items()
+            }
         }
     
     def detect_anomalies(self, logs: List[WhiteboxTrace], region_app_stats: Dict[str, Dict]) -> List[Dict]:
@@ -255,7 +352,7 @@ class DiagnosticAgent:
         anomalies.extend(self._detect_link_fluctuation(logs, region_app_stats))
         
         # 4. 出价竞争力分析
-        anomalies.extend(self._detect_competitiveness_issue(region_app_stats))
+        anomalies.extend(self._detect_competitiveness_issue(region_app_stats, logs))
         
         # 5. 传统异常检测（保留原有逻辑）
         win_rate, win_stats = self.analyze_win_rate(logs)
@@ -293,21 +390,28 @@ class DiagnosticAgent:
         if not logs:
             return anomalies
         
-        # 按区域统计超时率
+        # 按请求聚合后再按区域统计超时率（区域取自请求起点的 SSP 追踪，
+        # 只依赖任何日志详细程度下都会记录的 SSP 与超时追踪）
+        request_map: Dict[str, List[WhiteboxTrace]] = defaultdict(list)
+        for log in logs:
+            request_map[log.request_id].append(log)
+        
         region_timeout_stats = defaultdict(lambda: {'timeout': 0, 'total': 0, 'avg_latency': [], 'potential_loss': 0.0})
         
-        for log in logs:
-            region = self.extract_region_from_log(log)
+        for request_id, traces in request_map.items():
+            anchor = self._request_anchor(traces) or traces[0]
+            region = self.extract_region_from_log(anchor)
             region_timeout_stats[region]['total'] += 1
-            if log.reason_code == 'LATENCY_TIMEOUT':
+            timeout_log = next((t for t in traces if t.reason_code == 'LATENCY_TIMEOUT'), None)
+            if timeout_log:
                 region_timeout_stats[region]['timeout'] += 1
-                if log.latency_ms:
-                    region_timeout_stats[region]['avg_latency'].append(log.latency_ms)
+                if timeout_log.latency_ms:
+                    region_timeout_stats[region]['avg_latency'].append(timeout_log.latency_ms)
                 # 计算潜在损失
-                potential_ecpm = log.internal_variables.get('highest_potential_ecpm_loss', 0) or \
-                                log.internal_variables.get('max_potential_ecpm', 0) or 0
-                if potential_ecpm == 0 and log.eCPM:
-                    potential_ecpm = log.eCPM
+                potential_ecpm = timeout_log.internal_variables.get('highest_potential_ecpm_loss', 0) or \
+                                timeout_log.internal_variables.get('max_potential_ecpm', 0) or 0
+                if potential_ecpm == 0 and timeout_log.eCPM:
+                    potential_ecpm = timeout_log.eCPM
                 region_timeout_stats[region]['potential_loss'] += potential_ecpm
         
         # 计算各区域超时率和平均延迟
@@ -372,17 +476,19 @@ class DiagnosticAgent:
         
         return anomalies
     
-    def _detect_competitiveness_issue(self, region_app_stats: Dict[str, Dict]) -> List[Dict]:
+    def _detect_competitiveness_issue(self, region_app_stats: Dict[str, Dict],
+                                      logs: Optional[List[WhiteboxTrace]] = None) -> List[Dict]:
         """
         检测出价竞争力缺失：Win Rate < 5% 且平均 eCPM 远低于中标价
         增强版：P7 级别竞争力诊断，分析 pCTR 模型预估偏差
+        - logs: 与 region_app_stats 同一批日志（为空时重新读取最近 5 分钟）
         """
         anomalies = []
         
         # 计算行业平均 pCTR（从所有中标请求中）
-        all_logs = self.read_logs(time_window_minutes=5, max_logs=1000)
-        winning_logs = [log for log in all_logs if log.action == 'AUCTION_RESULT' or 
-                       (log.node == 'ADX' and log.action == 'FINAL_DECISION' and log.decision == 'PASS')]
+        all_logs = logs if logs is not None else self.read_logs(time_window_minutes=5, max_logs=1000)
+        winning_logs = [log for log in all_logs if self._is_win_trace(log)]
+        request_map = self._group_by_request(all_logs)
         
         industry_pctrs = [log.pCTR for log in winning_logs if log.pCTR and log.pCTR > 0]
         industry_avg_pctr = (sum(industry_pctrs) / len(industry_pctrs) * 100) if industry_pctrs else 1.2  # 默认1.2%
@@ -395,22 +501,19 @@ class DiagnosticAgent:
             avg_ecpm = stats['avg_ecpm']
             win_avg_ecpm = stats['win_avg_ecpm']
             
-            # 获取该区域/应用的出价日志，计算平均 pCTR
+            # 该区域/应用各请求的出价摘要，计算平均最高出价与其 pCTR
             region = stats['region']
             app_id = stats['app_id']
-            region_app_logs = [log for log in all_logs 
-                             if self.extract_region_from_log(log) == region and
-                             log.internal_variables.get('app_id') == app_id]
-            
-            bid_logs = [log for log in region_app_logs 
-                        if log.action in ['BID_CALCULATION', 'BID_SUBMITTED']]
+            bid_summaries = [summary for summary in
+                             (self._request_bid_summary(request_map.get(request_id, []))
+                              for request_id in stats['request_ids'])
+                             if summary is not None]
             
             avg_pctr = 0.0
             avg_bid = 0.0
-            if bid_logs:
-                pctrs = [log.pCTR for log in bid_logs if log.pCTR and log.pCTR > 0]
-                bids = [log.internal_variables.get('final_bid') or log.internal_variables.get('bid_price', 0) 
-                       for log in bid_logs]
+            if bid_summaries:
+                pctrs = [summary['max_bid_pctr'] for summary in bid_summaries if summary.get('max_bid_pctr')]
+                bids = [summary['max_bid'] for summary in bid_summaries]
                 avg_pctr = (sum(pctrs) / len(pctrs) * 100) if pctrs else 0
                 avg_bid = sum(bids) / len(bids) if bids else 0
             
@@ -468,16 +571,15 @@ class DiagnosticAgent:
     def _calculate_roi_loss(self, logs: List[WhiteboxTrace]) -> List[Dict]:
         """
         P7 视角：损耗折算 (Loss Valuation)
-        遍历最近 500 条日志，识别所有 decision="REJECTED" 且 reason_code="LATENCY_TIMEOUT" 的请求
+        遍历最近 500 个请求，识别所有 decision="REJECTED" 且 reason_code="LATENCY_TIMEOUT" 的请求
         应用公式：Potential_Loss = Sum(Rejected_eCPM × 1000 / Request_Count)
+        （按请求而不是日志行数取窗口，尾部采样折叠后的日志与完整日志覆盖相同的请求）
         """
-        # 限制为最近 500 条日志
-        recent_logs = logs[-500:] if len(logs) > 500 else logs
-        
-        # 按 request_id 分组
-        request_map: Dict[str, List[WhiteboxTrace]] = defaultdict(list)
-        for log in recent_logs:
-            request_map[log.request_id].append(log)
+        # 限制为最近 500 个请求
+        request_map = self._group_by_request(logs)
+        if len(request_map) > 500:
+            request_map = dict(list(request_map.items())[-500:])
+        recent_logs = [trace for traces in request_map.values() for trace in traces]
         
         # 按地区统计延迟超时损失
         region_loss_map: Dict[str, Dict] = defaultdict(lambda: {
@@ -499,7 +601,7 @@ class DiagnosticAgent:
                 continue
             
             # 提取地区
-            ssp_log = next((t for t in traces if t.node == 'SSP'), None)
+            ssp_log = self._request_anchor(traces)
             region = self.extract_region_from_log(ssp_log) if ssp_log else 'Unknown'
             
             # 计算潜在 eCPM 损失
@@ -514,17 +616,13 @@ class DiagnosticAgent:
                         trace.internal_variables.get('max_potential_ecpm', 0) or 0
                     )
             
-            # 2. 如果没有，从出价日志计算 eCPM
+            # 2. 如果没有，使用出价摘要中的最高 eCPM 或追踪上的 eCPM
             if potential_ecpm == 0:
+                bid_summary = self._request_bid_summary(traces)
+                if bid_summary and bid_summary.get('max_ecpm'):
+                    potential_ecpm = bid_summary['max_ecpm']
                 for trace in traces:
-                    if trace.action in ['BID_CALCULATION', 'BID_SUBMITTED']:
-                        bid_price = trace.internal_variables.get('final_bid') or trace.internal_variables.get('bid_price') or 0
-                        pctr = trace.pCTR or trace.internal_variables.get('pctr') or 0
-                        pcvr = trace.pCVR or trace.internal_variables.get('pcvr') or 0
-                        if bid_price and pctr and pcvr:
-                            calculated_ecpm = bid_price * pctr * pcvr * 1000
-                            potential_ecpm = max(potential_ecpm, calculated_ecpm)
-                    elif trace.eCPM:
+                    if trace.eCPM:
                         potential_ecpm = max(potential_ecpm, trace.eCPM)
             
             # 3. 如果还是没有，使用默认值（基于平均 eCPM）
@@ -579,8 +677,7 @@ class DiagnosticAgent:
         # 计算平均中标价
         winning_bids = []
         for log in logs:
-            if log.action == 'AUCTION_RESULT' or \
-               (log.node == 'ADX' and log.action == 'FINAL_DECISION' and log.decision == 'PASS'):
+            if self._is_win_trace(log):
                 # 获取中标价
                 winner_bid = log.internal_variables.get('winner_bid') or \
                            log.internal_variables.get('final_bid') or \
@@ -595,9 +692,9 @@ class DiagnosticAgent:
         threshold_bid = avg_winning_bid * 1.2
         
         # 按 request_id 分组，分析每个广告主的出价和胜率
-        request_map: Dict[str, List[WhiteboxTrace]] = defaultdict(list)
-        for log in logs:
-            request_map[log.request_id].append(log)
+        request_map = self._group_by_request(logs)
+        # 大盘平均 pCTR：全部有效出价的 pCTR 均值（由各请求出价摘要按出价数加权）
+        pctr_total, pctr_count = 0.0, 0
         
         # 按广告主（从 app_id 或 client_id 推断）聚合
         advertiser_stats: Dict[str, Dict] = defaultdict(lambda: {
@@ -611,7 +708,7 @@ class DiagnosticAgent:
         
         for request_id, traces in request_map.items():
             # 提取广告主标识（使用 app_id 作为代理）
-            ssp_log = next((t for t in traces if t.node == 'SSP'), None)
+            ssp_log = self._request_anchor(traces)
             if not ssp_log:
                 continue
             
@@ -619,16 +716,17 @@ class DiagnosticAgent:
                           ssp_log.internal_variables.get('client_id') or \
                           'Unknown'
             
-            # 查找出价日志
-            bid_log = next((t for t in traces 
-                          if t.action in ['BID_CALCULATION', 'BID_SUBMITTED']), None)
+            # 出价摘要（BID_SUMMARY 或尾部采样摘要），取该请求的最高出价及其 pCTR
+            bid_summary = self._request_bid_summary(traces)
             
-            if not bid_log:
+            if not bid_summary:
                 continue
             
-            bid_price = bid_log.internal_variables.get('final_bid') or \
-                       bid_log.internal_variables.get('bid_price') or 0
-            pctr = bid_log.pCTR or bid_log.internal_variables.get('pctr') or 0
+            bid_price = bid_summary.get('max_bid') or 0
+            pctr = bid_summary.get('max_bid_pctr') or 0
+            if bid_summary.get('mean_pctr'):
+                pctr_total += bid_summary['mean_pctr'] * bid_summary['bid_count']
+                pctr_count += bid_summary['bid_count']
             
             if bid_price > 0:
                 advertiser_stats[advertiser_id]['total_bids'] += 1
@@ -643,14 +741,11 @@ class DiagnosticAgent:
                     advertiser_stats[advertiser_id]['high_bids'].append(bid_price)
             
             # 检查是否中标
-            if any(t.action == 'AUCTION_RESULT' or 
-                  (t.node == 'ADX' and t.action == 'FINAL_DECISION' and t.decision == 'PASS')
-                  for t in traces):
+            if any(self._is_win_trace(t) for t in traces):
                 advertiser_stats[advertiser_id]['win_count'] += 1
         
         # 计算大盘平均 pCTR
-        all_pctrs = [log.pCTR for log in logs if log.pCTR and log.pCTR > 0]
-        market_avg_pctr = (sum(all_pctrs) / len(all_pctrs) * 100) if all_pctrs else 1.2  # 默认1.2%
+        market_avg_pctr = (pctr_total / pctr_count * 100) if pctr_count else 1.2  # 默认1.2%
         
         # 检测高价落榜案例
         for advertiser_id, stats in advertiser_stats.items():
@@ -691,6 +786,68 @@ class DiagnosticAgent:
         
         return anomalies
     
+    def _detect_quality_factor_penalty(self, logs: List[WhiteboxTrace]) -> List[Dict]:
+        """
+        流量质量风险：q_factor < 0.5 的请求（QUALITY_SCORE WARNING）占比超过 10% 时，
+        这些请求的出价 eCPM 被质量系数压低而容易落榜
+        """
+        anomalies = []
+        request_map = self._group_by_request(logs)
+        if len(request_map) < 10:
+            return anomalies
+        
+        penalized: Dict[str, List[float]] = defaultdict(list)
+        for request_id, traces in request_map.items():
+            warning = next((t for t in traces if t.action == 'QUALITY_SCORE' and t.decision == 'WARNING'), None)
+            if warning is not None:
+                penalized[request_id].append(warning.internal_variables.get('q_factor', 0))
+        
+        penalized_rate = len(penalized) / len(request_map) * 100
+        if penalized_rate > 10:
+            q_factors = [q for values in penalized.values() for q in values]
+            anomalies.append({
+                'type': 'QUALITY_FACTOR_PENALTY',
+                'severity': 'medium',
+                'title': '流量质量风险',
+                'description': f'{penalized_rate:.1f}% 的请求质量系数低于 0.5（平均 {sum(q_factors) / len(q_factors):.2f}），出价 eCPM 被大幅折减',
+                'details': {
+                    'penalized_requests': len(penalized),
+                    'total_requests': len(request_map),
+                    'penalized_rate': penalized_rate,
+                    'avg_q_factor': sum(q_factors) / len(q_factors),
+                    'request_ids': list(penalized)[:10]
+                },
+                'suggestion': '建议排查高风险流量来源（IP 集中、固定点击坐标等），必要时将其加入黑名单'
+            })
+        return anomalies
+    
+    def _detect_skan_environment(self, logs: List[WhiteboxTrace]) -> List[Dict]:
+        """
+        SKAN 隐私环境：iOS 请求占比超过 30% 时，转化数据只能通过延迟 24-48 小时的 SKAN postback 获取
+        （只读取请求锚点，任何日志详细程度与采样模式下结果相同）
+        """
+        anomalies = []
+        request_map = self._group_by_request(logs)
+        platforms = [anchor.internal_variables.get('platform') or ''
+                     for anchor in (self._request_anchor(traces) for traces in request_map.values())
+                     if anchor is not None]
+        if len(platforms) < 10:
+            return anomalies
+        ios_rate = sum(platform.upper() == 'IOS' for platform in platforms) / len(platforms) * 100
+        if ios_rate > 30:
+            anomalies.append({
+                'type': 'SKAN_PRIVACY_ENVIRONMENT',
+                'severity': 'low',
+                'title': 'SKAN 隐私受限环境',
+                'description': f'iOS 请求占比 {ios_rate:.1f}%，转化回传依赖 SKAN postback（延迟 24-48 小时）',
+                'details': {
+                    'ios_rate': ios_rate,
+                    'total_requests': len(platforms)
+                },
+                'suggestion': '隐私受限环境下建议启用 SKAN 概率优化，按转化值分布预估 pCVR，并避免依据短期转化数据调整出价'
+            })
+        return anomalies
+    
     def get_error_logs(self, logs: List[WhiteboxTrace], limit: int = 100) -> List[Dict]:
         """获取最近的错误日志"""
         error_logs = [
@@ -991,12 +1148,12 @@ class DiagnosticAgent:
             'priority': priority
         }
     
-    def diagnose(self, api_key: Optional[str] = None, time_window_minutes: int = 5) -> Dict:
+    def diagnose(self, api_key: Optional[str] = None, time_window_minutes: int = 5, max_logs: int = 1000) -> Dict:
         """
         执行完整诊断流程（增强版：时序聚合分析）
         """
-        # 读取最近5分钟或1000条日志
-        logs = self.read_logs(time_window_minutes=time_window_minutes, max_logs=1000)
+        # 读取最近5分钟或 max_logs 条日志
+        logs = self.read_logs(time_window_minutes=time_window_minutes, max_logs=max_logs)
         
         if not logs:
             return {
@@ -1011,6 +1168,9 @@ class DiagnosticAgent:
         # 检测异常（包含深度洞察）
         anomalies = self.detect_anomalies(logs, region_app_stats)
         
+        # 缺少输入而无法运行的检测器（不报告异常不代表没有异常）
+        unavailable_detectors = self._unavailable_detectors(logs)
+        
         # 获取错误日志
         error_logs = self.get_error_logs(logs, limit=100)
         
@@ -1070,6 +1230,7 @@ class DiagnosticAgent:
             },
             'region_app_aggregation': region_app_stats,
             'anomalies': sorted_anomalies,
+            'unavailable_detectors': unavailable_detectors,
             'ai_suggestions': llm_response,
             'structured_report': structured_report,  # 新增：结构化诊断报告
             'total_logs_analyzed': len(logs),
@@ -0,0 +1,251 @@
+"""
+内存映射黑名单存储
+离线把黑名单构建为排序后的定长哈希文件（每条 8 字节），运行时以只读 mmap 打开，
+多个 worker 进程共享同一份页缓存；文件头后附 Bloom 过滤器，绝大多数未命中的查询只需几次位探测
+
+文件布局（小端）：
+    header  : magic(8s) | count(Q) | bloom_bits(Q) | bloom_hashes(I) | reserved(I) | version(16s)
+    bloom   : bloom_bits / 8 字节（按 8 字节对齐）
+    keys    : count 个 uint64，升序、去重
+
+命令行：
+    python blacklist_store.py build <entries.txt> <blacklist.bin> [--fpr 0.01]
+    python blacklist_store.py info <blacklist.bin>
+"""
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+from typing import Iterable, List, Optional
+
+try:
+    import numpy as np  # 可选：向量化构建与查找
+except ImportError:
+    np = None
+
+
+MAGIC = b'WBBLST01'
+_HEADER = struct.Struct('<8sQQII16s')
+_KEY = struct.Struct('<Q')
+_MASK32 = 0xFFFFFFFF
+
+
+def hash_entry(entry: str) -> int:
+    """黑名单条目的 64 位哈希（blake2b，跨进程稳定）；碰撞概率约 n² / 2^65，可忽略"""
+    return int.from_bytes(hashlib.blake2b(entry.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _bloom_params(count: int, false_positive_rate: float):
+    """按条目数与目标误判率计算 Bloom 位数（8 字节对齐）与哈希个数"""
+    count = max(1, count)
+    bits = int(math.ceil(-count * math.log(false_positive_rate) / (math.log(2) ** 2)))
+    bits = max(64, (bits + 63) // 64 * 64)
+    hashes = max(1, int(round(bits / count * math.log(2))))
+    return bits, hashes
+
+
+def _bloom_positions(key: int, bits: int, hashes: int):
+    """双重哈希：由 64 位键的高低 32 位派生 k 个探测位置"""
+    h1 = key & _MASK32
+    h2 = (key >> 32) | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def _sorted_unique_keys(entries: Iterable[str]):
+    """条目 -> 升序去重的 64 位键（numpy 数组或列表）"""
+    if np is not None:
+        keys = np.fromiter((hash_entry(e) for e in entries), dtype=np.uint64)
+        return np.unique(keys)
+    return sorted({hash_entry(e) for e in entries})
+
+
+def _build_bloom(keys, bits: int, hashes: int) -> bytes:
+    """按键集合构建 Bloom 位数组"""
+    if np is not None:
+        array = np.zeros(bits // 8, dtype=np.uint8)
+        h1 = keys & np.uint64(_MASK32)
+        h2 = (keys >> np.uint64(32)) | np.uint64(1)
+        for i in range(hashes):
+            positions = (h1 + np.uint64(i) * h2) % np.uint64(bits)
+            np.bitwise_or.at(array, (positions >> np.uint64(3)).astype(np.intp),
+                             (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+        return array.tobytes()
+    array = bytearray(bits // 8)
+    for key in keys:
+        for pos in _bloom_positions(key, bits, hashes):
+            array[pos >> 3] |= 1 << (pos & 7)
+    return bytes(array)
+
+
+def _keys_version(key_bytes: bytes) -> str:
+    """存储文件版本号：排序后键数组的 SHA1 摘要（前 16 位），内容相同则版本相同"""
+    return hashlib.sha1(key_bytes).hexdigest()[:16]
+
+
+def build_blacklist_file(entries: Iterable[str], path: str, false_positive_rate: float = 0.01) -> str:
+    """
+    离线构建黑名单文件，返回版本号
+    先写临时文件再原子替换，已打开旧文件的进程不受影响，重新打开即可加载新版本
+    """
+    if not 0 < false_positive_rate < 1:
+        raise ValueError(f"Bloom 误判率必须在 (0, 1) 之间：{false_positive_rate}")
+    keys = _sorted_unique_keys(entries)
+    count = len(keys)
+    bits, hashes = _bloom_params(count, false_positive_rate)
+    bloom = _build_bloom(keys, bits, hashes)
+    if np is not None:
+        key_bytes = keys.astype('<u8').tobytes()
+    else:
+        key_bytes = b''.join(_KEY.pack(k) for k in keys)
+    version = _keys_version(key_bytes)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, count, bits, hashes, 0, version.encode('ascii')))
+        f.write(bloom)
+        f.write(key_bytes)
+    os.replace(tmp_path, path)
+    return version
+
+
+class MmapBlacklist:
+    """
+    只读内存映射黑名单
+    与 set 提供相同的查询接口（in / len），另有 version 供白盒追踪引用
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, bits, hashes, _, version = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"不是有效的黑名单文件：{path}")
+        self.count = count
+        self.bloom_bits = bits
+        self.bloom_hashes = hashes
+        self.version = version.decode('ascii')
+        self._bloom_offset = _HEADER.size
+        self._keys_offset = self._bloom_offset + bits // 8
+        if len(self._mmap) != self._keys_offset + count * _KEY.size:
+            self.close()
+            raise ValueError(f"黑名单文件长度与文件头不一致：{path}")
+        self._keys = None
+        if np is not None:
+            self._keys = np.frombuffer(self._mmap, dtype='<u8', count=count, offset=self._keys_offset)
+
+        # 监控计数：查询数、被 Bloom 直接排除数、Bloom 误判数
+        self.lookups = 0
+        self.bloom_rejects = 0
+        self.bloom_false_positives = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, entry) -> bool:
+        if not isinstance(entry, str) or not entry:
+            return False
+        self.lookups += 1
+        key = hash_entry(entry)
+        if not self._bloom_contains(key):
+            self.bloom_rejects += 1
+            return False
+        found = self._search(key)
+        if not found:
+            self.bloom_false_positives += 1
+        return found
+
+    def _bloom_contains(self, key: int) -> bool:
+        data = self._mmap
+        offset = self._bloom_offset
+        for pos in _bloom_positions(key, self.bloom_bits, self.bloom_hashes):
+            if not data[offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _search(self, key: int) -> bool:
+        """在排序键数组上二分查找"""
+        if self._keys is not None:
+            index = int(self._keys.searchsorted(np.uint64(key)))
+            return index < self.count and int(self._keys[index]) == key
+        lo, hi = 0, self.count
+        data, base = self._mmap, self._keys_offset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = _KEY.unpack_from(data, base + mid * _KEY.size)[0]
+            if value < key:
+                lo = mid + 1
+            elif value > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            'path': self.path,
+            'version': self.version,
+            'count': self.count,
+            'bloom_bits': self.bloom_bits,
+            'bloom_hashes': self.bloom_hashes,
+            'lookups': self.lookups,
+            'bloom_rejects': self.bloom_rejects,
+            'bloom_false_positives': self.bloom_false_positives,
+        }
+
+    def close(self):
+        """释放内存映射与文件句柄（可重复调用）"""
+        self._keys = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def _read_entries(path: str):
+    """读取文本黑名单：每行一个设备 ID 或应用 ID，忽略空行与 # 注释"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="构建 / 查看内存映射黑名单文件")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help="由文本黑名单重新生成黑名单文件")
+    build.add_argument('source', help="文本黑名单，每行一个条目")
+    build.add_argument('output', help="输出的黑名单文件")
+    build.add_argument('--fpr', type=float, default=0.01, help="Bloom 过滤器目标误判率")
+    info = subparsers.add_parser('info', help="查看黑名单文件信息")
+    info.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        version = build_blacklist_file(_read_entries(args.source), args.output, args.fpr)
+        with MmapBlacklist(args.output) as blacklist:
+            print(f"已生成 {args.output}：{len(blacklist)} 条，版本 {version}，"
+                  f"Bloom {blacklist.bloom_bits} 位 / {blacklist.bloom_hashes} 个哈希")
+    else:
+        with MmapBlacklist(args.path) as blacklist:
+            for key, value in blacklist.stats().items():
+                print(f"{key}: {value}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+时钟抽象
+引擎中需要"当前时间"的组件通过时钟对象取时，测试和仿真时注入模拟时钟即可把多日流程压缩到数秒内跑完
+- now(): 墙上时间（Unix 秒），用于时间戳与按时段的业务逻辑
+- monotonic(): 单调时间，用于计算耗时
+每个请求开始时在 request_scope 中取一次时间并缓存，请求内所有组件通过 request_time() 读取同一个时间戳，
+避免逐个决策点读系统时间，也避免请求中途跨过整点导致时段判断不一致
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Iterator, Optional
+
+
+class SystemClock:
+    """系统时钟：墙上时间（Unix 秒）"""
+
+    def now(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+
+class SimulatedClock:
+    """模拟时钟：时间只在显式推进时前进（墙上时间与单调时间相同）"""
+
+    def __init__(self, start: Optional[float] = None):
+        self._now = float(time.time() if start is None else start)
+
+    def now(self) -> float:
+        return self._now
+
+    def monotonic(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float) -> float:
+        """向前推进 seconds 秒，返回推进后的时间"""
+        if seconds < 0:
+            raise ValueError(f"模拟时钟不能倒退：{seconds}")
+        self._now += seconds
+        return self._now
+
+    def set(self, timestamp: float):
+        """跳到指定时间（不能早于当前时间）"""
+        if timestamp < self._now:
+            raise ValueError(f"模拟时钟不能倒退：{timestamp} < {self._now}")
+        self._now = float(timestamp)
+
+
+class RequestTime:
+    """单个请求的时间快照：Unix 秒、本地时间与缓存的 ISO 字符串"""
+    __slots__ = ('request_id', 'timestamp', 'datetime', '_iso')
+
+    def __init__(self, timestamp: float, request_id: Optional[str] = None):
+        self.request_id = request_id
+        self.timestamp = timestamp
+        self.datetime = datetime.fromtimestamp(timestamp)
+        self._iso: Optional[str] = None
+
+    @property
+    def iso(self) -> str:
+        if self._iso is None:
+            self._iso = self.datetime.isoformat()
+        return self._iso
+
+    @property
+    def hour(self) -> int:
+        return self.datetime.hour
+
+
+_SYSTEM_CLOCK = SystemClock()
+_current_request: ContextVar[Optional[RequestTime]] = ContextVar('whitebox_request_time', default=None)
+
+
+@contextmanager
+def request_scope(clock=None, request_id: Optional[str] = None) -> Iterator[RequestTime]:
+    """请求作用域：进入时取一次时间，作用域内 request_time() 都返回该快照（按 contextvars 隔离线程 / 协程）"""
+    snapshot = RequestTime((clock or _SYSTEM_CLOCK).now(), request_id)
+    token = _current_request.set(snapshot)
+    try:
+        yield snapshot
+    finally:
+        _current_request.reset(token)
+
+
+def request_time(clock=None) -> RequestTime:
+    """当前请求的时间快照；不在请求作用域内时按给定时钟（默认系统时钟）即时取时"""
+    snapshot = _current_request.get()
+    if snapshot is not None:
+        return snapshot
+    return RequestTime((clock or _SYSTEM_CLOCK).now())
@@ -0,0 +1,263 @@
+"""
+DSP 注册表：多个独立 DSP（各自的出价策略、预算与 QPS 上限）
+- 预算花费记在分片计数器上：每个线程只累加自己的分片，不加锁也不读全局状态；
+  分片按次数或按时间周期性对账汇总，预算耗尽的 DSP 在扇出前被跳过
+- QPS 上限按引擎时钟的整秒窗口计数，超限的 DSP 本秒内不再收到出价请求
+- 匀速投放（可选）：按引擎时钟把预算分摊到投放周期的各个时段，参与概率随实际花费与时段目标的比值调整，
+  被节流的请求不向该 DSP 扇出
+预算耗尽标记只在对账时更新，两次对账之间最多超支 reconcile_every 笔成交（软上限）
+"""
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from rng import GLOBAL_RANDOM
+
+
+# DSP 被跳过的原因代码
+SKIP_BUDGET_EXHAUSTED = "DSP_BUDGET_EXHAUSTED"
+SKIP_QPS_LIMITED = "DSP_QPS_LIMITED"
+SKIP_PACING_THROTTLED = "DSP_PACING_THROTTLED"
+
+
+class ShardedBudget:
+    """
+    分片预算计数器
+    - spend(): 累加到当前线程的分片（[已花费, 未对账笔数]），首次使用时注册分片
+    - reconcile(): 汇总所有分片得到 spent，更新 exhausted；某个分片未对账笔数达到 reconcile_every 时自动对账
+    """
+
+    def __init__(self, total: float, reconcile_every: int = 64):
+        self.total = total
+        self.reconcile_every = max(1, reconcile_every)
+        self._local = threading.local()
+        self._shards: List[List[float]] = []
+        self._lock = threading.Lock()
+        # 最近一次对账的结果
+        self.spent = 0.0
+        self.exhausted = total <= 0
+        self.reconciles = 0
+
+    def _shard(self) -> List[float]:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = [0.0, 0]
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def spend(self, amount: float):
+        shard = self._shard()
+        shard[0] += amount
+        shard[1] += 1
+        if shard[1] >= self.reconcile_every:
+            self.reconcile()
+
+    def reconcile(self) -> float:
+        """汇总各分片（只读分片的花费，不清零，避免与并发累加冲突），返回已花费总额"""
+        with self._lock:
+            spent = 0.0
+            for shard in self._shards:
+                spent += shard[0]
+                shard[1] = 0
+            self.spent = spent
+            self.exhausted = spent >= self.total
+            self.reconciles += 1
+        return spent
+
+    @property
+    def remaining(self) -> float:
+        """最近一次对账时的剩余预算"""
+        return max(0.0, self.total - self.spent)
+
+
+class BudgetPacer:
+    """
+    匀速投放：在 duration_seconds 内把预算均匀花完
+    - 每 interval_seconds 为一个时段；时段结束时对账预算，本时段的花费目标 = 剩余预算 × 时段长度 / 剩余投放时长
+      （提前花多了后续目标自动变小，花少了自动变大；投放周期结束后目标为全部剩余预算）
+    - 参与概率按 目标 / 实际花费 成比例调整：超出目标时按比例调低，不足时调高但单次最多乘以 1 + max_step，
+      并限制在 [min_rate, 1]
+    - 第一次 update 时的时间为投放开始时间
+    """
+
+    def __init__(self, budget: ShardedBudget, duration_seconds: float, interval_seconds: float = 1.0,
+                 max_step: float = 0.5, min_rate: float = 0.01, initial_rate: float = 1.0):
+        if duration_seconds <= 0:
+            raise ValueError(f"投放时长必须为正数：{duration_seconds}")
+        self.budget = budget
+        self.duration_seconds = duration_seconds
+        self.interval_seconds = interval_seconds
+        self.max_step = max_step
+        self.min_rate = min_rate
+        self.rate = min(1.0, max(min_rate, initial_rate))
+        self.start: Optional[float] = None
+        self._interval_start = 0.0
+        self._interval_spent = 0.0
+        self.intervals = 0
+
+    def update(self, now: float) -> float:
+        """按引擎时钟推进时段，返回当前参与概率"""
+        if self.start is None:
+            self.start = now
+            self._interval_start = now
+            self._interval_spent = self.budget.reconcile()
+            return self.rate
+        interval_length = now - self._interval_start
+        if interval_length < self.interval_seconds:
+            return self.rate
+        spent = self.budget.reconcile()
+        interval_spend = spent - self._interval_spent
+        remaining_seconds = self.duration_seconds - (self._interval_start - self.start)
+        remaining_budget = max(0.0, self.budget.total - self._interval_spent)
+        if remaining_seconds <= interval_length:
+            target = remaining_budget
+        else:
+            target = remaining_budget * interval_length / remaining_seconds
+        if interval_spend > 0:
+            factor = min(1.0 + self.max_step, target / interval_spend)
+        else:
+            factor = 1.0 + self.max_step
+        self.rate = min(1.0, max(self.min_rate, self.rate * factor))
+        self._interval_start = now
+        self._interval_spent = spent
+        self.intervals += 1
+        return self.rate
+
+    @property
+    def expected_spent(self) -> Optional[float]:
+        """按已用时长线性计算的应花费（尚未开始投放时为 None）"""
+        if self.start is None:
+            return None
+        return self.budget.total * min(1.0, (self._interval_start - self.start) / self.duration_seconds)
+
+
+class DSPEntry:
+    """注册表中的单个 DSP：出价方对象、预算、QPS 上限、匀速投放与监控计数"""
+    __slots__ = ('dsp_id', 'dsp', 'budget', 'qps_limit', 'pacer', '_pacing_rng', '_window', '_window_count',
+                 'requests', 'wins', 'budget_skips', 'qps_skips', 'pacing_skips')
+
+    def __init__(self, dsp_id: str, dsp, budget: Optional[ShardedBudget] = None,
+                 qps_limit: Optional[int] = None, pacer: Optional[BudgetPacer] = None,
+                 pacing_rng=None):
+        self.dsp_id = dsp_id
+        self.dsp = dsp
+        self.budget = budget
+        self.qps_limit = qps_limit
+        self.pacer = pacer
+        self._pacing_rng = pacing_rng if pacing_rng is not None else GLOBAL_RANDOM.stream('dsp_registry.pacing')
+        self._window = None
+        self._window_count = 0
+        self.requests = 0
+        self.wins = 0
+        self.budget_skips = 0
+        self.qps_skips = 0
+        self.pacing_skips = 0
+
+    def admit(self, now: float) -> Optional[str]:
+        """本次请求能否向该 DSP 扇出：可以时计入 QPS 并返回 None，否则返回跳过原因代码"""
+        if self.budget is not None and self.budget.exhausted:
+            self.budget_skips += 1
+            return SKIP_BUDGET_EXHAUSTED
+        if self.pacer is not None and self._pacing_rng.random() >= self.pacer.update(now):
+            self.pacing_skips += 1
+            return SKIP_PACING_THROTTLED
+        if self.qps_limit is not None:
+            window = int(now)
+            if window != self._window:
+                self._window = window
+                self._window_count = 0
+            if self._window_count >= self.qps_limit:
+                self.qps_skips += 1
+                return SKIP_QPS_LIMITED
+            self._window_count += 1
+        self.requests += 1
+        return None
+
+
+class DSPRegistry:
+    """
+    DSP 注册表（AdExchangeEngine.register_dsp 写入）
+    select() 按注册顺序返回本次请求可扇出的 DSP 与被跳过的 DSP；
+    距上次对账超过 reconcile_interval_seconds 时先对账全部预算
+    """
+
+    def __init__(self, reconcile_every: int = 64, reconcile_interval_seconds: float = 1.0):
+        self.reconcile_every = reconcile_every
+        self.reconcile_interval_seconds = reconcile_interval_seconds
+        self._entries: Dict[str, DSPEntry] = {}
+        self._last_reconcile: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, dsp_id: str) -> bool:
+        return dsp_id in self._entries
+
+    def register(self, dsp_id: str, dsp, budget: Optional[float] = None,
+                 qps_limit: Optional[int] = None, pacing_seconds: Optional[float] = None,
+                 pacing_interval_seconds: float = 1.0, rng=None) -> DSPEntry:
+        """
+        注册 DSP；budget / qps_limit 为空表示不限
+        - pacing_seconds: 投放时长，设置后预算在该时长内匀速花完（需要同时设置 budget）
+        - rng: 引擎随机数源，节流抽样使用其中的 dsp_registry.pacing.<dsp_id> 随机流
+        """
+        if dsp_id in self._entries:
+            raise ValueError(f"DSP 已注册：{dsp_id}")
+        if pacing_seconds is not None and budget is None:
+            raise ValueError(f"匀速投放需要设置预算：{dsp_id}")
+        sharded = ShardedBudget(budget, self.reconcile_every) if budget is not None else None
+        pacer = BudgetPacer(sharded, pacing_seconds, pacing_interval_seconds) if pacing_seconds is not None else None
+        pacing_rng = (rng if rng is not None else GLOBAL_RANDOM).stream(f'dsp_registry.pacing.{dsp_id}')
+        entry = DSPEntry(dsp_id, dsp, sharded, qps_limit, pacer, pacing_rng)
+        self._entries[dsp_id] = entry
+        return entry
+
+    def get(self, dsp_id: str) -> Optional[DSPEntry]:
+        return self._entries.get(dsp_id)
+
+    def select(self, now: float) -> Tuple[List[DSPEntry], List[Tuple[DSPEntry, str]]]:
+        """返回: (可扇出的 DSP 列表, [(被跳过的 DSP, 原因代码)])"""
+        if self._last_reconcile is None:
+            self._last_reconcile = now
+        elif now - self._last_reconcile >= self.reconcile_interval_seconds:
+            self.reconcile()
+            self._last_reconcile = now
+        selected, skipped = [], []
+        for entry in self._entries.values():
+            reason = entry.admit(now)
+            if reason is None:
+                selected.append(entry)
+            else:
+                skipped.append((entry, reason))
+        return selected, skipped
+
+    def record_win(self, dsp_id: str, price: float):
+        """记录成交花费"""
+        entry = self._entries.get(dsp_id)
+        if entry is None:
+            return
+        entry.wins += 1
+        if entry.budget is not None:
+            entry.budget.spend(price)
+
+    def reconcile(self):
+        for entry in self._entries.values():
+            if entry.budget is not None:
+                entry.budget.reconcile()
+
+    def stats(self) -> Dict:
+        return {
+            dsp_id: {
+                'requests': entry.requests,
+                'wins': entry.wins,
+                'budget_skips': entry.budget_skips,
+                'qps_skips': entry.qps_skips,
+                'pacing_skips': entry.pacing_skips,
+                'pacing_rate': entry.pacer.rate if entry.pacer is not None else None,
+                'budget': entry.budget.total if entry.budget is not None else None,
+                'spent': entry.budget.spent if entry.budget is not None else None,
+                'qps_limit': entry.qps_limit,
+            }
+            for dsp_id, entry in self._entries.items()
+        }
@@ -2,44 +2,546 @@
 白盒化广告交易引擎
 实现 SSP/ADX/DSP 的核心逻辑，并在每个决策点注入白盒日志
 """
+import asyncio
+import atexit
+import bisect
+import heapq
+import itertools
 import json
 import logging
-import random
+import queue
+import threading
 import time
-from datetime import datetime
-from typing import Dict, Optional, List, Tuple
-from dataclasses import asdict
-from schemas import WhiteboxTrace
+from typing import Callable, Dict, Iterable, Optional, List, Tuple, Union
 
+try:
+    import numpy as np  # 可选：批量采样返回 NumPy 数组
+except ImportError:
+    np = None
 
-class WhiteboxLogger:
-    """白盒日志记录器"""
+from blacklist_store import MmapBlacklist
+from clock import RequestTime, SystemClock, request_scope, request_time
+from dsp_registry import SKIP_BUDGET_EXHAUSTED, SKIP_PACING_THROTTLED, DSPEntry, DSPRegistry
+from filter_order import AdaptiveFilterOrder
+from rng import GLOBAL_RANDOM, EngineRandom
+from quality_counters import ClickDispersionTracker, ExactFeatureProvider
+from timing_wheel import HierarchicalTimingWheel
+from schemas import (AdRequest, BidRequest, LazyReasoning, WhiteboxRequestRecord, WhiteboxTrace,
+                     blacklist_sidecar_path, blacklist_version)
+
+
+_log = logging.getLogger(__name__)
+
+
+class FileSink:
+    """文件输出端 - 常驻文件句柄 + 缓冲写入"""
     
-    def __init__(self, log_file: str = "whitebox.log"):
+    def __init__(self, log_file: str = "whitebox.log",
+                 flush_every_records: int = 64,
+                 flush_every_bytes: int = 64 * 1024,
+                 flush_interval_seconds: float = 1.0,
+                 clock=None):
+        """
+        初始化文件输出端
+        - flush_every_records: 缓冲记录数达到该值时落盘（1 表示每条立即落盘）
+        - flush_every_bytes: 缓冲字符数达到该值时落盘（按字符数近似字节数）
+        - flush_interval_seconds: 距上次落盘超过该时间后，下一次写入触发落盘（0 表示不按时间落盘）
+        - clock: 时钟，按其 monotonic() 计算距上次落盘的时长，默认系统时钟
+        """
+        self.clock = clock if clock is not None else SystemClock()
         self.log_file = log_file
-        # 确保日志文件存在并清空（或追加模式）
-        with open(self.log_file, 'w', encoding='utf-8') as f:
-            f.write("")  # 清空文件
+        self.flush_every_records = max(1, flush_every_records)
+        self.flush_every_bytes = flush_every_bytes
+        self.flush_interval_seconds = flush_interval_seconds
+        # 以 'w' 模式打开即清空旧日志，之后所有写入复用同一个文件句柄
+        self._file = open(self.log_file, 'w', encoding='utf-8')
+        self._buffer: List[str] = []
+        self._buffered_bytes = 0
+        self._last_flush = self.clock.monotonic()
+        self._closed = False
+    
+    def write(self, line: str):
+        """写入一行日志（先进入缓冲区，按落盘策略批量写入）"""
+        if self._closed:
+            raise ValueError(f"FileSink 已关闭：{self.log_file}")
+        line += '\n'
+        self._buffer.append(line)
+        self._buffered_bytes += len(line)
+        
+        if len(self._buffer) >= self.flush_every_records or \
+           self._buffered_bytes >= self.flush_every_bytes or \
+           (self.flush_interval_seconds and
+                self.clock.monotonic() - self._last_flush >= self.flush_interval_seconds):
+            self.flush()
+    
+    def flush(self):
+        """将缓冲区中的日志写入磁盘"""
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer.clear()
+            self._buffered_bytes = 0
+        if not self._closed:
+            self._file.flush()
+        self._last_flush = self.clock.monotonic()
+    
+    def close(self):
+        """落盘并关闭文件句柄（可重复调用）"""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._file.close()
+
+
+class NullSink:
+    """空输出端 - 丢弃所有日志，仅计数（用于压测序列化开销）"""
+    
+    def __init__(self):
+        self.log_file = None
+        self.lines_written = 0
+    
+    def write(self, line: str):
+        self.lines_written += 1
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
+
+
+class MemorySink:
+    """内存输出端 - 日志行保存在列表中（用于压测和调试）"""
+    
+    def __init__(self):
+        self.log_file = None
+        self.lines: List[str] = []
+    
+    def write(self, line: str):
+        self.lines.append(line)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
+
+
+# 后台写线程队列满时的处理策略
+OVERFLOW_BLOCK = "block"              # 阻塞竞价线程，直到队列有空位
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # 丢弃队列中最旧的一条，写入新记录
+OVERFLOW_DROP = "drop"                # 丢弃新记录并计数
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP)
+
+# 日志记录模式
+RECORD_MODE_LINE = "line"        # 每个决策点一行
+RECORD_MODE_REQUEST = "request"  # 每个请求一行聚合记录
+RECORD_MODES = (RECORD_MODE_LINE, RECORD_MODE_REQUEST)
+
+# 日志详细程度（数值越大记录越多）
+VERBOSITY_FULL = "full"            # 全部决策点，包括每个过滤规则的 PASS
+VERBOSITY_DECISIONS = "decisions"  # 决策点（出价提交、最终决策）+ 拒绝
+VERBOSITY_REJECTS = "rejects"      # 仅拒绝/告警 + 出价摘要 + 竞价结果
+VERBOSITY_LEVELS = {VERBOSITY_REJECTS: 0, VERBOSITY_DECISIONS: 1, VERBOSITY_FULL: 2}
+
+# 任何级别都记录的决策点：请求起点（诊断 Agent 按请求聚合的锚点）、出价摘要（出价类检测器的输入）与竞价结果
+_ALWAYS_LOGGED_ACTIONS = frozenset({"REQUEST_GENERATED", "BID_SUMMARY", "AUCTION_RESULT"})
+# 任何级别都记录的决策结果
+_ALWAYS_LOGGED_DECISIONS = frozenset({"REJECT", "WARNING"})
+# decisions 及以上级别记录的决策点
+_DECISION_ACTIONS = frozenset({"BID_SUBMITTED", "FINAL_DECISION"})
+
+# 过滤规则阶段：竞价前规则只读取请求本身，在向 DSP 扇出前执行；竞价后规则需要出价（bid_price 等）
+FILTER_STAGE_PRE_BID = "pre_bid"
+FILTER_STAGE_POST_BID = "post_bid"
+
+# 请求超时阈值（毫秒）：SSP 处理延迟超过该值时请求超时；异步扇出时也是等待 DSP 出价的截止时间（tmax）
+TIMEOUT_THRESHOLD_MS = 100
+
+# 后台写线程控制信号
+_WRITER_STOP = object()
+
+
+_SNAPSHOT_CONTAINERS = (dict, list)
+
+
+def _snapshot(variables):
+    """
+    复制日志变量：只复制 dict / list（逐层），标量、元组与其他对象按引用保留
+    AdRequest 等生成后不再修改的记录对象直接返回
+    """
+    if variables.__class__ is not dict:
+        return variables
+    copied = dict(variables)
+    for key, value in copied.items():
+        if value.__class__ in _SNAPSHOT_CONTAINERS:
+            copied[key] = _copy_container(value)
+    return copied
+
+
+def _copy_container(value):
+    if value.__class__ is dict:
+        return _snapshot(value)
+    return [_copy_container(item) if item.__class__ in _SNAPSHOT_CONTAINERS else item for item in value]
+
+
+class WhiteboxLogger:
+    """白盒日志记录器 - 支持同步写入与后台写线程两种模式"""
+    
+    def __init__(self, log_file: str = "whitebox.log",
+                 flush_every_records: int = 64,
+                 flush_every_bytes: int = 64 * 1024,
+                 flush_interval_seconds: float = 1.0,
+                 sink=None,
+                 async_mode: bool = False,
+                 queue_size: int = 10000,
+                 overflow_policy: str = OVERFLOW_BLOCK,
+                 eager_reasoning: bool = False,
+                 record_mode: str = "line",
+                 verbosity: str = "full",
+                 tail_sampling: bool = False,
+                 tail_sample_rate: float = 0.01,
+                 clock=None,
+                 rng=None,
+                 snapshot_variables: bool = True):
+        """
+        初始化日志记录器
+        - flush_*: 默认文件输出端的落盘策略，见 FileSink
+        - sink: 自定义输出端（FileSink/NullSink/MemorySink），为空时写入 log_file
+        - async_mode: 为 True 时追踪对象进入有界队列，由后台写线程序列化并写入
+        - queue_size: 后台队列容量
+        - overflow_policy: 队列满时的策略：block / drop_oldest / drop
+        - eager_reasoning: 为 True 时记录即渲染推理说明（进程内直接读取追踪对象时使用），
+          默认延迟到序列化时渲染
+        - record_mode: line 为每个决策点一行；request 为每个请求一行聚合记录（steps 数组）
+        - verbosity: 日志详细程度：full（全部）/ decisions（决策点 + 拒绝）/ rejects（拒绝 + 出价摘要 + 竞价结果）
+        - tail_sampling: 尾部采样：请求结束后才决定是否写出完整决策链，
+          仅被拒绝、超时、质量告警或命中随机采样的请求保留完整链路，其余折叠为一行摘要
+        - tail_sample_rate: 普通请求保留完整链路的随机采样比例
+        - clock: 时钟（SystemClock / SimulatedClock）；请求作用域外记录追踪时按该时钟取时
+        - rng: 随机数源（EngineRandom），用于尾部采样；默认使用 random 模块
+        - snapshot_variables: 延迟序列化时（后台写线程、聚合记录、尾部采样）在 log_decision 时复制内部变量中的
+          dict / list，之后调用方修改原对象不会影响日志（元组与其他对象按引用保留，不应在记录后修改）；
+          调用方保证记录后不再修改时可关闭以省去复制。
+          同步逐行写入时记录当场序列化，不需要复制
+        """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"未知的队列溢出策略：{overflow_policy}")
+        if record_mode not in RECORD_MODES:
+            raise ValueError(f"未知的日志记录模式：{record_mode}")
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError(f"未知的日志详细程度：{verbosity}")
+        
+        self.clock = clock if clock is not None else SystemClock()
+        self._sampling_rng = (rng if rng is not None else GLOBAL_RANDOM).stream('logger.sampling')
+        self.sink = sink if sink is not None else FileSink(
+            log_file, flush_every_records, flush_every_bytes, flush_interval_seconds, self.clock
+        )
+        self.log_file = self.sink.log_file
+        self.async_mode = async_mode
+        self.overflow_policy = overflow_policy
+        self.eager_reasoning = eager_reasoning
+        self.record_mode = record_mode
+        self.verbosity = verbosity
+        self._verbosity_level = VERBOSITY_LEVELS[verbosity]
+        self.tail_sampling = tail_sampling
+        self.tail_sample_rate = tail_sample_rate
+        self.snapshot_variables = snapshot_variables
+        self.summarized_count = 0  # 尾部采样折叠为摘要的请求数
+        # 聚合模式下进行中请求的追踪缓存：request_id -> [WhiteboxTrace]
+        self._open_requests: Dict[str, List[WhiteboxTrace]] = {}
+        self._closed = False
+        
+        # 已登记的黑名单版本：version -> 排序后的条目；有日志文件时同时写入旁路文件（每个版本一行）
+        self.blacklist_versions: Dict[str, List[str]] = {}
+        self.blacklist_sidecar = blacklist_sidecar_path(self.log_file) if self.log_file else None
+        self._sidecar_started = False
+        
+        # 监控计数：入队数、丢弃数、生产者被阻塞次数、已写出行数、后台写出失败次数
+        self.enqueued_count = 0
+        self.dropped_count = 0
+        self.blocked_count = 0
+        self.written_count = 0
+        self.write_error_count = 0
+        
+        self._queue: Optional[queue.Queue] = None
+        self._writer: Optional[threading.Thread] = None
+        if async_mode:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._writer_idle_seconds = flush_interval_seconds or 1.0
+            self._writer = threading.Thread(target=self._writer_loop, name="whitebox-writer", daemon=True)
+            self._writer.start()
+        
+        # 进程退出时兜底落盘，避免缓冲区中的追踪记录丢失
+        atexit.register(self.close)
+    
+    def request_time(self) -> RequestTime:
+        """当前请求的时间快照（引擎在每个请求开始时取一次），组件应通过它读取时间而不是 datetime.now()"""
+        return request_time(self.clock)
+    
+    def is_enabled(self, action: str, decision: str) -> bool:
+        """
+        当前详细程度下该决策点是否需要记录
+        调用方应在构建内部变量快照之前调用，被抑制的追踪不产生任何开销
+        """
+        level = self._verbosity_level
+        if level >= VERBOSITY_LEVELS[VERBOSITY_FULL]:
+            return True
+        if decision in _ALWAYS_LOGGED_DECISIONS or action in _ALWAYS_LOGGED_ACTIONS:
+            return True
+        return level >= VERBOSITY_LEVELS[VERBOSITY_DECISIONS] and action in _DECISION_ACTIONS
+    
+    def register_blacklist(self, version: str, entries=None, size: int = None, source: str = None) -> bool:
+        """
+        登记黑名单快照：同一版本只记录一次，追踪中只写版本号与条目数
+        - entries: 完整条目（内存黑名单）
+        - source: 黑名单文件路径（内存映射黑名单只存哈希，无法还原条目，仅记录来源）
+        返回是否为新版本
+        """
+        if version in self.blacklist_versions:
+            return False
+        snapshot = sorted(entries) if entries is not None else None
+        self.blacklist_versions[version] = snapshot
+        if self.blacklist_sidecar:
+            record = {
+                'blacklist_version': version,
+                'blacklist_size': len(snapshot) if snapshot is not None else size,
+                'timestamp': self.request_time().iso,
+            }
+            if snapshot is not None:
+                record['entries'] = snapshot
+            if source is not None:
+                record['source'] = source
+            # 首次写入时清空旧旁路文件，与 FileSink 清空旧日志保持一致
+            mode = 'a' if self._sidecar_started else 'w'
+            with open(self.blacklist_sidecar, mode, encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._sidecar_started = True
+        return True
+    
+    def begin_request(self, request_id: str):
+        """标记请求开始：聚合模式或尾部采样下此后该请求的追踪先缓存在内存中"""
+        if self.record_mode == RECORD_MODE_REQUEST or self.tail_sampling:
+            self._open_requests[request_id] = []
+    
+    def end_request(self, request_id: str):
+        """
+        标记请求结束：
+        - 尾部采样未命中时写出一行摘要
+        - 聚合模式下把该请求的全部追踪合并为一条记录写出，否则逐条写出
+        """
+        traces = self._open_requests.pop(request_id, None)
+        if not traces:
+            return
+        if self.tail_sampling and not self._is_interesting(traces) and \
+                self._sampling_rng.random() >= self.tail_sample_rate:
+            self.summarized_count += 1
+            self._emit(self._summarize(request_id, traces))
+        elif self.record_mode == RECORD_MODE_REQUEST:
+            self._emit(WhiteboxRequestRecord(request_id, traces))
+        else:
+            for trace in traces:
+                self._emit(trace)
+    
+    @staticmethod
+    def _is_interesting(traces: List[WhiteboxTrace]) -> bool:
+        """尾部采样判定：被拒绝、延迟超时或质量告警的请求必须保留完整决策链"""
+        for trace in traces:
+            if trace.decision in _ALWAYS_LOGGED_DECISIONS or trace.reason_code == "LATENCY_TIMEOUT":
+                return True
+        return False
+    
+    @staticmethod
+    def _summarize(request_id: str, traces: List[WhiteboxTrace]) -> WhiteboxTrace:
+        """把一个请求的决策链折叠为一行摘要（保留诊断 Agent 聚合所需的请求与竞价结果字段）"""
+        outcome = next((t for t in traces if t.action == "AUCTION_RESULT"), traces[-1])
+        anchor = next((t for t in traces if t.action == "REQUEST_GENERATED"), None)
+        summary_vars = {'steps': len(traces)}
+        if anchor is not None:
+            for key in ('device_id', 'app_id', 'app_name', 'platform', 'ad_size'):
+                summary_vars[key] = anchor.internal_variables.get(key)
+        if outcome.action == "AUCTION_RESULT":
+            for key in ('winner_dsp', 'winner_bid', 'winner_ecpm', 'actual_paid_price', 'total_bids'):
+                summary_vars[key] = outcome.internal_variables.get(key)
+        # 出价摘要：诊断 Agent 按广告主统计出价、pCTR 与胜率需要这些字段
+        bid_summary = next((t for t in traces if t.action == "BID_SUMMARY"), None)
+        if bid_summary is not None:
+            summary_vars.update(bid_summary.internal_variables)
+        step_count = len(traces)
+        return WhiteboxTrace(
+            request_id=request_id,
+            timestamp=traces[0].timestamp,
+            node="ADX",
+            action="REQUEST_SUMMARY",
+            decision=outcome.decision,
+            reason_code=outcome.reason_code,
+            internal_variables=summary_vars,
+            reasoning=LazyReasoning(
+                lambda: f"请求未命中尾部采样，{step_count} 个决策点已折叠为摘要，结果：{outcome.reason_code}"
+            ),
+            pCTR=outcome.pCTR,
+            pCVR=outcome.pCVR,
+            eCPM=outcome.eCPM,
+            latency_ms=outcome.latency_ms,
+            second_best_bid=outcome.second_best_bid,
+            actual_paid_price=outcome.actual_paid_price,
+            saved_amount=outcome.saved_amount
+        )
     
     def log(self, trace: WhiteboxTrace):
         """写入一条白盒追踪记录"""
-        with open(self.log_file, 'a', encoding='utf-8') as f:
-            f.write(trace.to_log_line() + '\n')
+        if self._closed:
+            raise ValueError(f"WhiteboxLogger 已关闭：{self.log_file}")
+        pending = self._open_requests.get(trace.request_id)
+        if pending is not None:
+            pending.append(trace)
+            return
+        self._emit(trace)
+    
+    def _emit(self, record):
+        """写出一条日志记录（追踪或聚合记录，均提供 to_log_line）"""
+        if self._queue is None:
+            self.sink.write(record.to_log_line())
+            self.written_count += 1
+            return
+        
+        # 后台模式：只入队记录对象，序列化和磁盘写入都在写线程完成
+        self.enqueued_count += 1
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow_policy == OVERFLOW_DROP:
+                self.dropped_count += 1
+            elif self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                # 取出最旧的一条再放入新记录不是原子操作：腾出的空位可能被其他生产者占用，放不进去时重试
+                while True:
+                    try:
+                        oldest = self._queue.get_nowait()
+                    except queue.Empty:
+                        oldest = None
+                    if isinstance(oldest, threading.Event):
+                        # 不丢弃 flush 信号，直接唤醒等待方
+                        oldest.set()
+                    elif oldest is not None:
+                        self.dropped_count += 1
+                    try:
+                        self._queue.put_nowait(record)
+                        break
+                    except queue.Full:
+                        continue
+            else:
+                self.blocked_count += 1
+                self._queue.put(record)
+    
+    def _writer_loop(self):
+        """后台写线程：消费队列、序列化并写入输出端"""
+        while True:
+            try:
+                item = self._queue.get(timeout=self._writer_idle_seconds)
+            except queue.Empty:
+                # 空闲时按时间落盘，保证看板能读到最新日志
+                self._writer_call(self.sink.flush)
+                continue
+            if item is _WRITER_STOP:
+                break
+            if isinstance(item, threading.Event):
+                self._writer_call(self.sink.flush)
+                item.set()
+                continue
+            if self._writer_call(lambda: self.sink.write(item.to_log_line())):
+                self.written_count += 1
+    
+    def _writer_call(self, func) -> bool:
+        """
+        写线程中执行序列化 / 写入 / 落盘：异常计入 write_errors 并通过 logging 报告，写线程继续运行
+        首次出错记录完整堆栈，之后每 1000 次汇总一次，避免输出端持续故障时刷屏
+        """
+        try:
+            func()
+            return True
+        except Exception:
+            self.write_error_count += 1
+            if self.write_error_count == 1:
+                _log.exception("白盒日志写出失败：%s", self.log_file)
+            elif self.write_error_count % 1000 == 0:
+                _log.error("白盒日志写出失败已累计 %d 次：%s", self.write_error_count, self.log_file)
+            return False
+    
+    def stats(self) -> Dict:
+        """日志管道监控指标"""
+        return {
+            'async_mode': self.async_mode,
+            'overflow_policy': self.overflow_policy,
+            'enqueued': self.enqueued_count,
+            'written': self.written_count,
+            'dropped': self.dropped_count,
+            'blocked': self.blocked_count,
+            'write_errors': self.write_error_count,
+            'summarized_requests': self.summarized_count,
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0
+        }
+    
+    def flush(self):
+        """落盘：后台模式下等待写线程处理完当前队列"""
+        if self._queue is not None and self._writer.is_alive():
+            done = threading.Event()
+            self._queue.put(done)
+            done.wait()
+        else:
+            self.sink.flush()
+    
+    def close(self):
+        """落盘并关闭输出端（可重复调用）"""
+        if self._closed:
+            return
+        # 写出尚未结束的请求，避免追踪丢失
+        for request_id in list(self._open_requests):
+            self.end_request(request_id)
+        self._closed = True
+        if self._queue is not None and self._writer.is_alive():
+            self._queue.put(_WRITER_STOP)
+            self._writer.join()
+        self.sink.close()
+        atexit.unregister(self.close)
+    
+    def __enter__(self) -> 'WhiteboxLogger':
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
     
     def log_decision(self, request_id: str, node: str, action: str, 
                      decision: str, reason_code: str, 
-                     internal_variables: Dict, reasoning: str,
+                     internal_variables: Dict,
+                     reasoning: Union[str, Callable[[], str]] = "",
                      pctr: Optional[float] = None,
                      pcvr: Optional[float] = None,
                      ecpm: Optional[float] = None,
                      latency_ms: Optional[float] = None,
                      second_best_bid: Optional[float] = None,
                      actual_paid_price: Optional[float] = None,
-                     saved_amount: Optional[float] = None):
-        """便捷方法：记录决策点"""
+                     saved_amount: Optional[float] = None,
+                     reasoning_args: Optional[Dict] = None):
+        """
+        便捷方法：记录决策点
+        reasoning 可以是字符串、模板（配合 reasoning_args 按 str.format 填充）或返回字符串的可调用对象，
+        后两种情况只在序列化时渲染
+        """
+        if not self.is_enabled(action, decision):
+            return
+        if self.snapshot_variables and (self._queue is not None or request_id in self._open_requests):
+            # 延迟序列化：复制调用方之后可能修改的容器（与内部变量是同一对象的模板参数共用快照）
+            snapshot = _snapshot(internal_variables)
+            if reasoning_args is internal_variables:
+                reasoning_args = snapshot
+            internal_variables = snapshot
+        if reasoning_args is not None or callable(reasoning):
+            reasoning = LazyReasoning(reasoning, reasoning_args)
+            if self.eager_reasoning:
+                reasoning = reasoning.render()
         trace = WhiteboxTrace(
             request_id=request_id,
-            timestamp=datetime.now().isoformat(),
+            timestamp=self.request_time().iso,
             node=node,
             action=action,
             decision=decision,
@@ -58,7 +560,15 @@ class WhiteboxLogger:
 
 
 class FilterRule:
-    """过滤规则基类 - 可扩展的过滤策略"""
+    """
+    过滤规则基类 - 可扩展的过滤策略
+    stage: 规则所属阶段；只依赖请求字段的规则应声明为 FILTER_STAGE_PRE_BID，
+    被拒绝的请求不再向 DSP 扇出。默认按竞价后执行（可读取 bid_price）
+    independent: 为 False 时该规则在自适应排序中固定在原位置
+    """
+    stage = FILTER_STAGE_POST_BID
+    # 结果与副作用不依赖其他规则是否先执行：自适应排序（filter_order.AdaptiveFilterOrder）只重排独立规则
+    independent = True
     
     def __init__(self, name: str, logger: WhiteboxLogger):
         self.name = name
@@ -68,8 +578,48 @@ class FilterRule:
         """
         应用过滤规则
         返回: (是否通过, 原因代码, 内部变量快照)
+        通过且当前日志级别不记录该规则的 PASS 追踪时，应跳过快照构建并返回空字典
+        （用 self.logger.is_enabled(action, "PASS") 判断）
         """
         raise NotImplementedError("子类必须实现 apply 方法")
+    
+    def compile(self) -> Optional[Callable[[Dict], object]]:
+        """
+        编译为快速判定函数 check(ad_request)：通过时返回 None，拒绝时返回非 None 的拒绝信息（交给 explain）
+        判定函数不构建快照、不记录追踪；需要记录该规则的 PASS 追踪或规则不支持编译时返回 None，
+        过滤链对该规则回退到 apply
+        """
+        return None
+    
+    def explain(self, request_id: str, ad_request: Dict, rejection) -> Tuple[str, Dict]:
+        """编译判定拒绝后构建内部变量快照并记录 REJECT 追踪，返回: (原因代码, 内部变量快照)"""
+        raise NotImplementedError("支持 compile 的规则必须实现 explain 方法")
+
+
+class CompiledFilterChain:
+    """
+    预编译过滤链：依次执行各规则的判定函数，遇到第一个拒绝即停止，只为拒绝的规则构建快照与追踪
+    不支持编译的规则（如自定义 FilterRule 子类）在链中回退到 apply
+    """
+    __slots__ = ('filters', '_steps')
+    
+    def __init__(self, filters: List[FilterRule]):
+        self.filters = list(filters)
+        self._steps = tuple((rule, rule.compile()) for rule in self.filters)
+    
+    def run(self, request_id: str, ad_request: Dict) -> Optional[Tuple[FilterRule, str, Dict]]:
+        """全部通过时返回 None，否则返回: (拒绝的规则, 原因代码, 内部变量快照)"""
+        for rule, check in self._steps:
+            if check is None:
+                passed, reason_code, internal_vars = rule.apply(request_id, ad_request)
+                if not passed:
+                    return rule, reason_code, internal_vars
+                continue
+            rejection = check(ad_request)
+            if rejection is not None:
+                reason_code, internal_vars = rule.explain(request_id, ad_request, rejection)
+                return rule, reason_code, internal_vars
+        return None
 
 
 class FloorPriceFilter(FilterRule):
@@ -81,79 +631,143 @@ class FloorPriceFilter(FilterRule):
     
     def apply(self, request_id: str, ad_request: Dict) -> Tuple[bool, str, Dict]:
         bid_price = ad_request.get('bid_price', 0)
+        if bid_price < self.floor_price:
+            return (False,) + self.explain(request_id, ad_request, bid_price)
+        if not self.logger.is_enabled("FLOOR_PRICE_CHECK", "PASS"):
+            return True, "BID_ABOVE_FLOOR", {}
+        
         internal_vars = {
             'bid_price': bid_price,
             'floor_price': self.floor_price,
             'filter_name': self.name
         }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="FLOOR_PRICE_CHECK",
+            decision="PASS",
+            reason_code="BID_ABOVE_FLOOR",
+            internal_variables=internal_vars,
+            reasoning="出价 {bid_price} 高于底价 {floor_price}，通过底价过滤",
+            reasoning_args=internal_vars
+        )
+        return True, "BID_ABOVE_FLOOR", internal_vars
+    
+    def compile(self) -> Optional[Callable[[Dict], object]]:
+        if self.logger.is_enabled("FLOOR_PRICE_CHECK", "PASS"):
+            return None
+        floor_price = self.floor_price
         
-        if bid_price >= self.floor_price:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="FLOOR_PRICE_CHECK",
-                decision="PASS",
-                reason_code="BID_ABOVE_FLOOR",
-                internal_variables=internal_vars,
-                reasoning=f"出价 {bid_price} 高于底价 {self.floor_price}，通过底价过滤"
-            )
-            return True, "BID_ABOVE_FLOOR", internal_vars
-        else:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="FLOOR_PRICE_CHECK",
-                decision="REJECT",
-                reason_code="BID_BELOW_FLOOR",
-                internal_variables=internal_vars,
-                reasoning=f"出价 {bid_price} 低于底价 {self.floor_price}，被底价过滤拒绝"
-            )
-            return False, "BID_BELOW_FLOOR", internal_vars
+        def check(ad_request: Dict):
+            bid_price = ad_request.get('bid_price', 0)
+            return bid_price if bid_price < floor_price else None
+        return check
+    
+    def explain(self, request_id: str, ad_request: Dict, bid_price) -> Tuple[str, Dict]:
+        internal_vars = {
+            'bid_price': bid_price,
+            'floor_price': self.floor_price,
+            'filter_name': self.name
+        }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="FLOOR_PRICE_CHECK",
+            decision="REJECT",
+            reason_code="BID_BELOW_FLOOR",
+            internal_variables=internal_vars,
+            reasoning="出价 {bid_price} 低于底价 {floor_price}，被底价过滤拒绝",
+            reasoning_args=internal_vars
+        )
+        return "BID_BELOW_FLOOR", internal_vars
 
 
 class BlacklistFilter(FilterRule):
     """黑名单过滤规则"""
+    stage = FILTER_STAGE_PRE_BID
     
-    def __init__(self, blacklist: List[str], logger: WhiteboxLogger):
+    def __init__(self, blacklist: Union[List[str], MmapBlacklist], logger: WhiteboxLogger):
+        """
+        - blacklist: 条目列表 / 集合，或离线构建的内存映射黑名单（MmapBlacklist）
+        """
         super().__init__("BlacklistFilter", logger)
+        self.update_blacklist(blacklist)
+    
+    def update_blacklist(self, blacklist: Union[List[str], MmapBlacklist]):
+        """
+        替换黑名单并计算内容版本号
+        完整条目只在版本变化时登记一次（旁路文件），追踪中仅记录版本号与条目数
+        """
+        if isinstance(blacklist, MmapBlacklist):
+            # 内存映射黑名单：版本号在构建时已写入文件头，不在进程内展开为集合
+            self.blacklist = blacklist
+            self.blacklist_version = blacklist.version
+            self.logger.register_blacklist(self.blacklist_version, size=len(blacklist), source=blacklist.path)
+            return
         self.blacklist = set(blacklist)
+        self.blacklist_version = blacklist_version(self.blacklist)
+        self.logger.register_blacklist(self.blacklist_version, self.blacklist)
     
     def apply(self, request_id: str, ad_request: Dict) -> Tuple[bool, str, Dict]:
         device_id = ad_request.get('device_id', '')
         app_id = ad_request.get('app_id', '')
-        internal_vars = {
+        if device_id in self.blacklist or app_id in self.blacklist:
+            return (False,) + self.explain(request_id, ad_request, True)
+        if not self.logger.is_enabled("BLACKLIST_CHECK", "PASS"):
+            return True, "NOT_IN_BLACKLIST", {}
+        
+        internal_vars = self._snapshot(device_id, app_id)
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="BLACKLIST_CHECK",
+            decision="PASS",
+            reason_code="NOT_IN_BLACKLIST",
+            internal_variables=internal_vars,
+            reasoning="设备 {device_id} 和应用 {app_id} 不在黑名单中，通过检查",
+            reasoning_args=internal_vars
+        )
+        return True, "NOT_IN_BLACKLIST", internal_vars
+    
+    def compile(self) -> Optional[Callable[[Dict], object]]:
+        if self.logger.is_enabled("BLACKLIST_CHECK", "PASS"):
+            return None
+        
+        def check(ad_request: Dict):
+            # 每次读取 self.blacklist，update_blacklist 替换黑名单后无需重新编译
+            blacklist = self.blacklist
+            if ad_request.get('device_id', '') in blacklist or ad_request.get('app_id', '') in blacklist:
+                return True
+            return None
+        return check
+    
+    def explain(self, request_id: str, ad_request: Dict, rejection) -> Tuple[str, Dict]:
+        internal_vars = self._snapshot(ad_request.get('device_id', ''), ad_request.get('app_id', ''))
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="BLACKLIST_CHECK",
+            decision="REJECT",
+            reason_code="IN_BLACKLIST",
+            internal_variables=internal_vars,
+            reasoning="设备 {device_id} 或应用 {app_id} 在黑名单中，拒绝请求",
+            reasoning_args=internal_vars
+        )
+        return "IN_BLACKLIST", internal_vars
+    
+    def _snapshot(self, device_id: str, app_id: str) -> Dict:
+        return {
             'device_id': device_id,
             'app_id': app_id,
-            'blacklist': list(self.blacklist),
+            'blacklist_version': self.blacklist_version,
+            'blacklist_size': len(self.blacklist),
             'filter_name': self.name
         }
-        
-        if device_id in self.blacklist or app_id in self.blacklist:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="BLACKLIST_CHECK",
-                decision="REJECT",
-                reason_code="IN_BLACKLIST",
-                internal_variables=internal_vars,
-                reasoning=f"设备 {device_id} 或应用 {app_id} 在黑名单中，拒绝请求"
-            )
-            return False, "IN_BLACKLIST", internal_vars
-        else:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="BLACKLIST_CHECK",
-                decision="PASS",
-                reason_code="NOT_IN_BLACKLIST",
-                internal_variables=internal_vars,
-                reasoning=f"设备 {device_id} 和应用 {app_id} 不在黑名单中，通过检查"
-            )
-            return True, "NOT_IN_BLACKLIST", internal_vars
 
 
 class SizeMatchFilter(FilterRule):
     """尺寸匹配过滤规则"""
+    stage = FILTER_STAGE_PRE_BID
     
     def __init__(self, required_size: tuple, logger: WhiteboxLogger):
         super().__init__("SizeMatchFilter", logger)
@@ -161,114 +775,182 @@ class SizeMatchFilter(FilterRule):
     
     def apply(self, request_id: str, ad_request: Dict) -> Tuple[bool, str, Dict]:
         ad_size = ad_request.get('ad_size', (0, 0))
+        if ad_size != self.required_size:
+            return (False,) + self.explain(request_id, ad_request, ad_size)
+        if not self.logger.is_enabled("SIZE_MATCH_CHECK", "PASS"):
+            return True, "SIZE_MATCHED", {}
+        
         internal_vars = {
             'ad_size': ad_size,
             'required_size': self.required_size,
             'filter_name': self.name
         }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="SIZE_MATCH_CHECK",
+            decision="PASS",
+            reason_code="SIZE_MATCHED",
+            internal_variables=internal_vars,
+            reasoning="广告尺寸 {ad_size} 匹配要求尺寸 {required_size}",
+            reasoning_args=internal_vars
+        )
+        return True, "SIZE_MATCHED", internal_vars
+    
+    def compile(self) -> Optional[Callable[[Dict], object]]:
+        if self.logger.is_enabled("SIZE_MATCH_CHECK", "PASS"):
+            return None
+        required_size = self.required_size
         
-        if ad_size == self.required_size:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="SIZE_MATCH_CHECK",
-                decision="PASS",
-                reason_code="SIZE_MATCHED",
-                internal_variables=internal_vars,
-                reasoning=f"广告尺寸 {ad_size} 匹配要求尺寸 {self.required_size}"
-            )
-            return True, "SIZE_MATCHED", internal_vars
-        else:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="SIZE_MATCH_CHECK",
-                decision="REJECT",
-                reason_code="SIZE_MISMATCH",
-                internal_variables=internal_vars,
-                reasoning=f"广告尺寸 {ad_size} 不匹配要求尺寸 {self.required_size}"
-            )
-            return False, "SIZE_MISMATCH", internal_vars
+        def check(ad_request: Dict):
+            ad_size = ad_request.get('ad_size', (0, 0))
+            return ad_size if ad_size != required_size else None
+        return check
+    
+    def explain(self, request_id: str, ad_request: Dict, ad_size) -> Tuple[str, Dict]:
+        internal_vars = {
+            'ad_size': ad_size,
+            'required_size': self.required_size,
+            'filter_name': self.name
+        }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="SIZE_MATCH_CHECK",
+            decision="REJECT",
+            reason_code="SIZE_MISMATCH",
+            internal_variables=internal_vars,
+            reasoning="广告尺寸 {ad_size} 不匹配要求尺寸 {required_size}",
+            reasoning_args=internal_vars
+        )
+        return "SIZE_MISMATCH", internal_vars
 
 
 class LatencyTimeoutFilter(FilterRule):
-    """延迟超时过滤规则"""
+    """
+    延迟超时过滤规则
+    LATENCY_CHECK 追踪与引擎的 SSP 延迟超时检查使用相同的 latency_ms / timeout_threshold 字段（另带 filter_name），
+    延迟同时记录在追踪顶层的 latency_ms
+    """
+    stage = FILTER_STAGE_PRE_BID
     
-    def __init__(self, max_latency_ms: int, logger: WhiteboxLogger):
+    def __init__(self, max_latency_ms: int, logger: WhiteboxLogger, rng=None):
         super().__init__("LatencyTimeoutFilter", logger)
         self.max_latency_ms = max_latency_ms
+        self._rng = (rng if rng is not None else GLOBAL_RANDOM).stream('filter.latency')
     
     def apply(self, request_id: str, ad_request: Dict) -> Tuple[bool, str, Dict]:
         # 模拟处理延迟（实际应该从请求开始时间计算）
-        latency_ms = random.randint(10, 150)  # 模拟 10-150ms 延迟
+        latency_ms = self._rng.randint(10, 150)  # 模拟 10-150ms 延迟
+        if latency_ms > self.max_latency_ms:
+            return (False,) + self.explain(request_id, ad_request, latency_ms)
+        if not self.logger.is_enabled("LATENCY_CHECK", "PASS"):
+            return True, "LATENCY_OK", {}
+        
         internal_vars = {
             'latency_ms': latency_ms,
-            'max_latency_ms': self.max_latency_ms,
+            'timeout_threshold': self.max_latency_ms,
             'filter_name': self.name
         }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="LATENCY_CHECK",
+            decision="PASS",
+            reason_code="LATENCY_OK",
+            internal_variables=internal_vars,
+            reasoning="响应延迟 {latency_ms}ms 在允许范围内（≤{timeout_threshold}ms）",
+            reasoning_args=internal_vars,
+            latency_ms=latency_ms
+        )
+        return True, "LATENCY_OK", internal_vars
+    
+    def compile(self) -> Optional[Callable[[Dict], object]]:
+        if self.logger.is_enabled("LATENCY_CHECK", "PASS"):
+            return None
+        randint, max_latency_ms = self._rng.randint, self.max_latency_ms
         
-        if latency_ms <= self.max_latency_ms:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="LATENCY_CHECK",
-                decision="PASS",
-                reason_code="LATENCY_OK",
-                internal_variables=internal_vars,
-                reasoning=f"响应延迟 {latency_ms}ms 在允许范围内（≤{self.max_latency_ms}ms）"
-            )
-            return True, "LATENCY_OK", internal_vars
-        else:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="LATENCY_CHECK",
-                decision="REJECT",
-                reason_code="LATENCY_TIMEOUT",
-                internal_variables=internal_vars,
-                reasoning=f"响应延迟 {latency_ms}ms 超过阈值 {self.max_latency_ms}ms，请求超时"
-            )
-            return False, "LATENCY_TIMEOUT", internal_vars
+        def check(ad_request: Dict):
+            latency_ms = randint(10, 150)
+            return latency_ms if latency_ms > max_latency_ms else None
+        return check
+    
+    def explain(self, request_id: str, ad_request: Dict, latency_ms) -> Tuple[str, Dict]:
+        internal_vars = {
+            'latency_ms': latency_ms,
+            'timeout_threshold': self.max_latency_ms,
+            'filter_name': self.name
+        }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="LATENCY_CHECK",
+            decision="REJECT",
+            reason_code="LATENCY_TIMEOUT",
+            internal_variables=internal_vars,
+            reasoning="响应延迟 {latency_ms}ms 超过阈值 {timeout_threshold}ms，请求超时",
+            reasoning_args=internal_vars,
+            latency_ms=latency_ms
+        )
+        return "LATENCY_TIMEOUT", internal_vars
 
 
 class CreativeMismatchFilter(FilterRule):
     """素材合规性过滤规则"""
     
-    def __init__(self, logger: WhiteboxLogger, rejection_rate: float = 0.1):
+    def __init__(self, logger: WhiteboxLogger, rejection_rate: float = 0.1, rng=None):
         super().__init__("CreativeMismatchFilter", logger)
         self.rejection_rate = rejection_rate  # 10% 的素材不合规率
+        self._rng = (rng if rng is not None else GLOBAL_RANDOM).stream('filter.creative')
     
     def apply(self, request_id: str, ad_request: Dict) -> Tuple[bool, str, Dict]:
         # 模拟素材合规性检查
-        is_compliant = random.random() > self.rejection_rate
+        if self._rng.random() <= self.rejection_rate:
+            return (False,) + self.explain(request_id, ad_request, True)
+        if not self.logger.is_enabled("CREATIVE_COMPLIANCE_CHECK", "PASS"):
+            return True, "CREATIVE_COMPLIANT", {}
+        
         internal_vars = {
-            'is_compliant': is_compliant,
+            'is_compliant': True,
             'rejection_rate': self.rejection_rate,
             'filter_name': self.name
         }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="CREATIVE_COMPLIANCE_CHECK",
+            decision="PASS",
+            reason_code="CREATIVE_COMPLIANT",
+            internal_variables=internal_vars,
+            reasoning="素材通过合规性检查"
+        )
+        return True, "CREATIVE_COMPLIANT", internal_vars
+    
+    def compile(self) -> Optional[Callable[[Dict], object]]:
+        if self.logger.is_enabled("CREATIVE_COMPLIANCE_CHECK", "PASS"):
+            return None
+        random_draw, rejection_rate = self._rng.random, self.rejection_rate
         
-        if is_compliant:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="CREATIVE_COMPLIANCE_CHECK",
-                decision="PASS",
-                reason_code="CREATIVE_COMPLIANT",
-                internal_variables=internal_vars,
-                reasoning="素材通过合规性检查"
-            )
-            return True, "CREATIVE_COMPLIANT", internal_vars
-        else:
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="CREATIVE_COMPLIANCE_CHECK",
-                decision="REJECT",
-                reason_code="CREATIVE_MISMATCH",
-                internal_variables=internal_vars,
-                reasoning="素材不合规，被拒绝（可能包含违规内容、尺寸不符等）"
-            )
-            return False, "CREATIVE_MISMATCH", internal_vars
+        def check(ad_request: Dict):
+            return True if random_draw() <= rejection_rate else None
+        return check
+    
+    def explain(self, request_id: str, ad_request: Dict, rejection) -> Tuple[str, Dict]:
+        internal_vars = {
+            'is_compliant': False,
+            'rejection_rate': self.rejection_rate,
+            'filter_name': self.name
+        }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="CREATIVE_COMPLIANCE_CHECK",
+            decision="REJECT",
+            reason_code="CREATIVE_MISMATCH",
+            internal_variables=internal_vars,
+            reasoning="素材不合规，被拒绝（可能包含违规内容、尺寸不符等）"
+        )
+        return "CREATIVE_MISMATCH", internal_vars
 
 
 class FloorPriceHighFilter(FilterRule):
@@ -280,43 +962,92 @@ class FloorPriceHighFilter(FilterRule):
     
     def apply(self, request_id: str, ad_request: Dict) -> Tuple[bool, str, Dict]:
         bid_price = ad_request.get('bid_price', 0)
+        if bid_price < self.floor_price:
+            return (False,) + self.explain(request_id, ad_request, bid_price)
+        if not self.logger.is_enabled("FLOOR_PRICE_HIGH_CHECK", "PASS"):
+            return True, "BID_ABOVE_FLOOR", {}
+        
         internal_vars = {
             'bid_price': bid_price,
             'floor_price': self.floor_price,
-            'price_gap': self.floor_price - bid_price if bid_price < self.floor_price else 0,
+            'price_gap': 0,
             'filter_name': self.name
         }
-        
-        if bid_price >= self.floor_price:
-            return True, "BID_ABOVE_FLOOR", internal_vars
-        else:
-            # 记录底价过高的损耗
-            self.logger.log_decision(
-                request_id=request_id,
-                node="ADX",
-                action="FLOOR_PRICE_HIGH_CHECK",
-                decision="REJECT",
-                reason_code="FLOOR_PRICE_HIGH",
-                internal_variables=internal_vars,
-                reasoning=f"出价 {bid_price} 低于底价 {self.floor_price}，底价设置可能过高，导致 {internal_vars['price_gap']:.4f} 的潜在收入损失"
-            )
-            return False, "FLOOR_PRICE_HIGH", internal_vars
+        return True, "BID_ABOVE_FLOOR", internal_vars
+    
+    def compile(self) -> Optional[Callable[[Dict], object]]:
+        # 通过时不记录追踪，任何日志级别都可以编译
+        floor_price = self.floor_price
+        
+        def check(ad_request: Dict):
+            bid_price = ad_request.get('bid_price', 0)
+            return bid_price if bid_price < floor_price else None
+        return check
+    
+    def explain(self, request_id: str, ad_request: Dict, bid_price) -> Tuple[str, Dict]:
+        internal_vars = {
+            'bid_price': bid_price,
+            'floor_price': self.floor_price,
+            'price_gap': self.floor_price - bid_price,
+            'filter_name': self.name
+        }
+        # 记录底价过高的损耗
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="FLOOR_PRICE_HIGH_CHECK",
+            decision="REJECT",
+            reason_code="FLOOR_PRICE_HIGH",
+            internal_variables=internal_vars,
+            reasoning="出价 {bid_price} 低于底价 {floor_price}，底价设置可能过高，导致 {price_gap:.4f} 的潜在收入损失",
+            reasoning_args=internal_vars
+        )
+        return "FLOOR_PRICE_HIGH", internal_vars
 
 
 class QualityScorer:
     """流量质量评分器 - 反欺诈检测"""
     
-    def __init__(self, logger: WhiteboxLogger, fraud_rate: float = 0.15):
+    def __init__(self, logger: WhiteboxLogger, fraud_rate: float = 0.15,
+                 ip_window_seconds: float = 300,
+                 ip_bucket_seconds: float = 5,
+                 max_tracked_ips: int = 100000,
+                 max_tracked_click_keys: int = 100000,
+                 feature_provider=None,
+                 max_devices_per_ip: int = 50,
+                 max_ips_per_device: int = 20,
+                 rng=None):
         """
         初始化质量评分器
         - fraud_rate: 作弊流量比例，默认 15%
+        - ip_window_seconds / ip_bucket_seconds: IP 集中度统计窗口与时间桶粒度
+        - max_tracked_ips: 最多跟踪的 IP 数，超出后按 LRU 淘汰冷 IP
+        - max_tracked_click_keys: 最多跟踪的设备-应用点击历史数，超出后按 LRU 淘汰
+        - feature_provider: 流量特征提供者，默认 ExactFeatureProvider（按 IP 精确计数）；
+          全量流量可使用 SketchFeatureProvider（固定内存，额外提供设备 / IP 基数特征）
+        - max_devices_per_ip / max_ips_per_device: 基数特征阈值（仅在提供者给出对应特征时生效）
+        - rng: 随机数源（EngineRandom），默认使用 random 模块
         """
         self.logger = logger
+        rng = rng if rng is not None else GLOBAL_RANDOM
+        self._ip_rng = rng.stream('quality.ip')
+        self._click_rng = rng.stream('quality.click')
+        self._fraud_rng = rng.stream('quality.fraud')
         self.fraud_rate = fraud_rate
-        # 模拟 IP 池（用于检测 IP 异常集中）
-        self.ip_pool = {}
-        # 模拟点击坐标历史（用于检测坐标固定）
-        self.click_coordinates = {}
+        self.max_devices_per_ip = max_devices_per_ip
+        self.max_ips_per_device = max_ips_per_device
+        # 窗口内流量特征（用于检测 IP 异常集中等）
+        # 窗口按引擎时钟（当前请求的时间戳）滑动；传入的提供者未指定时钟时同样绑定到引擎时钟，模拟时钟下窗口随模拟时间老化
+        request_clock = lambda: self.logger.request_time().timestamp
+        if feature_provider is None:
+            feature_provider = ExactFeatureProvider(ip_window_seconds, ip_bucket_seconds, max_tracked_ips,
+                                                    clock=request_clock)
+        elif hasattr(feature_provider, 'bind_clock'):
+            feature_provider.bind_clock(request_clock)
+        self.feature_provider = feature_provider
+        # 点击坐标历史（用于检测坐标固定）：每个设备-应用最近 20 次点击
+        self.click_tracker = ClickDispersionTracker(history_size=20, min_samples=5,
+                                                    variance_threshold=100, max_keys=max_tracked_click_keys)
     
     def score(self, request_id: str, ad_request: Dict) -> Tuple[float, Dict]:
         """
@@ -327,69 +1058,48 @@ class QualityScorer:
         app_id = ad_request.get('app_id', '')
         
         # 模拟 IP 地址（实际应从请求中获取）
-        ip_address = f"192.168.{random.randint(1, 10)}.{random.randint(1, 255)}"
+        ip_address = f"192.168.{self._ip_rng.randint(1, 10)}.{self._ip_rng.randint(1, 255)}"
         
         # 模拟点击坐标（实际应从点击事件中获取）
-        click_x = random.randint(0, 1080)
-        click_y = random.randint(0, 1920)
+        click_x = self._click_rng.randint(0, 1080)
+        click_y = self._click_rng.randint(0, 1920)
         
         fraud_features = []
         q_factor = 1.0
         
         # 特征 1: IP 异常集中检测
         # 模拟：如果该 IP 在短时间内出现次数过多，标记为异常
-        if ip_address not in self.ip_pool:
-            self.ip_pool[ip_address] = []
-        self.ip_pool[ip_address].append(datetime.now())
-        
-        # 清理 5 分钟前的记录
-        five_min_ago = datetime.now().timestamp() - 300
-        self.ip_pool[ip_address] = [
-            ts for ts in self.ip_pool[ip_address] 
-            if ts.timestamp() > five_min_ago
-        ]
+        traffic_features = self.feature_provider.observe(ip_address, device_id)
         
         # 如果同一 IP 在 5 分钟内出现超过 10 次，标记为异常
-        if len(self.ip_pool[ip_address]) > 10:
+        if traffic_features['ip_requests'] > 10:
             fraud_features.append("IP异常集中")
             q_factor *= 0.5  # IP 异常集中，质量系数降低 50%
         
+        # 基数特征（草图提供者）：同一 IP 下设备过多 / 同一设备频繁更换 IP
+        if traffic_features.get('devices_per_ip', 0) > self.max_devices_per_ip:
+            fraud_features.append("IP设备数异常")
+            q_factor *= 0.7
+        if traffic_features.get('ips_per_device', 0) > self.max_ips_per_device:
+            fraud_features.append("设备IP漂移")
+            q_factor *= 0.7
+        
         # 特征 2: 点击坐标固定检测
         # 模拟：如果点击坐标过于固定（方差很小），标记为异常
         coordinate_key = f"{device_id}_{app_id}"
-        if coordinate_key not in self.click_coordinates:
-            self.click_coordinates[coordinate_key] = []
         
-        self.click_coordinates[coordinate_key].append((click_x, click_y))
-        
-        # 只保留最近 20 次点击记录
-        if len(self.click_coordinates[coordinate_key]) > 20:
-            self.click_coordinates[coordinate_key] = self.click_coordinates[coordinate_key][-20:]
-        
-        # 如果坐标方差过小（点击位置过于固定），标记为异常
-        if len(self.click_coordinates[coordinate_key]) >= 5:
-            coords = self.click_coordinates[coordinate_key]
-            x_coords = [c[0] for c in coords]
-            y_coords = [c[1] for c in coords]
-            
-            # 计算坐标方差
-            x_mean = sum(x_coords) / len(x_coords)
-            y_mean = sum(y_coords) / len(y_coords)
-            x_variance = sum((x - x_mean) ** 2 for x in x_coords) / len(x_coords)
-            y_variance = sum((y - y_mean) ** 2 for y in y_coords) / len(y_coords)
-            
-            # 如果 X 或 Y 坐标方差小于 100（点击位置过于集中），标记为异常
-            if x_variance < 100 or y_variance < 100:
-                fraud_features.append("点击坐标固定")
-                q_factor *= 0.6  # 点击坐标固定，质量系数降低 40%
+        # 如果 X 或 Y 坐标方差小于 100（点击位置过于集中），标记为异常（至少 5 次点击）
+        if self.click_tracker.add(coordinate_key, click_x, click_y):
+            fraud_features.append("点击坐标固定")
+            q_factor *= 0.6  # 点击坐标固定，质量系数降低 40%
         
         # 随机模拟其他作弊特征（用于演示）
-        if random.random() < self.fraud_rate:
-            if "IP异常集中" not in fraud_features and "点击坐标固定" not in fraud_features:
+        if self._fraud_rng.random() < self.fraud_rate:
+            if not fraud_features:
                 # 随机选择一种作弊特征
-                fraud_type = random.choice(["设备指纹异常", "行为模式异常", "时间分布异常"])
+                fraud_type = self._fraud_rng.choice(["设备指纹异常", "行为模式异常", "时间分布异常"])
                 fraud_features.append(fraud_type)
-                q_factor *= random.uniform(0.3, 0.7)  # 随机降低质量系数
+                q_factor *= self._fraud_rng.uniform(0.3, 0.7)  # 随机降低质量系数
         
         # 确保 q_factor 在 [0.0, 1.0] 范围内
         q_factor = max(0.0, min(1.0, q_factor))
@@ -399,6 +1109,7 @@ class QualityScorer:
             'fraud_features': fraud_features,
             'ip_address': ip_address,
             'click_coordinates': (click_x, click_y),
+            'traffic_features': traffic_features,
             'quality_score': q_factor,
             'is_high_risk': q_factor < 0.5
         }
@@ -411,10 +1122,16 @@ class QualityScorer:
             decision="PASS" if q_factor >= 0.5 else "WARNING",
             reason_code="QUALITY_SCORED",
             internal_variables=score_details,
-            reasoning=f"流量质量评分：q_factor={q_factor:.2f}，检测到特征：{', '.join(fraud_features) if fraud_features else '无异常'}"
+            reasoning=lambda: f"流量质量评分：q_factor={q_factor:.2f}，检测到特征：{', '.join(fraud_features) if fraud_features else '无异常'}"
         )
         
         return q_factor, score_details
+    
+    def stats(self) -> Dict:
+        """特征计数器监控指标"""
+        stats = dict(self.feature_provider.stats())
+        stats['click_tracker'] = self.click_tracker.stats()
+        return stats
 
 
 class BiddingStrategy:
@@ -427,7 +1144,7 @@ class BiddingStrategy:
     def calculate_bid(self, request_id: str, ad_request: Dict) -> Tuple[float, Dict, str]:
         """
         计算出价
-        返回: (出价金额, 内部变量快照, 推理说明)
+        返回: (出价金额, 内部变量快照, 推理说明（字符串或 LazyReasoning）)
         """
         raise NotImplementedError("子类必须实现 calculate_bid 方法")
 
@@ -442,7 +1159,7 @@ class CTRBasedBiddingStrategy(BiddingStrategy):
     def _get_multiplier(self, ad_request: Dict) -> Tuple[float, str]:
         """计算乘数因子"""
         platform = ad_request.get('platform', '').upper()
-        hour = datetime.now().hour
+        hour = self.logger.request_time().hour
         
         multiplier = 1.0
         reasons = []
@@ -473,11 +1190,15 @@ class CTRBasedBiddingStrategy(BiddingStrategy):
             'multiplier': multiplier,
             'final_bid': final_bid,
             'platform': ad_request.get('platform', ''),
-            'hour': datetime.now().hour,
-            'strategy_name': self.name
+            'hour': self.logger.request_time().hour,
+            'strategy_name': self.name,
+            'dsp_id': ad_request.get('dsp_id')
         }
         
-        reasoning = f"基础价 {self.base_price} × CTR得分 {ctr_score} × 乘数 {multiplier} = {final_bid}。{multiplier_reason}"
+        # 推理说明延迟渲染：只有在追踪被序列化时才格式化
+        reasoning = LazyReasoning(
+            lambda: f"基础价 {self.base_price} × CTR得分 {ctr_score} × 乘数 {multiplier} = {final_bid}。{multiplier_reason}"
+        )
         
         self.logger.log_decision(
             request_id=request_id,
@@ -492,16 +1213,37 @@ class CTRBasedBiddingStrategy(BiddingStrategy):
         return final_bid, internal_vars, reasoning
 
 
+# SKAN 转化值取值范围 0-63
+SKAN_CONVERSION_VALUES = 64
+_SKAN_RESCALE_THRESHOLD = 1e12
+
+
 class SKANOptimizer:
     """SKAN (SKAdNetwork) 概率优化器 - 处理隐私受限环境下的延迟归因"""
     
-    def __init__(self, logger: WhiteboxLogger):
+    def __init__(self, logger: WhiteboxLogger, per_campaign: bool = False, distribution_store=None, rng=None):
+        """
+        - per_campaign: 为 True 时按活动（请求中的 campaign_id，缺省为 app_id）维护独立分布，
+          新活动以全局分布为先验（需要 NumPy，见 skan_store.SKANDistributionStore）
+        - distribution_store: 已有的活动分布矩阵（如从检查点加载），优先于 per_campaign
+        - rng: 随机数源（EngineRandom），默认使用 random 模块
+        """
         self.logger = logger
-        # 历史转化值分布（用于概率预估）
-        # 格式：{conversion_value: probability}
-        self.historical_conversion_distribution = self._initialize_conversion_distribution()
+        rng = rng if rng is not None else GLOBAL_RANDOM
+        self._conversion_rng = rng.stream('skan.conversion')
+        self._delay_rng = rng.stream('skan.delay')
+        # 历史转化值分布（用于概率预估）：按转化值 0-63 存放的未归一化权重及其总和，
+        # 概率 = 权重 / 总和；累积权重表在分布变化后首次采样时重建
+        distribution = self._initialize_conversion_distribution()
+        self._weights: List[float] = [distribution[value] for value in range(SKAN_CONVERSION_VALUES)]
+        self._total_weight = sum(self._weights)
+        self._cdf: Optional[List[float]] = None
         # 转化值到业务价值的映射（0-63）
         self.conversion_value_mapping = self._initialize_conversion_mapping()
+        if distribution_store is None and per_campaign:
+            from skan_store import SKANDistributionStore
+            distribution_store = SKANDistributionStore(self._weights)
+        self.distribution_store = distribution_store
     
     def _initialize_conversion_distribution(self) -> Dict[int, float]:
         """初始化历史转化值分布（模拟数据）"""
@@ -553,8 +1295,18 @@ class SKANOptimizer:
             return None, {}
         
         # 模拟生成转化值（实际应该从 SKAN postback 中获取）
-        # 这里使用历史分布的概率来模拟
-        conversion_value = self._sample_conversion_value()
+        # 这里使用历史分布的概率来模拟；按活动维护分布时查找该活动的行
+        campaign_id = self.campaign_key(ad_request)
+        if campaign_id is not None:
+            conversion_value = self.distribution_store.sample(campaign_id, self._conversion_rng)
+            historical_prob = self.distribution_store.probability(campaign_id, conversion_value)
+        else:
+            conversion_value = self._sample_conversion_value()
+            historical_prob = self.conversion_probability(conversion_value)
+        
+        # 模拟 postback 延迟（24h - 48h）
+        postback_delay_hours = self._delay_rng.uniform(24, 48)
+        
         business_value = self.conversion_value_mapping.get(conversion_value, 0)
         
         # 基于转化值预估 pCVR
@@ -563,14 +1315,11 @@ class SKANOptimizer:
         base_pcvr = 0.01 + (conversion_value / 63.0) * 0.09
         
         # 应用历史分布概率调整
-        historical_prob = self.historical_conversion_distribution.get(conversion_value, 0.01)
         confidence = min(1.0, historical_prob * 10)  # 转换为信心度（0-1）
         
         # 概率调整后的 pCVR
         adjusted_pcvr = base_pcvr * (0.7 + confidence * 0.3)  # 在基础值上下浮动30%
         
-        # 模拟 postback 延迟（24h - 48h）
-        postback_delay_hours = random.uniform(24, 48)
         postback_delay_seconds = postback_delay_hours * 3600
         
         optimization_details = {
@@ -584,6 +1333,8 @@ class SKANOptimizer:
             'historical_prob': historical_prob,
             'is_skan_optimized': True
         }
+        if campaign_id is not None:
+            optimization_details['campaign_id'] = campaign_id
         
         # 记录 SKAN 优化结果
         self.logger.log_decision(
@@ -593,72 +1344,186 @@ class SKANOptimizer:
             decision="PASS",
             reason_code="SKAN_PCVR_ESTIMATED",
             internal_variables=optimization_details,
-            reasoning=f"SKAN 概率优化：转化值 {conversion_value}，业务价值 ${business_value:.2f}，预估 pCVR {adjusted_pcvr*100:.2f}%，预测信心度 {confidence*100:.1f}%，postback 延迟 {postback_delay_hours:.1f} 小时"
+            reasoning="SKAN 概率优化：转化值 {conversion_value}，业务价值 ${business_value:.2f}，预估 pCVR {adjusted_pcvr:.2%}，预测信心度 {confidence:.1%}，postback 延迟 {postback_delay_hours:.1f} 小时",
+            reasoning_args=optimization_details
         )
         
         return adjusted_pcvr, optimization_details
     
+    def campaign_key(self, ad_request: Dict) -> Optional[str]:
+        """按活动维护分布时的行键：campaign_id，缺省为 app_id；未启用时返回 None"""
+        if self.distribution_store is None:
+            return None
+        return ad_request.get('campaign_id') or ad_request.get('app_id', '')
+    
+    @property
+    def historical_conversion_distribution(self) -> Dict[int, float]:
+        """历史转化值分布快照 {conversion_value: probability}（只读，修改请使用 update_conversion_distribution）"""
+        total = self._total_weight
+        return {value: weight / total for value, weight in enumerate(self._weights)}
+    
+    def conversion_probability(self, conversion_value: int, default: float = 0.01) -> float:
+        """单个转化值的历史概率"""
+        if 0 <= conversion_value < SKAN_CONVERSION_VALUES:
+            return self._weights[conversion_value] / self._total_weight
+        return default
+    
+    def _cumulative_weights(self) -> List[float]:
+        """累积权重表（缓存，分布更新后失效）"""
+        if self._cdf is None:
+            self._cdf = list(itertools.accumulate(self._weights))
+        return self._cdf
+    
     def _sample_conversion_value(self) -> int:
-        """根据历史分布概率采样转化值"""
-        rand = random.random()
-        cumulative = 0.0
-        for value, prob in sorted(self.historical_conversion_distribution.items()):
-            cumulative += prob
-            if rand <= cumulative:
-                return value
-        return 31  # 默认返回中值
+        """根据历史分布概率采样转化值：在累积权重表上二分查找"""
+        cdf = self._cumulative_weights()
+        index = bisect.bisect_left(cdf, self._conversion_rng.random() * self._total_weight)
+        return index if index < SKAN_CONVERSION_VALUES else 31  # 浮点误差越界时返回中值
+    
+    def sample_many(self, n: int):
+        """批量采样 n 个转化值，安装 NumPy 时返回 int64 数组，否则返回列表"""
+        if np is None:
+            return [self._sample_conversion_value() for _ in range(n)]
+        cdf = np.asarray(self._cumulative_weights())
+        uniforms = self._conversion_rng.random_array(n) if hasattr(self._conversion_rng, 'random_array') \
+            else np.random.random_sample(n)
+        indices = np.searchsorted(cdf, np.asarray(uniforms) * self._total_weight, side='left')
+        indices[indices >= SKAN_CONVERSION_VALUES] = 31
+        return indices.astype(np.int64)
     
     def update_conversion_distribution(self, conversion_value: int, weight: float = 0.1):
-        """更新历史转化值分布（用于在线学习）"""
-        if conversion_value not in self.historical_conversion_distribution:
+        """
+        更新历史转化值分布（用于在线学习）
+        对整个分布做指数移动平均 p' = (1 - weight) * p + weight * e_v（e_v 为该转化值的独热向量），
+        与 SKANDistributionStore.apply_postbacks 的逐条更新规则相同
+        未归一化权重下等价于只给该转化值加 weight / (1 - weight) * 总和（其余权重不变、总和放大），O(1) 完成
+        """
+        if not 0 <= conversion_value < SKAN_CONVERSION_VALUES:
             return
         
-        # 指数移动平均更新
-        old_prob = self.historical_conversion_distribution[conversion_value]
-        new_prob = old_prob * (1 - weight) + weight
-        self.historical_conversion_distribution[conversion_value] = new_prob
+        self._cdf = None
+        if weight >= 1.0:
+            # 权重为 1 时分布直接变为该转化值
+            self._weights = [0.0] * SKAN_CONVERSION_VALUES
+            self._weights[conversion_value] = 1.0
+            self._total_weight = 1.0
+            return
         
-        # 归一化
-        total = sum(self.historical_conversion_distribution.values())
-        for key in self.historical_conversion_distribution:
-            self.historical_conversion_distribution[key] /= total
+        # 指数移动平均更新
+        delta = weight / (1.0 - weight) * self._total_weight
+        self._weights[conversion_value] += delta
+        self._total_weight += delta
+        
+        # 权重总和持续增长，超过阈值时整体缩放回概率尺度（不改变分布）
+        if self._total_weight > _SKAN_RESCALE_THRESHOLD:
+            total = self._total_weight
+            self._weights = [w / total for w in self._weights]
+            self._total_weight = sum(self._weights)
+    
+    def apply_postbacks(self, campaign_ids: List[str], conversion_values: List[int], weight: float = 0.1):
+        """
+        批量应用 SKAN postback：按活动维护分布时一次矩阵更新，否则逐条更新全局分布
+        """
+        if self.distribution_store is not None:
+            self.distribution_store.apply_postbacks(campaign_ids, conversion_values, weight)
+            return
+        for conversion_value in conversion_values:
+            self.update_conversion_distribution(conversion_value, weight)
+
+
+class SKANPostbackScheduler:
+    """
+    SKAN postback 调度器
+    中标时按 postback 延迟把 (活动, 转化值) 放入分层时间轮，每次 poll 把已到期的 postback
+    批量送入 SKANOptimizer.apply_postbacks，形成 出价 -> postback -> 分布更新 的反馈闭环
+    注入 SimulatedClock 时，多日的 SKAN 反馈可以在数秒内模拟完成
+    """
+    
+    def __init__(self, skan_optimizer: SKANOptimizer, clock=None, tick_seconds: float = 1.0,
+                 weight: float = 0.1):
+        """
+        - clock: 时钟（SystemClock / SimulatedClock），默认系统时钟
+        - tick_seconds: 时间轮精度
+        - weight: 每个 postback 的 EMA 权重
+        """
+        self.skan_optimizer = skan_optimizer
+        self.clock = clock if clock is not None else SystemClock()
+        self.weight = weight
+        self.wheel = HierarchicalTimingWheel(tick_seconds, clock=self.clock)
+        # 监控计数：已调度、已送达、送达批次数
+        self.scheduled_count = 0
+        self.delivered_count = 0
+        self.batch_count = 0
+    
+    def schedule(self, delay_seconds: float, campaign_id: str, conversion_value: int):
+        """登记一个将在 delay_seconds 秒后到达的 postback"""
+        self.wheel.schedule(delay_seconds, (campaign_id, conversion_value))
+        self.scheduled_count += 1
+    
+    def poll(self) -> int:
+        """送达所有已到期的 postback，返回本次送达数"""
+        expired = self.wheel.advance()
+        if not expired:
+            return 0
+        campaign_ids = [campaign_id for campaign_id, _ in expired]
+        conversion_values = [conversion_value for _, conversion_value in expired]
+        self.skan_optimizer.apply_postbacks(campaign_ids, conversion_values, self.weight)
+        self.delivered_count += len(expired)
+        self.batch_count += 1
+        return len(expired)
+    
+    def __len__(self) -> int:
+        return len(self.wheel)
+    
+    def stats(self) -> Dict:
+        return {
+            'scheduled': self.scheduled_count,
+            'delivered': self.delivered_count,
+            'batches': self.batch_count,
+            'pending': len(self.wheel),
+        }
 
 
 class SSP:
     """SSP (Supply-Side Platform) - 流量发起方"""
     
-    def __init__(self, logger: WhiteboxLogger):
+    def __init__(self, logger: WhiteboxLogger, rng=None):
+        """- rng: 随机数源（EngineRandom），默认使用 random 模块"""
         self.logger = logger
+        rng = rng if rng is not None else GLOBAL_RANDOM
+        self._latency_rng = rng.stream('ssp.latency')
+        self._postback_rng = rng.stream('ssp.postback')
     
     def generate_request(self, request_id: str, device_id: str, app_id: str, 
-                        app_name: str, platform: str, ad_size: tuple) -> Dict:
+                        app_name: str, platform: str, ad_size: tuple) -> AdRequest:
         """生成广告请求"""
         # 生成处理延迟 (latency_ms): 50ms - 150ms
-        latency_ms = random.uniform(50, 150)
+        latency_ms = self._latency_rng.uniform(50, 150)
         
         # 为 iOS 流量生成 postback 延迟（24h - 48h）
         postback_delay_hours = None
-        postback_delay_seconds = None
         if platform.upper() == 'IOS':
-            postback_delay_hours = random.uniform(24, 48)
-            postback_delay_seconds = postback_delay_hours * 3600
+            postback_delay_hours = self._postback_rng.uniform(24, 48)
+        postback_delay_seconds = postback_delay_hours * 3600 if postback_delay_hours is not None else None
         
-        ad_request = {
-            'request_id': request_id,
-            'device_id': device_id,
-            'app_id': app_id,
-            'app_name': app_name,
-            'platform': platform,
-            'ad_size': ad_size,
-            'latency_ms': latency_ms,  # 处理延迟
-            'postback_delay_hours': postback_delay_hours,  # SKAN postback 延迟（仅 iOS）
-            'postback_delay_seconds': postback_delay_seconds,  # SKAN postback 延迟（秒）
-            'timestamp': datetime.now().isoformat()
-        }
+        ad_request = AdRequest(
+            request_id=request_id,
+            device_id=device_id,
+            app_id=app_id,
+            app_name=app_name,
+            platform=platform,
+            ad_size=ad_size,
+            latency_ms=latency_ms,  # 处理延迟
+            postback_delay_hours=postback_delay_hours,  # SKAN postback 延迟（仅 iOS）
+            postback_delay_seconds=postback_delay_seconds,  # SKAN postback 延迟（秒）
+            timestamp=self.logger.request_time().iso
+        )
         
-        reasoning = f"SSP 生成广告请求：设备 {device_id}，应用 {app_name} ({app_id})，平台 {platform}，尺寸 {ad_size}，处理延迟 {latency_ms:.1f}ms"
-        if postback_delay_hours:
-            reasoning += f"，SKAN postback 延迟 {postback_delay_hours:.1f} 小时"
+        def reasoning() -> str:
+            text = f"SSP 生成广告请求：设备 {device_id}，应用 {app_name} ({app_id})，平台 {platform}，尺寸 {ad_size}，处理延迟 {latency_ms:.1f}ms"
+            if postback_delay_hours:
+                text += f"，SKAN postback 延迟 {postback_delay_hours:.1f} 小时"
+            return text
         
         self.logger.log_decision(
             request_id=request_id,
@@ -666,7 +1531,7 @@ class SSP:
             action="REQUEST_GENERATED",
             decision="PASS",
             reason_code="REQUEST_CREATED",
-            internal_variables=ad_request.copy(),
+            internal_variables=ad_request,  # 请求不可修改，直接引用，序列化时展开
             reasoning=reasoning,
             latency_ms=latency_ms
         )
@@ -674,86 +1539,177 @@ class SSP:
         return ad_request
 
 
+class TopKBids:
+    """
+    流式保留 eCPM 最高的 k 个出价：出价逐个到达，O(log k) 插入，内存与出价总数无关
+    排名与按 eCPM 稳定降序排序一致（eCPM 相同时先到达的在前）；
+    k 为 None 时保留全部出价（内存 O(n)，ranked 排序 O(n log n)），只用于显式要求完整出价列表的场景
+    """
+    
+    def __init__(self, k: Optional[int] = 2):
+        self.k = k
+        # 最小堆：(eCPM, -到达序号, 出价)，堆顶为当前保留出价中排名最低者；到达序号唯一，不会比较到出价字典
+        self._heap: List[Tuple[float, int, Dict]] = []
+        self.count = 0
+    
+    def push(self, ecpm: float, bid: Dict):
+        entry = (ecpm, -self.count, bid)
+        self.count += 1
+        if self.k is None or len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif (ecpm, entry[1]) > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+    
+    def ranked(self) -> List[Dict]:
+        """按排名返回保留的出价"""
+        return [bid for _, _, bid in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
+
+
 class ADX:
     """ADX (Ad Exchange) - 广告交易平台"""
     
-    def __init__(self, logger: WhiteboxLogger, filters: List[FilterRule] = None, quality_scorer: Optional[QualityScorer] = None, skan_optimizer: Optional[SKANOptimizer] = None):
+    def __init__(self, logger: WhiteboxLogger, filters: List[FilterRule] = None, quality_scorer: Optional[QualityScorer] = None, skan_optimizer: Optional[SKANOptimizer] = None,
+                 trace_top_n: Optional[int] = 10, filter_order: Optional[AdaptiveFilterOrder] = None):
+        """
+        - trace_top_n: 竞价结果、AUCTION_RESULT 追踪与 run_auction 返回值中 all_bids 保留的最高 eCPM 出价数；
+          默认 10，0 为不记录；None 为显式要求保留全部出价（按 eCPM 降序，内存 O(n)、排序 O(n log n)）。
+          获胜者与二价计费固定由前 2 名决定，与 trace_top_n 无关
+        - filter_order: 自适应过滤顺序（AdaptiveFilterOrder），按实测耗时与拒绝率重排独立规则，
+          所用顺序记录在 FINAL_DECISION 追踪的 filter_order 中；为空时按添加顺序执行，
+          并使用预编译过滤链（CompiledFilterChain）
+        """
         self.logger = logger
         self.filters = filters or []
         self.quality_scorer = quality_scorer
         self.skan_optimizer = skan_optimizer
+        self.trace_top_n = trace_top_n
+        self.filter_order = filter_order
+        # (阶段, 规则数) -> 预编译过滤链；add_filter 时清空
+        self._compiled_chains: Dict[Tuple[Optional[str], int], CompiledFilterChain] = {}
     
     def add_filter(self, filter_rule: FilterRule):
         """添加过滤规则"""
         self.filters.append(filter_rule)
+        self._compiled_chains.clear()
     
-    def process_request(self, ad_request: Dict) -> Tuple[bool, str]:
-        """处理广告请求，应用所有过滤规则"""
+    def _compiled_chain(self, stage: Optional[str]) -> CompiledFilterChain:
+        """该阶段的预编译过滤链（按规则数缓存，直接修改 filters 列表追加规则时也会重新编译）"""
+        key = (stage, len(self.filters))
+        chain = self._compiled_chains.get(key)
+        if chain is None:
+            filters = self.filters if stage is None else [f for f in self.filters if f.stage == stage]
+            chain = self._compiled_chains[key] = CompiledFilterChain(filters)
+        return chain
+    
+    def process_request(self, ad_request: Dict, stage: Optional[str] = None) -> Tuple[bool, str]:
+        """
+        处理广告请求，应用过滤规则
+        - stage: 只应用该阶段（FILTER_STAGE_PRE_BID / FILTER_STAGE_POST_BID）的规则，None 为全部规则；
+          请求接收追踪在第一个阶段记录，最终通过（FINAL_DECISION PASS）在最后一个阶段记录
+        """
         request_id = ad_request.get('request_id', 'unknown')
+        filter_order = self.filter_order
+        if filter_order is not None:
+            filters = self.filters if stage is None else [f for f in self.filters if f.stage == stage]
+            filters = filter_order.order(stage or 'all', filters)
+            chain = None
+        else:
+            chain = self._compiled_chain(stage)
+            filters = chain.filters
         
-        self.logger.log_decision(
-            request_id=request_id,
-            node="ADX",
-            action="REQUEST_RECEIVED",
-            decision="PASS",
-            reason_code="REQUEST_ACCEPTED",
-            internal_variables=ad_request.copy(),
-            reasoning=f"ADX 接收到来自 SSP 的广告请求"
-        )
+        if stage != FILTER_STAGE_POST_BID and self.logger.is_enabled("REQUEST_RECEIVED", "PASS"):
+            self.logger.log_decision(
+                request_id=request_id,
+                node="ADX",
+                action="REQUEST_RECEIVED",
+                decision="PASS",
+                reason_code="REQUEST_ACCEPTED",
+                internal_variables=ad_request if isinstance(ad_request, AdRequest) else ad_request.copy(),
+                reasoning=f"ADX 接收到来自 SSP 的广告请求"
+            )
         
-        # 依次应用所有过滤规则
-        for filter_rule in self.filters:
-            passed, reason_code, internal_vars = filter_rule.apply(request_id, ad_request)
-            if not passed:
+        # 依次应用所有过滤规则，遇到第一个拒绝即停止
+        if chain is not None:
+            rejected = chain.run(request_id, ad_request)
+        else:
+            rejected = None
+            for filter_rule in filters:
+                passed, reason_code, internal_vars = filter_order.evaluate(filter_rule, request_id, ad_request)
+                if not passed:
+                    rejected = filter_rule, reason_code, internal_vars
+                    break
+        if rejected is not None:
+            filter_rule, reason_code, internal_vars = rejected
+            # 记录请求在哪个阶段被拒绝（竞价前拒绝的请求没有产生 DSP 开销）
+            reject_vars = dict(internal_vars, filter_stage=filter_rule.stage)
+            if filter_order is not None:
+                reject_vars['filter_order'] = [f.name for f in filters]
+            self.logger.log_decision(
+                request_id=request_id,
+                node="ADX",
+                action="FINAL_DECISION",
+                decision="REJECT",
+                reason_code=reason_code,
+                internal_variables=reject_vars,
+                reasoning=lambda: f"请求被 {filter_rule.name} 拒绝（{filter_rule.stage}），原因：{reason_code}"
+            )
+            return False, reason_code
+        
+        if stage == FILTER_STAGE_PRE_BID:
+            # 竞价前规则全部通过，等待出价后执行竞价后规则
+            if self.logger.is_enabled("FILTER_STAGE", "PASS"):
+                stage_vars = {'filter_stage': stage, 'filters_count': len(filters)}
+                if filter_order is not None:
+                    stage_vars['filter_order'] = [f.name for f in filters]
                 self.logger.log_decision(
                     request_id=request_id,
                     node="ADX",
-                    action="FINAL_DECISION",
-                    decision="REJECT",
-                    reason_code=reason_code,
-                    internal_variables=internal_vars,
-                    reasoning=f"请求被 {filter_rule.name} 拒绝，原因：{reason_code}"
+                    action="FILTER_STAGE",
+                    decision="PASS",
+                    reason_code="PRE_BID_FILTERS_PASSED",
+                    internal_variables=stage_vars,
+                    reasoning="{filters_count} 个竞价前过滤规则均通过，向 DSP 发起出价请求",
+                    reasoning_args=stage_vars
                 )
-                return False, reason_code
+            return True, "PRE_BID_FILTERS_PASSED"
         
         # 所有过滤通过
-        self.logger.log_decision(
-            request_id=request_id,
-            node="ADX",
-            action="FINAL_DECISION",
-            decision="PASS",
-            reason_code="ALL_FILTERS_PASSED",
-            internal_variables={'filters_count': len(self.filters)},
-            reasoning=f"所有 {len(self.filters)} 个过滤规则均通过，请求被接受"
-        )
+        if self.logger.is_enabled("FINAL_DECISION", "PASS"):
+            pass_vars = {'filters_count': len(self.filters)}
+            if filter_order is not None:
+                pass_vars['filter_order'] = [f.name for f in filters]
+            self.logger.log_decision(
+                request_id=request_id,
+                node="ADX",
+                action="FINAL_DECISION",
+                decision="PASS",
+                reason_code="ALL_FILTERS_PASSED",
+                internal_variables=pass_vars,
+                reasoning="所有 {filters_count} 个过滤规则均通过，请求被接受",
+                reasoning_args=pass_vars
+            )
         
         return True, "ALL_FILTERS_PASSED"
     
-    def run_auction(self, bids: List[Dict], request_id: str, ad_request: Optional[Dict] = None) -> Optional[Dict]:
+    def run_auction(self, bids: Iterable[Dict], request_id: str, ad_request: Optional[Dict] = None) -> Optional[Dict]:
         """
         运行竞价，实现 eCPM 排序和二价计费（Second Price Auction）
         调整后的 eCPM = bid_price * pCTR * pCVR * q_factor * 1000
+        出价逐个到达时单遍计算 eCPM，用固定 k=2 的 TopKBids 选出获胜者与第二名（内存与出价数无关）；
+        trace_top_n 大于 2 时另用 k=trace_top_n 的 TopKBids 保留 all_bids，为 None 时才保留并排序全部出价
         返回: 获胜者信息，包含实际支付价格（二价计费）
         """
-        if not bids or len(bids) == 0:
-            return None
-        
-        # 计算每个出价的调整后 eCPM（引入质量系数 q_factor）
+        top = TopKBids(2)
+        # all_bids 不超过前 2 名时直接取 top 的排名，无需另外保留
+        trace_top_n = self.trace_top_n
+        traced = TopKBids(trace_top_n) if trace_top_n is None or trace_top_n > 2 else None
         for bid in bids:
+            self._score_bid(bid, request_id, ad_request)
+            
             bid_price = bid.get('bid_price', 0)
             pctr = bid.get('pctr', 0.001)
             pcvr = bid.get('pcvr', 0.01)
-            
-            # 获取质量系数 q_factor（如果启用了质量评分）
             q_factor = bid.get('q_factor', 1.0)
-            if self.quality_scorer and ad_request:
-                # 如果出价中没有 q_factor，则进行质量评分
-                if 'q_factor' not in bid:
-                    q_factor, quality_details = self.quality_scorer.score(request_id, ad_request)
-                    bid['q_factor'] = q_factor
-                    bid['quality_details'] = quality_details
-                else:
-                    q_factor = bid['q_factor']
             
             # 调整后的 eCPM 公式：Adjusted_eCPM = Bid × pCTR × pCVR × q_factor × 1000
             adjusted_ecpm = bid_price * pctr * pcvr * q_factor * 1000
@@ -764,26 +1720,26 @@ class ADX:
             bid['q_factor'] = q_factor
             bid['pctr'] = pctr
             bid['pcvr'] = pcvr
+            top.push(adjusted_ecpm, bid)
+            if traced is not None:
+                traced.push(adjusted_ecpm, bid)
         
-        # 按 eCPM 排序（降序）
-        sorted_bids = sorted(bids, key=lambda x: x.get('ecpm', 0), reverse=True)
-        
-        if len(sorted_bids) == 0:
+        if top.count == 0:
             return None
         
-        winner = sorted_bids[0]
-        winner_bid = winner.get('bid_price', 0)
+        # 按 eCPM 降序的前 2 名
+        ranked_bids = top.ranked()
+        winner = ranked_bids[0]
         winner_pctr = winner.get('pctr', 0.001)
         winner_pcvr = winner.get('pcvr', 0.01)
-        winner_ecpm = winner.get('ecpm', 0)
         
         # 二价计费（GSP）：计算实际支付价格
-        if len(sorted_bids) > 1:
+        if len(ranked_bids) > 1:
             # 有多个出价者，使用第二高的 eCPM 计算实际支付价格
-            second_highest_ecpm = sorted_bids[1].get('ecpm', 0)
+            second_highest_ecpm = ranked_bids[1].get('ecpm', 0)
             # 公式：Actual_Paid_Price = (Second_Highest_eCPM + 0.01) / (1000 × Winner_pCTR × Winner_pCVR)
             actual_paid_price = (second_highest_ecpm + 0.01) / (1000 * winner_pctr * winner_pcvr)
-            second_best_bid = sorted_bids[1].get('bid_price', 0)
+            second_best_bid = ranked_bids[1].get('bid_price', 0)
         else:
             # 只有一个出价，按底价成交
             floor_price = winner.get('floor_price', 0.1)
@@ -791,33 +1747,82 @@ class ADX:
             second_best_bid = floor_price
             second_highest_ecpm = 0
         
+        traced_bids = traced.ranked() if traced is not None else ranked_bids[:trace_top_n]
+        return self._auction_result(ranked_bids, traced_bids, second_best_bid, second_highest_ecpm, actual_paid_price)
+    
+    def _score_bid(self, bid: Dict, request_id: str, ad_request: Optional[Dict]):
+        if self.quality_scorer and ad_request and 'q_factor' not in bid:
+            q_factor, quality_details = self.quality_scorer.score(request_id, ad_request)
+            bid['q_factor'] = q_factor
+            bid['quality_details'] = quality_details
+    
+    def _auction_result(self, ranked_bids: List[Dict], traced_bids: List[Dict], second_best_bid: float, second_highest_ecpm: float,
+                        actual_paid_price: float) -> Dict:
+        """
+        由按 eCPM 降序的前 2 名出价与二价计费结果构建竞价结果
+        all_bids 为按 eCPM 降序的前 trace_top_n 名（traced_bids；trace_top_n 为 0 时不包含该字段）
+        """
+        winner = ranked_bids[0]
+        winner_bid = winner.get('bid_price', 0)
+        winner_ecpm = winner.get('ecpm', 0)
+        
         # 确保实际支付价格不超过出价
         actual_paid_price = min(actual_paid_price, winner_bid)
         
         # 计算节省的金额
         saved_amount = winner_bid - actual_paid_price
         
-        return {
+        result = {
             'winner': winner,
             'winner_bid': winner_bid,  # 原始出价
             'winner_ecpm': winner_ecpm,
-            'winner_pctr': winner_pctr,
-            'winner_pcvr': winner_pcvr,
+            'winner_pctr': winner.get('pctr', 0.001),
+            'winner_pcvr': winner.get('pcvr', 0.01),
             'second_best_bid': second_best_bid,  # 第二名出价
-            'second_highest_ecpm': second_highest_ecpm if len(sorted_bids) > 1 else 0,  # 第二名 eCPM
+            'second_highest_ecpm': second_highest_ecpm,  # 第二名 eCPM
             'actual_paid_price': actual_paid_price,  # 实际支付价格（二价计费）
             'saved_amount': saved_amount,  # 节省金额 = Winner_Bid_Price - Actual_Paid_Price
-            'all_bids': sorted_bids,  # 包含所有出价信息（用于 AI 诊断）
             'original_ecpm': winner.get('original_ecpm', winner_ecpm)  # 原始 eCPM（未调整质量系数）
         }
+        if self.trace_top_n != 0:
+            # eCPM 最高的出价信息（用于 AI 诊断）
+            result['all_bids'] = traced_bids
+        return result
 
 
 class DSP:
     """DSP (Demand-Side Platform) - 需求方平台"""
     
-    def __init__(self, logger: WhiteboxLogger, bidding_strategy: BiddingStrategy):
+    def __init__(self, logger: WhiteboxLogger, bidding_strategy: BiddingStrategy, rng=None,
+                 response_latency_ms: Optional[Tuple[float, float]] = None, dsp_id: Optional[str] = None):
+        """
+        - rng: 随机数源（EngineRandom），默认使用 random 模块
+        - response_latency_ms: 异步出价（bid_async）时模拟的网络响应时间范围 (最小, 最大)，为空时立即返回
+        - dsp_id: 注册表中的 DSP ID；设置时使用该 DSP 独立的随机流（dsp.<dsp_id>.pctr 等），
+          为空时使用共用的 dsp.pctr 等随机流
+        """
         self.logger = logger
         self.bidding_strategy = bidding_strategy
+        self.response_latency_ms = response_latency_ms
+        self.dsp_id = dsp_id
+        rng = rng if rng is not None else GLOBAL_RANDOM
+        prefix = f'dsp.{dsp_id}' if dsp_id else 'dsp'
+        self._pctr_rng = rng.stream(f'{prefix}.pctr')
+        self._pcvr_rng = rng.stream(f'{prefix}.pcvr')
+        self._response_rng = rng.stream(f'{prefix}.response')
+    
+    async def bid_async(self, ad_request: Dict, skan_optimizer: Optional[SKANOptimizer] = None) -> Optional[Dict]:
+        """
+        异步出价：出价在协程开始时同步算出（随机数按 DSP 顺序抽取，与同步路径一致），
+        再等待模拟的网络响应时间后返回；接入真实 DSP 时在此处 await 网络请求
+        只有等待响应的 I/O 时间是并发的：出价计算本身是 CPU 密集的同步代码，在事件循环线程上按 DSP 顺序执行，
+        不放入线程池（日志请求缓存与随机流都不是线程安全的）
+        """
+        bid_request = self.bid(ad_request, skan_optimizer)
+        if self.response_latency_ms is not None:
+            low, high = self.response_latency_ms
+            await asyncio.sleep(self._response_rng.uniform(low, high) / 1000)
+        return bid_request
     
     def bid(self, ad_request: Dict, skan_optimizer: Optional[SKANOptimizer] = None) -> Optional[Dict]:
         """对广告请求进行出价"""
@@ -825,7 +1830,7 @@ class DSP:
         platform = ad_request.get('platform', '').upper()
         
         # 为每个 DSP 出价生成 pCTR (0.1% - 5%)
-        pctr = random.uniform(0.001, 0.05)  # 0.1% - 5%
+        pctr = self._pctr_rng.uniform(0.001, 0.05)  # 0.1% - 5%
         
         # pCVR 生成：如果是 iOS 流量且启用了 SKAN 优化，使用 SKAN 概率模型
         pcvr = None
@@ -834,13 +1839,17 @@ class DSP:
             pcvr, skan_details = skan_optimizer.estimate_pcvr_from_skan(request_id, ad_request)
             if pcvr is None:
                 # 如果 SKAN 优化失败，回退到默认值
-                pcvr = random.uniform(0.01, 0.10)
+                pcvr = self._pcvr_rng.uniform(0.01, 0.10)
         else:
             # 非 iOS 流量或未启用 SKAN，使用默认随机值
-            pcvr = random.uniform(0.01, 0.10)   # 1% - 10%
+            pcvr = self._pcvr_rng.uniform(0.01, 0.10)   # 1% - 10%
         
         ad_request['pctr'] = pctr
         ad_request['pcvr'] = pcvr
+        if skan_details:
+            # 中标后由引擎按 postback 延迟调度该转化值的回传
+            ad_request['skan_conversion_value'] = skan_details.get('conversion_value')
+            ad_request['postback_delay_seconds'] = skan_details.get('postback_delay_seconds')
         
         # 将 pCTR 转换为 CTR 得分（归一化到 0-1）
         # pCTR 范围是 0.1%-5%，转换为 0.02-1.0 的得分
@@ -848,7 +1857,7 @@ class DSP:
         
         # 根据平台和时段进行微调
         platform = ad_request.get('platform', '').upper()
-        hour = datetime.now().hour
+        hour = self.logger.request_time().hour
         
         if platform == 'IOS':
             ctr_score *= 1.1
@@ -863,43 +1872,47 @@ class DSP:
         
         ad_request['ctr_score'] = ctr_score
         
-        # 构建内部变量（包含 SKAN 信息）
-        internal_vars = {
-            'ctr_score': ctr_score,
-            'pctr': pctr,
-            'pcvr': pcvr,
-            'platform': platform,
-            'hour': hour
-        }
+        # 构建内部变量（包含 SKAN 信息）；当前日志级别不记录该决策点时跳过
+        if self.logger.is_enabled("CTR_ESTIMATION", "PASS"):
+            internal_vars = {
+                'dsp_id': ad_request.get('dsp_id'),
+                'ctr_score': ctr_score,
+                'pctr': pctr,
+                'pcvr': pcvr,
+                'platform': platform,
+                'hour': hour
+            }
         
-        # 如果使用了 SKAN 优化，添加 SKAN 详情
-        if skan_details:
-            internal_vars.update({
-                'skan_optimized': True,
-                'conversion_value': skan_details.get('conversion_value'),
-                'skan_confidence': skan_details.get('confidence'),
-                'postback_delay_hours': skan_details.get('postback_delay_hours')
-            })
-            reasoning = f"DSP 估算：pCTR {pctr*100:.2f}%，pCVR {pcvr*100:.2f}%（SKAN 概率优化，信心度 {skan_details.get('confidence', 0)*100:.1f}%），CTR得分 {ctr_score:.4f}（平台：{platform}，时段：{hour}点）"
-        else:
-            reasoning = f"DSP 估算：pCTR {pctr*100:.2f}%，pCVR {pcvr*100:.2f}%，CTR得分 {ctr_score:.4f}（平台：{platform}，时段：{hour}点）"
+            # 如果使用了 SKAN 优化，添加 SKAN 详情
+            if skan_details:
+                internal_vars.update({
+                    'skan_optimized': True,
+                    'conversion_value': skan_details.get('conversion_value'),
+                    'skan_confidence': skan_details.get('confidence'),
+                    'postback_delay_hours': skan_details.get('postback_delay_hours')
+                })
+                reasoning = "DSP 估算：pCTR {pctr:.2%}，pCVR {pcvr:.2%}（SKAN 概率优化，信心度 {skan_confidence:.1%}），CTR得分 {ctr_score:.4f}（平台：{platform}，时段：{hour}点）"
+            else:
+                reasoning = "DSP 估算：pCTR {pctr:.2%}，pCVR {pcvr:.2%}，CTR得分 {ctr_score:.4f}（平台：{platform}，时段：{hour}点）"
         
-        self.logger.log_decision(
-            request_id=request_id,
-            node="DSP",
-            action="CTR_ESTIMATION",
-            decision="PASS",
-            reason_code="CTR_CALCULATED",
-            internal_variables=internal_vars,
-            reasoning=reasoning,
-            pctr=pctr,
-            pcvr=pcvr
-        )
+            self.logger.log_decision(
+                request_id=request_id,
+                node="DSP",
+                action="CTR_ESTIMATION",
+                decision="PASS",
+                reason_code="CTR_CALCULATED",
+                internal_variables=internal_vars,
+                reasoning=reasoning,
+                reasoning_args=internal_vars,
+                pctr=pctr,
+                pcvr=pcvr
+            )
         
         # 使用出价策略计算出价
         bid_price, internal_vars, reasoning = self.bidding_strategy.calculate_bid(request_id, ad_request)
         ad_request['bid_price'] = bid_price
         
+        dsp_id = ad_request.get('dsp_id')
         self.logger.log_decision(
             request_id=request_id,
             node="DSP",
@@ -907,7 +1920,7 @@ class DSP:
             decision="PASS",
             reason_code="BID_SUBMITTED",
             internal_variables=internal_vars,
-            reasoning=f"DSP 提交出价：{bid_price}。{reasoning}"
+            reasoning=lambda: f"{dsp_id} 提交出价：{bid_price}。{reasoning}"
         )
         
         return ad_request
@@ -916,19 +1929,69 @@ class DSP:
 class AdExchangeEngine:
     """广告交易引擎 - 协调 SSP/ADX/DSP 的完整流程"""
     
-    def __init__(self, log_file: str = "whitebox.log", enable_quality_scoring: bool = True, enable_skan_optimization: bool = True):
-        self.logger = WhiteboxLogger(log_file)
-        self.ssp = SSP(self.logger)
+    def __init__(self, log_file: str = "whitebox.log", enable_quality_scoring: bool = True, enable_skan_optimization: bool = True,
+                 logger_options: Optional[Dict] = None, verbosity: str = VERBOSITY_FULL,
+                 quality_options: Optional[Dict] = None, skan_options: Optional[Dict] = None,
+                 auction_options: Optional[Dict] = None,
+                 simulate_postbacks: bool = False, clock=None,
+                 seed: Optional[int] = None, rng: Optional[EngineRandom] = None,
+                 dsp_registry: Optional[DSPRegistry] = None):
+        """
+        初始化引擎
+        - logger_options: 透传给 WhiteboxLogger 的落盘策略参数（如 flush_every_records）
+        - verbosity: 白盒日志详细程度：full / decisions / rejects
+        - quality_options: 透传给 QualityScorer 的参数（如 feature_provider=SketchFeatureProvider()）
+        - skan_options: 透传给 SKANOptimizer 的参数（如 per_campaign=True）
+        - auction_options: 透传给 ADX 的参数（all_bids 默认只保留 eCPM 前 10 的出价；如 trace_top_n=0 不记录出价列表，
+          trace_top_n=None 保留全部出价（内存随出价数线性增长），
+          filter_order=AdaptiveFilterOrder() 启用自适应过滤顺序）
+        - simulate_postbacks: 中标后调度 SKAN postback，到期后回灌转化值分布（需启用 SKAN 优化）
+        - clock: 引擎时钟（每个请求取一次时间戳，供日志、出价时段、质量特征窗口与 postback 调度使用），
+          传入 SimulatedClock 可回放或快速模拟多日流程
+        - seed / rng: 引擎随机数源；各组件从中取独立的命名随机流，相同 seed 的运行结果可复现
+        - dsp_registry: DSP 注册表（可传入自定义对账参数的 DSPRegistry）；通过 register_dsp 注册 DSP 后
+          按注册表扇出，否则使用 setup_dsp 配置的单个 DSP 与 num_dsps 个合成 ID（DSP_1..N）
+        """
+        self.clock = clock if clock is not None else SystemClock()
+        self.rng = rng if rng is not None else EngineRandom(seed)
+        logger_options = dict(logger_options or {})
+        logger_options.setdefault('verbosity', verbosity)
+        logger_options.setdefault('clock', self.clock)
+        logger_options.setdefault('rng', self.rng)
+        self.logger = WhiteboxLogger(log_file, **logger_options)
+        self.ssp = SSP(self.logger, rng=self.rng)
         # 初始化质量评分器（如果启用）
-        quality_scorer = QualityScorer(self.logger) if enable_quality_scoring else None
+        quality_options = dict(quality_options or {})
+        quality_options.setdefault('rng', self.rng)
+        quality_scorer = QualityScorer(self.logger, **quality_options) if enable_quality_scoring else None
         # 初始化 SKAN 优化器（如果启用）
-        skan_optimizer = SKANOptimizer(self.logger) if enable_skan_optimization else None
-        self.adx = ADX(self.logger, quality_scorer=quality_scorer, skan_optimizer=skan_optimizer)
+        skan_options = dict(skan_options or {})
+        skan_options.setdefault('rng', self.rng)
+        skan_optimizer = SKANOptimizer(self.logger, **skan_options) if enable_skan_optimization else None
+        self.adx = ADX(self.logger, quality_scorer=quality_scorer, skan_optimizer=skan_optimizer,
+                       **(auction_options or {}))
         self.skan_optimizer = skan_optimizer  # 保存引用，供 DSP 使用
+        self.postback_scheduler = SKANPostbackScheduler(skan_optimizer, self.clock) \
+            if simulate_postbacks and skan_optimizer else None
         self.dsp = None  # 将在运行时设置
+        self.dsp_registry = dsp_registry if dsp_registry is not None else DSPRegistry()
+    
+    def flush(self):
+        """将白盒日志缓冲区落盘"""
+        self.logger.flush()
+    
+    def close(self):
+        """落盘并关闭白盒日志"""
+        self.logger.close()
+    
+    def __enter__(self) -> 'AdExchangeEngine':
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
     
     def setup_adx_filters(self, floor_price: float = 0.1, 
-                          blacklist: List[str] = None,
+                          blacklist: Union[List[str], MmapBlacklist] = None,
                           required_size: tuple = (320, 50),
                           max_latency_ms: int = 100):
         """配置 ADX 过滤规则"""
@@ -937,13 +2000,75 @@ class AdExchangeEngine:
         
         self.adx.add_filter(BlacklistFilter(blacklist, self.logger))
         self.adx.add_filter(SizeMatchFilter(required_size, self.logger))
-        self.adx.add_filter(LatencyTimeoutFilter(max_latency_ms, self.logger))
-        self.adx.add_filter(CreativeMismatchFilter(self.logger))
+        self.adx.add_filter(LatencyTimeoutFilter(max_latency_ms, self.logger, rng=self.rng))
+        self.adx.add_filter(CreativeMismatchFilter(self.logger, rng=self.rng))
         # 注意：底价过滤需要在收到出价后才能应用，所以稍后处理
     
-    def setup_dsp(self, base_price: float = 0.5):
-        """配置 DSP 出价策略"""
-        self.dsp = DSP(self.logger, CTRBasedBiddingStrategy(base_price, self.logger))
+    def setup_dsp(self, base_price: float = 0.5, response_latency_ms: Optional[Tuple[float, float]] = None):
+        """
+        配置 DSP 出价策略
+        - response_latency_ms: 异步竞价（run_auction_async）时模拟的 DSP 响应时间范围（毫秒）
+        """
+        self.dsp = DSP(self.logger, CTRBasedBiddingStrategy(base_price, self.logger), rng=self.rng,
+                       response_latency_ms=response_latency_ms)
+    
+    def register_dsp(self, dsp_id: str, bidding_strategy: Optional[BiddingStrategy] = None,
+                     base_price: float = 0.5, budget: Optional[float] = None, qps_limit: Optional[int] = None,
+                     response_latency_ms: Optional[Tuple[float, float]] = None,
+                     pacing_seconds: Optional[float] = None) -> DSPEntry:
+        """
+        向注册表添加一个 DSP（注册后竞价按注册表扇出，忽略 num_dsps）
+        - bidding_strategy: 该 DSP 的出价策略，默认 CTRBasedBiddingStrategy(base_price)
+        - budget: 总预算（按成交的实际支付价格扣减），预算耗尽后在扇出前跳过；为空表示不限
+        - qps_limit: 每秒最多收到的出价请求数（按引擎时钟），为空表示不限
+        - pacing_seconds: 投放时长（按引擎时钟），设置后按时段目标节流，预算在该时长内匀速花完
+        """
+        if bidding_strategy is None:
+            bidding_strategy = CTRBasedBiddingStrategy(base_price, self.logger)
+        dsp = DSP(self.logger, bidding_strategy, rng=self.rng, response_latency_ms=response_latency_ms,
+                  dsp_id=dsp_id)
+        return self.dsp_registry.register(dsp_id, dsp, budget=budget, qps_limit=qps_limit,
+                                          pacing_seconds=pacing_seconds, rng=self.rng)
+    
+    def _select_dsps(self, request_id: str, num_dsps: int) -> List[Tuple[DSP, str]]:
+        """本次请求扇出的 (DSP, DSP ID) 列表；注册表中被跳过的 DSP 记录追踪"""
+        if not len(self.dsp_registry):
+            if self.dsp is None:
+                return []
+            return [(self.dsp, f'DSP_{i+1}') for i in range(num_dsps)]
+        selected, skipped = self.dsp_registry.select(self.logger.request_time().timestamp)
+        for entry, reason_code in skipped:
+            self._log_dsp_skipped(request_id, entry, reason_code)
+        return [(entry.dsp, entry.dsp_id) for entry in selected]
+    
+    def _log_dsp_skipped(self, request_id: str, entry: DSPEntry, reason_code: str):
+        """记录扇出前被跳过的 DSP（预算耗尽、匀速投放节流或达到 QPS 上限）"""
+        if not self.logger.is_enabled("DSP_SELECTION", "REJECT"):
+            return
+        budget = entry.budget
+        skip_vars = {
+            'dsp_id': entry.dsp_id,
+            'budget': budget.total if budget is not None else None,
+            'spent': budget.spent if budget is not None else None,
+            'qps_limit': entry.qps_limit,
+            'pacing_rate': entry.pacer.rate if entry.pacer is not None else None
+        }
+        if reason_code == SKIP_BUDGET_EXHAUSTED:
+            reasoning = "{dsp_id} 预算已耗尽（已花费 {spent:.4f} / 预算 {budget:.4f}），不向其发送出价请求"
+        elif reason_code == SKIP_PACING_THROTTLED:
+            reasoning = "{dsp_id} 匀速投放节流（参与概率 {pacing_rate:.3f}，已花费 {spent:.4f} / 预算 {budget:.4f}），不向其发送出价请求"
+        else:
+            reasoning = "{dsp_id} 本秒出价请求已达 QPS 上限 {qps_limit}，不向其发送出价请求"
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="DSP_SELECTION",
+            decision="REJECT",
+            reason_code=reason_code,
+            internal_variables=skip_vars,
+            reasoning=reasoning,
+            reasoning_args=skip_vars
+        )
     
     def run_auction(self, request_id: str, device_id: str, app_id: str,
                    app_name: str, platform: str, ad_size: tuple, 
@@ -952,44 +2077,200 @@ class AdExchangeEngine:
         运行完整的广告竞价流程（支持多个 DSP）
         返回：处理结果字典
         """
-        TIMEOUT_THRESHOLD = 100  # ms
+        # 请求生命周期：请求开始时取一次时间戳；聚合模式下整条决策链在请求结束时合并写出
+        with request_scope(self.clock, request_id):
+            self.logger.begin_request(request_id)
+            try:
+                return self._run_auction(request_id, device_id, app_id, app_name, platform, ad_size, num_dsps)
+            finally:
+                self.logger.end_request(request_id)
+                if self.postback_scheduler is not None:
+                    self.postback_scheduler.poll()
+    
+    async def run_auction_async(self, request_id: str, device_id: str, app_id: str,
+                                app_name: str, platform: str, ad_size: tuple,
+                                num_dsps: int = 3, tmax_ms: Optional[float] = None) -> Dict:
+        """
+        异步竞价：同时向所有 DSP 发出出价请求（DSP.bid_async），等待响应的时间取决于最慢的 DSP 而不是各 DSP 之和
+        （各 DSP 的出价计算仍在事件循环线程上依次执行，见 DSP.bid_async）
+        - tmax_ms: 等待 DSP 出价的截止时间，默认为 TIMEOUT_THRESHOLD_MS；截止后仍未返回的出价被丢弃，
+          记录为 DSP_BID_TIMEOUT
+        DSP 均按时返回时，结果与日志和同一种子下的 run_auction 相同
+        多个请求可以在同一事件循环中并发执行（请求时间快照按协程隔离）
+        """
+        with request_scope(self.clock, request_id):
+            self.logger.begin_request(request_id)
+            try:
+                return await self._run_auction_async(request_id, device_id, app_id, app_name, platform, ad_size,
+                                                     num_dsps, TIMEOUT_THRESHOLD_MS if tmax_ms is None else tmax_ms)
+            finally:
+                self.logger.end_request(request_id)
+                if self.postback_scheduler is not None:
+                    self.postback_scheduler.poll()
+    
+    async def _run_auction_async(self, request_id: str, device_id: str, app_id: str,
+                                 app_name: str, platform: str, ad_size: tuple,
+                                 num_dsps: int, tmax_ms: float) -> Dict:
+        """单个请求的异步竞价流程主体：与 _run_auction 相同，只是 DSP 出价并发进行并受截止时间约束"""
+        # 1. SSP 生成请求（包含 latency_ms）
+        ad_request = self.ssp.generate_request(
+            request_id, device_id, app_id, app_name, platform, ad_size
+        )
+        
+        # 2. 竞价前过滤，被拒绝的请求不向 DSP 扇出
+        rejection = self._pre_bid_screen(request_id, ad_request)
+        if rejection is not None:
+            return rejection
+        
+        # 3. 同时向所有 DSP 发出出价请求，截止时间内返回的出价按 DSP 顺序收集
+        all_bids = []
+        fanout = self._select_dsps(request_id, num_dsps)
+        if fanout:
+            dsp_requests = [BidRequest(ad_request, dsp_id=dsp_id) for _, dsp_id in fanout]
+            # 截止时间由 asyncio.wait 在事件循环时钟上执行，耗时也按同一时钟计算（SystemClock 下即 clock.monotonic()）
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            tasks = [asyncio.ensure_future(dsp.bid_async(dsp_request, self.skan_optimizer))
+                     for (dsp, _), dsp_request in zip(fanout, dsp_requests)]
+            done, pending = await asyncio.wait(tasks, timeout=tmax_ms / 1000)
+            for task in pending:
+                task.cancel()
+            elapsed_ms = (loop.time() - started) * 1000
+            for dsp_request, task in zip(dsp_requests, tasks):
+                if task in done:
+                    self._collect_bid(all_bids, task.result(), request_id)
+                else:
+                    self._log_bid_timeout(request_id, dsp_request['dsp_id'], tmax_ms, elapsed_ms)
         
+        # 4-6. 延迟、有效出价与竞价后过滤检查
+        rejection = self._screen_request(request_id, ad_request, all_bids)
+        if rejection is not None:
+            return rejection
+        
+        # 7. 运行竞价（调整后的 eCPM 排序 + 二价计费）
+        auction_result = self.adx.run_auction(all_bids, request_id, ad_request)
+        return self._auction_outcome(request_id, ad_request, all_bids, auction_result)
+    
+    def _log_bid_timeout(self, request_id: str, dsp_id: str, tmax_ms: float, elapsed_ms: float):
+        """记录截止时间内未返回而被丢弃的 DSP 出价"""
+        timeout_vars = {
+            'dsp_id': dsp_id,
+            'tmax_ms': tmax_ms,
+            'elapsed_ms': elapsed_ms
+        }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="DSP_RESPONSE",
+            decision="REJECT",
+            reason_code="DSP_BID_TIMEOUT",
+            internal_variables=timeout_vars,
+            reasoning="{dsp_id} 未在截止时间 {tmax_ms:.0f}ms 内返回出价（已等待 {elapsed_ms:.1f}ms），出价被丢弃",
+            reasoning_args=timeout_vars,
+            latency_ms=elapsed_ms
+        )
+    
+    def _run_auction(self, request_id: str, device_id: str, app_id: str,
+                     app_name: str, platform: str, ad_size: tuple,
+                     num_dsps: int) -> Dict:
+        """单个请求的竞价流程主体"""
         # 1. SSP 生成请求（包含 latency_ms）
         ad_request = self.ssp.generate_request(
             request_id, device_id, app_id, app_name, platform, ad_size
         )
         
-        latency_ms = ad_request.get('latency_ms', 0)
+        # 2. 竞价前过滤（黑名单、尺寸等只依赖请求的规则），被拒绝的请求不向 DSP 扇出
+        rejection = self._pre_bid_screen(request_id, ad_request)
+        if rejection is not None:
+            return rejection
         
-        # 2. 多个 DSP 出价（每个 DSP 生成独立的 pCTR 和 pCVR）
+        # 3. 多个 DSP 出价（每个 DSP 生成独立的 pCTR 和 pCVR）
         all_bids = []
-        floor_price = 0.1
         
-        for i in range(num_dsps):
-            # 为每个 DSP 创建独立的请求副本
-            dsp_request = ad_request.copy()
-            dsp_request['dsp_id'] = f'DSP_{i+1}'
-            
-            if self.dsp:
-                # 传递 SKAN 优化器给 DSP（用于 iOS 流量的 pCVR 预估）
-                dsp_request = self.dsp.bid(dsp_request, self.skan_optimizer)
-                bid_price = dsp_request.get('bid_price', 0)
-                pctr = dsp_request.get('pctr', 0.001)
-                pcvr = dsp_request.get('pcvr', 0.01)
-                
-                # 应用底价过滤
-                if bid_price >= floor_price:
-                    all_bids.append({
-                        'dsp_id': f'DSP_{i+1}',
-                        'bid_price': bid_price,
-                        'pctr': pctr,
-                        'pcvr': pcvr,
-                        'floor_price': floor_price,
-                        'request_id': request_id,
-                        'internal_vars': dsp_request.get('internal_variables', {})
-                    })
-        
-        # 3. 延迟过滤检查（在收集出价后进行，以便计算潜在损失）
+        for dsp, dsp_id in self._select_dsps(request_id, num_dsps):
+            # 每个 DSP 一个覆盖层，出价字段写入覆盖层，共享基础请求
+            dsp_request = BidRequest(ad_request, dsp_id=dsp_id)
+            # 传递 SKAN 优化器给 DSP（用于 iOS 流量的 pCVR 预估）
+            dsp_request = dsp.bid(dsp_request, self.skan_optimizer)
+            self._collect_bid(all_bids, dsp_request, request_id)
+        
+        # 4-6. 延迟、有效出价与竞价后过滤检查
+        rejection = self._screen_request(request_id, ad_request, all_bids)
+        if rejection is not None:
+            return rejection
+        
+        # 7. 运行竞价（调整后的 eCPM 排序 + 二价计费）
+        auction_result = self.adx.run_auction(all_bids, request_id, ad_request)
+        return self._auction_outcome(request_id, ad_request, all_bids, auction_result)
+    
+    def _pre_bid_screen(self, request_id: str, ad_request: Dict) -> Optional[Dict]:
+        """竞价前过滤：请求被拒绝时返回结果，否则返回 None"""
+        passed, reason_code = self.adx.process_request(ad_request, FILTER_STAGE_PRE_BID)
+        if passed:
+            return None
+        return {
+            'request_id': request_id,
+            'status': 'REJECTED',
+            'reason': reason_code,
+            'bid_price': 0,
+            'filter_stage': FILTER_STAGE_PRE_BID
+        }
+    
+    @staticmethod
+    def _collect_bid(all_bids: List[Dict], dsp_request: Dict, request_id: str, floor_price: float = 0.1):
+        """收集 DSP 出价（应用底价过滤）"""
+        bid_price = dsp_request.get('bid_price', 0)
+        pctr = dsp_request.get('pctr', 0.001)
+        pcvr = dsp_request.get('pcvr', 0.01)
+        
+        # 应用底价过滤
+        if bid_price >= floor_price:
+            all_bids.append({
+                'dsp_id': dsp_request['dsp_id'],
+                'bid_price': bid_price,
+                'pctr': pctr,
+                'pcvr': pcvr,
+                'floor_price': floor_price,
+                'request_id': request_id,
+                'internal_vars': dsp_request.get('internal_variables', {}),
+                'skan_conversion_value': dsp_request.get('skan_conversion_value'),
+                'postback_delay_seconds': dsp_request.get('postback_delay_seconds')
+            })
+    
+    def _log_bid_summary(self, request_id: str, all_bids: List[Dict]):
+        """
+        记录单请求出价摘要（有效出价数、最高出价及其 DSP / pCTR、平均 pCTR、最高 eCPM）
+        诊断 Agent 按广告主统计出价与胜率时读取该摘要，尾部采样折叠请求时摘要字段保留在 REQUEST_SUMMARY 中
+        """
+        if not all_bids or not self.logger.is_enabled("BID_SUMMARY", "PASS"):
+            return
+        top = max(all_bids, key=lambda bid: bid['bid_price'])
+        bid_summary = {
+            'bid_count': len(all_bids),
+            'max_bid': top['bid_price'],
+            'max_bid_dsp': top['dsp_id'],
+            'max_bid_pctr': top['pctr'],
+            'mean_pctr': sum(bid['pctr'] for bid in all_bids) / len(all_bids),
+            'max_ecpm': max(bid['bid_price'] * bid['pctr'] * bid['pcvr'] * 1000 for bid in all_bids)
+        }
+        self.logger.log_decision(
+            request_id=request_id,
+            node="ADX",
+            action="BID_SUMMARY",
+            decision="PASS",
+            reason_code="BIDS_COLLECTED",
+            internal_variables=bid_summary,
+            reasoning="收到 {bid_count} 个有效出价，最高出价 {max_bid:.4f}（{max_bid_dsp}，pCTR {max_bid_pctr:.2%}）",
+            reasoning_args=bid_summary
+        )
+    
+    def _screen_request(self, request_id: str, ad_request: Dict, all_bids: List[Dict]) -> Optional[Dict]:
+        """出价后检查：延迟超时、无有效出价、竞价后过滤规则；请求被拒绝时返回结果，否则返回 None"""
+        self._log_bid_summary(request_id, all_bids)
+        TIMEOUT_THRESHOLD = TIMEOUT_THRESHOLD_MS  # ms
+        latency_ms = ad_request.get('latency_ms', 0)
+        
+        # 4. 延迟过滤检查（在收集出价后进行，以便计算潜在损失）
         if latency_ms > TIMEOUT_THRESHOLD:
             # 计算潜在最高 eCPM 收入损失
             max_potential_ecpm = 0.0
@@ -998,19 +2279,21 @@ class AdExchangeEngine:
                     ecpm = bid['bid_price'] * bid['pctr'] * bid['pcvr'] * 1000
                     max_potential_ecpm = max(max_potential_ecpm, ecpm)
             
+            timeout_vars = {
+                'latency_ms': latency_ms,
+                'timeout_threshold': TIMEOUT_THRESHOLD,
+                'max_potential_ecpm': max_potential_ecpm,
+                'total_bids': len(all_bids)
+            }
             self.logger.log_decision(
                 request_id=request_id,
                 node="ADX",
                 action="LATENCY_CHECK",
                 decision="REJECT",
                 reason_code="LATENCY_TIMEOUT",
-                internal_variables={
-                    'latency_ms': latency_ms,
-                    'timeout_threshold': TIMEOUT_THRESHOLD,
-                    'max_potential_ecpm': max_potential_ecpm,
-                    'total_bids': len(all_bids)
-                },
-                reasoning=f"响应延迟 {latency_ms:.1f}ms 超过阈值 {TIMEOUT_THRESHOLD}ms，请求超时，潜在最高 eCPM 收入损失：{max_potential_ecpm:.4f}",
+                internal_variables=timeout_vars,
+                reasoning="响应延迟 {latency_ms:.1f}ms 超过阈值 {timeout_threshold}ms，请求超时，潜在最高 eCPM 收入损失：{max_potential_ecpm:.4f}",
+                reasoning_args=timeout_vars,
                 latency_ms=latency_ms
             )
             
@@ -1023,7 +2306,7 @@ class AdExchangeEngine:
                 'max_potential_ecpm': max_potential_ecpm
             }
         
-        # 4. 如果没有有效出价，直接拒绝
+        # 5. 如果没有有效出价，直接拒绝
         if not all_bids:
             return {
                 'request_id': request_id,
@@ -1032,24 +2315,27 @@ class AdExchangeEngine:
                 'bid_price': 0
             }
         
-        # 5. ADX 应用其他过滤规则（使用最高出价进行过滤检查）
+        # 6. ADX 应用竞价后过滤规则（使用最高出价进行过滤检查）
         highest_bid = max(all_bids, key=lambda x: x['bid_price'])
-        test_request = ad_request.copy()
-        test_request['bid_price'] = highest_bid['bid_price']
+        test_request = BidRequest(ad_request, bid_price=highest_bid['bid_price'])
         
-        passed, reason_code = self.adx.process_request(test_request)
+        passed, reason_code = self.adx.process_request(test_request, FILTER_STAGE_POST_BID)
         
         if not passed:
             return {
                 'request_id': request_id,
                 'status': 'REJECTED',
                 'reason': reason_code,
-                'bid_price': highest_bid['bid_price']
+                'bid_price': highest_bid['bid_price'],
+                'filter_stage': FILTER_STAGE_POST_BID
             }
         
-        # 6. 运行竞价（调整后的 eCPM 排序 + 二价计费）
-        auction_result = self.adx.run_auction(all_bids, request_id, ad_request)
-        
+        return None
+    
+    def _auction_outcome(self, request_id: str, ad_request: Dict, all_bids: List[Dict],
+                         auction_result: Optional[Dict]) -> Dict:
+        """记录竞价结果并调度 SKAN postback，返回请求结果"""
+        latency_ms = ad_request.get('latency_ms', 0)
         if auction_result:
             winner = auction_result['winner']
             actual_paid_price = auction_result['actual_paid_price']
@@ -1057,29 +2343,45 @@ class AdExchangeEngine:
             winner_ecpm = auction_result['winner_ecpm']
             second_best_bid = auction_result['second_best_bid']
             
+            # 注册表中的 DSP 按实际支付价格扣减预算
+            if len(self.dsp_registry):
+                self.dsp_registry.record_win(winner['dsp_id'], actual_paid_price)
+            
+            # SKAN：中标的 iOS 出价在 postback 延迟后回传转化值
+            if self.postback_scheduler is not None and winner.get('skan_conversion_value') is not None:
+                self.postback_scheduler.schedule(
+                    winner['postback_delay_seconds'],
+                    self.skan_optimizer.campaign_key(ad_request),
+                    winner['skan_conversion_value']
+                )
+            
             # 记录竞价结果（包含所有新字段）
+            auction_vars = {
+                'winner_bid': auction_result['winner_bid'],
+                'winner_ecpm': winner_ecpm,
+                'winner_pctr': auction_result['winner_pctr'],
+                'winner_pcvr': auction_result['winner_pcvr'],
+                'second_best_bid': second_best_bid,
+                'second_highest_ecpm': auction_result['second_highest_ecpm'],
+                'actual_paid_price': actual_paid_price,
+                'saved_amount': saved_amount,
+                'total_bids': len(all_bids),
+                'latency_ms': latency_ms,
+                'original_ecpm': auction_result.get('original_ecpm', winner_ecpm),  # 原始 eCPM
+                'winner_q_factor': winner.get('q_factor', 1.0),  # 获胜者的质量系数
+                'winner_dsp': winner['dsp_id'],
+            }
+            if 'all_bids' in auction_result:
+                # eCPM 最高的前 N 个出价（用于 AI 诊断），N 见 ADX.trace_top_n
+                auction_vars['all_bids'] = auction_result['all_bids']
             self.logger.log_decision(
                 request_id=request_id,
                 node="ADX",
                 action="AUCTION_RESULT",
                 decision="PASS",
                 reason_code="AUCTION_WON",
-                internal_variables={
-                    'winner_bid': auction_result['winner_bid'],
-                    'winner_ecpm': winner_ecpm,
-                    'winner_pctr': auction_result['winner_pctr'],
-                    'winner_pcvr': auction_result['winner_pcvr'],
-                    'second_best_bid': second_best_bid,
-                    'second_highest_ecpm': auction_result['second_highest_ecpm'],
-                    'actual_paid_price': actual_paid_price,
-                    'saved_amount': saved_amount,
-                    'total_bids': len(all_bids),
-                    'latency_ms': latency_ms,
-                    'original_ecpm': auction_result.get('original_ecpm', winner_ecpm),  # 原始 eCPM
-                    'winner_q_factor': winner.get('q_factor', 1.0),  # 获胜者的质量系数
-                    'all_bids': auction_result.get('all_bids', [])  # 所有出价信息（用于 AI 诊断）
-                },
-                reasoning=f"竞价完成：{winner['dsp_id']} 获胜，eCPM {winner_ecpm:.4f}，原始出价 {auction_result['winner_bid']:.4f}，第二名 eCPM {auction_result['second_highest_ecpm']:.4f}，实际支付 {actual_paid_price:.4f}（GSP 二价计费），节省 {saved_amount:.4f}",
+                internal_variables=auction_vars,
+                reasoning=lambda: f"竞价完成：{winner['dsp_id']} 获胜，eCPM {winner_ecpm:.4f}，原始出价 {auction_result['winner_bid']:.4f}，第二名 eCPM {auction_result['second_highest_ecpm']:.4f}，实际支付 {actual_paid_price:.4f}（GSP 二价计费），节省 {saved_amount:.4f}",
                 pctr=auction_result['winner_pctr'],
                 pcvr=auction_result['winner_pcvr'],
                 ecpm=winner_ecpm,
@@ -1101,7 +2403,8 @@ class AdExchangeEngine:
                 'pctr': auction_result['winner_pctr'],
                 'pcvr': auction_result['winner_pcvr'],
                 'latency_ms': latency_ms,
-                'all_bids': all_bids
+                # 与 AUCTION_RESULT 追踪相同：按 eCPM 降序，最多 trace_top_n 个
+                'all_bids': auction_result.get('all_bids', [])
             }
         else:
             return {
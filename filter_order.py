@@ -0,0 +1,128 @@
+"""
+自适应过滤规则顺序
+按实测的平均耗时与拒绝概率周期性地重排过滤链：互相独立的规则按 耗时 / 拒绝概率 升序执行
+（便宜且拒绝率高的先执行），使每个请求平均执行的规则数与耗时最少
+- 只有每条规则的样本数都达到 min_samples 时才重排
+- 新顺序的预期耗时至少降低 min_improvement 才切换，避免统计波动导致顺序来回抖动
+- 声明 independent = False 的规则固定在原位置，只在它们分隔出的区段内重排
+"""
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+class FilterStats:
+    """单条规则的计数：执行次数、拒绝次数、累计耗时（秒）"""
+    __slots__ = ('evaluations', 'rejections', 'cost_seconds')
+
+    def __init__(self):
+        self.evaluations = 0
+        self.rejections = 0
+        self.cost_seconds = 0.0
+
+    @property
+    def mean_cost(self) -> float:
+        return self.cost_seconds / self.evaluations if self.evaluations else 0.0
+
+    @property
+    def reject_rate(self) -> float:
+        return self.rejections / self.evaluations if self.evaluations else 0.0
+
+
+def expected_cost(order: Sequence, stats: Dict[object, FilterStats]) -> float:
+    """按各规则独立拒绝的假设估计一次过滤链的预期耗时：Σ cost_i × Π_{j<i} (1 - p_j)"""
+    total = 0.0
+    reach = 1.0
+    for rule in order:
+        s = stats[rule]
+        total += reach * s.mean_cost
+        reach *= 1.0 - s.reject_rate
+    return total
+
+
+class AdaptiveFilterOrder:
+    """
+    过滤链顺序管理器（ADX 的 filter_order 参数）
+    每个阶段（竞价前 / 竞价后）的过滤链单独维护顺序；每执行 reorder_interval 次过滤链检查一次是否需要重排
+    """
+
+    def __init__(self, reorder_interval: int = 1000, min_samples: int = 100, min_improvement: float = 0.05,
+                 timer: Callable[[], float] = time.perf_counter):
+        self.reorder_interval = max(1, reorder_interval)
+        self.min_samples = min_samples
+        self.min_improvement = min_improvement
+        self._timer = timer
+        self._stats: Dict[object, FilterStats] = {}
+        # 阶段 -> 当前顺序
+        self._orders: Dict[str, List] = {}
+        self._runs = 0
+        # 监控计数：检查次数、实际重排次数
+        self.checks = 0
+        self.reorders = 0
+
+    def order(self, stage: str, filters: Sequence) -> List:
+        """该阶段本次执行使用的规则顺序（规则集合变化时回到给定顺序）"""
+        current = self._orders.get(stage)
+        if current is None or len(current) != len(filters) or set(map(id, current)) != set(map(id, filters)):
+            current = list(filters)
+            self._orders[stage] = current
+        self._runs += 1
+        if self._runs % self.reorder_interval == 0:
+            self._reorder_all()
+            current = self._orders[stage]
+        return current
+
+    def evaluate(self, filter_rule, request_id: str, ad_request: Dict) -> Tuple[bool, str, Dict]:
+        """执行规则并记录耗时与是否拒绝"""
+        started = self._timer()
+        passed, reason_code, internal_vars = filter_rule.apply(request_id, ad_request)
+        elapsed = self._timer() - started
+        s = self._stats.get(filter_rule)
+        if s is None:
+            s = self._stats[filter_rule] = FilterStats()
+        s.evaluations += 1
+        s.cost_seconds += elapsed
+        if not passed:
+            s.rejections += 1
+        return passed, reason_code, internal_vars
+
+    def _reorder_all(self):
+        for stage, current in self._orders.items():
+            self.checks += 1
+            candidate = self._candidate(current)
+            if candidate is None or candidate == current:
+                continue
+            if expected_cost(candidate, self._stats) < expected_cost(current, self._stats) * (1 - self.min_improvement):
+                self._orders[stage] = candidate
+                self.reorders += 1
+
+    def _candidate(self, current: List):
+        """按 耗时 / 拒绝概率 排序各区段内的独立规则；有规则样本不足时返回 None"""
+        if any(rule not in self._stats or self._stats[rule].evaluations < self.min_samples for rule in current):
+            return None
+
+        def rank(rule) -> float:
+            s = self._stats[rule]
+            return s.mean_cost / s.reject_rate if s.reject_rate > 0 else float('inf')
+
+        candidate, segment = [], []
+        for rule in current:
+            if getattr(rule, 'independent', True):
+                segment.append(rule)
+                continue
+            candidate.extend(sorted(segment, key=rank))
+            candidate.append(rule)
+            segment = []
+        candidate.extend(sorted(segment, key=rank))
+        return candidate
+
+    def stats(self) -> Dict:
+        return {
+            'orders': {stage: [getattr(rule, 'name', repr(rule)) for rule in order]
+                       for stage, order in self._orders.items()},
+            'filters': {getattr(rule, 'name', repr(rule)): {'evaluations': s.evaluations,
+                                                            'reject_rate': s.reject_rate,
+                                                            'mean_cost_us': s.mean_cost * 1e6}
+                        for rule, s in self._stats.items()},
+            'checks': self.checks,
+            'reorders': self.reorders,
+        }
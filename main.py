@@ -87,6 +87,9 @@ def main():
             print(f"  出价: {result['bid_price']:.4f}")
         print()
     
+    # 落盘并关闭白盒日志
+    engine.close()
+    
     # 汇总结果
     print("=" * 60)
     print("竞价结果汇总:")
@@ -0,0 +1,289 @@
+"""
+流量质量特征计数器
+QualityScorer 在每次竞价时调用，这里的结构要求单次更新 / 查询 O(1)，且内存有上限
+"""
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from sketches import CountMinHLL, CountMinSketch, WindowedSketch
+
+
+class _WindowSlot:
+    """单个键的环形时间桶"""
+    __slots__ = ('buckets', 'last_bucket', 'total')
+
+    def __init__(self, num_buckets: int, bucket: int):
+        self.buckets: List[int] = [0] * num_buckets
+        self.last_bucket = bucket
+        self.total = 0
+
+
+class SlidingWindowCounter:
+    """
+    按键统计滑动时间窗口内的事件次数
+    - 窗口切分为 num_buckets 个定长时间桶（默认 60 个 5 秒桶 = 5 分钟），每个键一个环形数组 + 累计总数
+    - 自增与查询均摊 O(1)：只清理自上次访问以来过期的桶，且最多清理一圈
+    - 键数超过 max_keys 时按 LRU 淘汰最久未访问的键
+    计数按桶粒度过期，窗口边界误差不超过一个桶的时长
+    clock 为取时函数（Unix 秒）；未指定时使用 time.time，可在写入前通过 bind_clock 绑定到引擎时钟
+    """
+
+    def __init__(self, window_seconds: float = 300, bucket_seconds: float = 5,
+                 max_keys: int = 100000, clock: Optional[Callable[[], float]] = None):
+        if bucket_seconds <= 0 or window_seconds < bucket_seconds:
+            raise ValueError(f"无效的窗口配置：window={window_seconds}s, bucket={bucket_seconds}s")
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = int(round(window_seconds / bucket_seconds))
+        self.max_keys = max(1, max_keys)
+        self._clock = clock if clock is not None else time.time
+        self._clock_explicit = clock is not None
+        self._slots: "OrderedDict[str, _WindowSlot]" = OrderedDict()
+
+        # 监控计数：自增次数、LRU 淘汰键数
+        self.increments = 0
+        self.evictions = 0
+
+    def bind_clock(self, clock: Callable[[], float]):
+        """未显式指定时钟时改用 clock（应在写入数据之前调用）"""
+        if not self._clock_explicit:
+            self._clock = clock
+            self._clock_explicit = True
+
+    def _current_bucket(self) -> int:
+        return int(self._clock() // self.bucket_seconds)
+
+    def _advance(self, slot: _WindowSlot, bucket: int):
+        """清理 slot 中自上次访问以来已滑出窗口的桶"""
+        elapsed = bucket - slot.last_bucket
+        if elapsed <= 0:
+            return
+        buckets = slot.buckets
+        if elapsed >= self.num_buckets:
+            for i in range(self.num_buckets):
+                buckets[i] = 0
+            slot.total = 0
+        else:
+            n = self.num_buckets
+            for b in range(slot.last_bucket + 1, bucket + 1):
+                index = b % n
+                slot.total -= buckets[index]
+                buckets[index] = 0
+        slot.last_bucket = bucket
+
+    def increment(self, key: str, amount: int = 1) -> int:
+        """记录一次事件，返回该键当前窗口内的总次数"""
+        bucket = self._current_bucket()
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = _WindowSlot(self.num_buckets, bucket)
+            self._slots[key] = slot
+            if len(self._slots) > self.max_keys:
+                self._slots.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._advance(slot, bucket)
+            self._slots.move_to_end(key)
+        slot.buckets[bucket % self.num_buckets] += amount
+        slot.total += amount
+        self.increments += 1
+        return slot.total
+
+    def count(self, key: str) -> int:
+        """查询该键当前窗口内的总次数（不影响 LRU 顺序）"""
+        slot = self._slots.get(key)
+        if slot is None:
+            return 0
+        self._advance(slot, self._current_bucket())
+        return slot.total
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def stats(self) -> Dict:
+        return {
+            'keys': len(self._slots),
+            'max_keys': self.max_keys,
+            'increments': self.increments,
+            'evictions': self.evictions,
+            'window_seconds': self.window_seconds,
+            'bucket_seconds': self.bucket_seconds,
+        }
+
+
+class _ClickRing:
+    """单个键最近 N 次点击坐标的环形缓冲 + 整数累计和"""
+    __slots__ = ('xs', 'ys', 'pos', 'n', 'sum_x', 'sum_y', 'sum_xx', 'sum_yy')
+
+    def __init__(self, capacity: int):
+        self.xs: List[int] = [0] * capacity
+        self.ys: List[int] = [0] * capacity
+        self.pos = 0
+        self.n = 0
+        self.sum_x = 0
+        self.sum_y = 0
+        self.sum_xx = 0
+        self.sum_yy = 0
+
+
+class ClickDispersionTracker:
+    """
+    按键（device_app）跟踪最近 history_size 次点击坐标的离散程度
+    - 环形缓冲 + 坐标和 / 平方和的整数累计，单次更新与判定 O(1)
+    - 坐标为整数，方差判定用整数运算精确完成：
+      var < threshold  <=>  n * Σx² - (Σx)² < threshold * n²
+    - 键数超过 max_keys 时按 LRU 淘汰最久未访问的键
+    """
+
+    def __init__(self, history_size: int = 20, min_samples: int = 5,
+                 variance_threshold: int = 100, max_keys: int = 100000):
+        self.history_size = history_size
+        self.min_samples = min_samples
+        self.variance_threshold = variance_threshold
+        self.max_keys = max(1, max_keys)
+        self._rings: "OrderedDict[str, _ClickRing]" = OrderedDict()
+
+        # 监控计数：记录次数、LRU 淘汰键数
+        self.updates = 0
+        self.evictions = 0
+
+    def add(self, key: str, x: int, y: int) -> bool:
+        """记录一次点击，返回该键的点击位置是否过于固定（X 或 Y 方差低于阈值）"""
+        ring = self._rings.get(key)
+        if ring is None:
+            ring = _ClickRing(self.history_size)
+            self._rings[key] = ring
+            if len(self._rings) > self.max_keys:
+                self._rings.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._rings.move_to_end(key)
+
+        pos = ring.pos
+        if ring.n == self.history_size:
+            old_x, old_y = ring.xs[pos], ring.ys[pos]
+            ring.sum_x -= old_x
+            ring.sum_y -= old_y
+            ring.sum_xx -= old_x * old_x
+            ring.sum_yy -= old_y * old_y
+        else:
+            ring.n += 1
+        ring.xs[pos] = x
+        ring.ys[pos] = y
+        ring.sum_x += x
+        ring.sum_y += y
+        ring.sum_xx += x * x
+        ring.sum_yy += y * y
+        ring.pos = (pos + 1) % self.history_size
+        self.updates += 1
+        return self._is_fixed(ring)
+
+    def _is_fixed(self, ring: _ClickRing) -> bool:
+        n = ring.n
+        if n < self.min_samples:
+            return False
+        limit = self.variance_threshold * n * n
+        return n * ring.sum_xx - ring.sum_x * ring.sum_x < limit or \
+            n * ring.sum_yy - ring.sum_y * ring.sum_y < limit
+
+    def variances(self, key: str):
+        """该键当前的 (X 方差, Y 方差)，用于调试；无记录时返回 None"""
+        ring = self._rings.get(key)
+        if ring is None or ring.n == 0:
+            return None
+        n = ring.n
+        return ((n * ring.sum_xx - ring.sum_x * ring.sum_x) / (n * n),
+                (n * ring.sum_yy - ring.sum_y * ring.sum_y) / (n * n))
+
+    def __len__(self) -> int:
+        return len(self._rings)
+
+    def stats(self) -> Dict:
+        return {
+            'keys': len(self._rings),
+            'max_keys': self.max_keys,
+            'updates': self.updates,
+            'evictions': self.evictions,
+            'history_size': self.history_size,
+        }
+
+
+class ExactFeatureProvider:
+    """
+    精确流量特征：每个 IP 一个滑动窗口计数器（内存随活跃 IP 数增长，受 LRU 上限约束）
+    只提供 ip_requests
+    """
+
+    def __init__(self, window_seconds: float = 300, bucket_seconds: float = 5,
+                 max_keys: int = 100000, clock: Optional[Callable[[], float]] = None):
+        self.ip_counter = SlidingWindowCounter(window_seconds, bucket_seconds, max_keys, clock)
+
+    def bind_clock(self, clock: Callable[[], float]):
+        """未显式指定时钟时改用 clock（QualityScorer 绑定到引擎时钟）"""
+        self.ip_counter.bind_clock(clock)
+
+    def observe(self, ip_address: str, device_id: str) -> Dict:
+        """记录一次请求，返回窗口内的流量特征"""
+        return {'ip_requests': self.ip_counter.increment(ip_address)}
+
+    def stats(self) -> Dict:
+        return {'ip_counter': self.ip_counter.stats()}
+
+
+class SketchFeatureProvider:
+    """
+    草图流量特征：固定内存，适合全量流量
+    - ip_requests / device_requests: Count-Min 频次
+    - devices_per_ip / ips_per_device: Count-Min + HyperLogLog 基数
+    窗口内按代衰减；同参数的多个进程可通过 merge 合并
+    """
+
+    def __init__(self, window_seconds: float = 300, generations: int = 5,
+                 cm_width: int = 4096, cm_depth: int = 4,
+                 hll_width: int = 1024, hll_depth: int = 3, hll_precision: int = 6,
+                 clock: Optional[Callable[[], float]] = None):
+        def counts():
+            return WindowedSketch(lambda: CountMinSketch(cm_width, cm_depth), window_seconds, generations, clock)
+
+        def distincts():
+            return WindowedSketch(lambda: CountMinHLL(hll_width, hll_depth, hll_precision),
+                                  window_seconds, generations, clock)
+
+        self.ip_requests = counts()
+        self.device_requests = counts()
+        self.devices_per_ip = distincts()
+        self.ips_per_device = distincts()
+
+    def bind_clock(self, clock: Callable[[], float]):
+        """未显式指定时钟时改用 clock（QualityScorer 绑定到引擎时钟）"""
+        for sketch in (self.ip_requests, self.device_requests, self.devices_per_ip, self.ips_per_device):
+            sketch.bind_clock(clock)
+
+    def observe(self, ip_address: str, device_id: str) -> Dict:
+        """记录一次请求，返回窗口内的流量特征（频次取整，基数四舍五入）"""
+        self.ip_requests.add(ip_address)
+        self.device_requests.add(device_id)
+        self.devices_per_ip.add(ip_address, device_id)
+        self.ips_per_device.add(device_id, ip_address)
+        return {
+            'ip_requests': self.ip_requests.estimate(ip_address),
+            'device_requests': self.device_requests.estimate(device_id),
+            'devices_per_ip': int(round(self.devices_per_ip.estimate(ip_address))),
+            'ips_per_device': int(round(self.ips_per_device.estimate(device_id))),
+        }
+
+    def merge(self, other: "SketchFeatureProvider"):
+        """合并另一个进程的草图（参数需一致）"""
+        self.ip_requests.merge(other.ip_requests)
+        self.device_requests.merge(other.device_requests)
+        self.devices_per_ip.merge(other.devices_per_ip)
+        self.ips_per_device.merge(other.ips_per_device)
+
+    def stats(self) -> Dict:
+        return {
+            'ip_requests': self.ip_requests.stats(),
+            'device_requests': self.device_requests.stats(),
+            'devices_per_ip': self.devices_per_ip.stats(),
+            'ips_per_device': self.ips_per_device.stats(),
+        }
@@ -0,0 +1,129 @@
+"""
+引擎随机数源
+- EngineRandom: 可设种子的引擎级随机数源，按名称派生相互独立的随机流（ssp / dsp / filters ...），
+  某个组件多取或少取随机数不会影响其他组件的序列，基准测试与回放结果可复现
+- RandomStream: 单个随机流；安装 NumPy 时按块预取均匀分布随机数并从缓冲区逐个取用，
+  否则回退到 random.Random
+随机流提供与 random 模块相同的 random / uniform / randint / choice 接口，组件未注入随机流时直接使用 random 模块
+"""
+import hashlib
+import random
+from typing import Dict, Optional, Sequence
+
+try:
+    import numpy as np  # 可选：块预取快速路径
+except ImportError:
+    np = None
+
+
+def _stream_key(name: str) -> int:
+    """随机流名称 -> 稳定的整数（与 PYTHONHASHSEED 无关）"""
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class RandomStream:
+    """
+    单个随机流：一串 [0, 1) 均匀分布随机数，其余分布均由它变换得到
+    NumPy 路径下每次预取 block_size 个，逐个取用只是一次列表下标访问
+    """
+
+    def __init__(self, name: str, seed: Optional[int] = None, block_size: int = 1024):
+        self.name = name
+        self.block_size = max(1, block_size)
+        self._buffer: list = []
+        self._pos = 0
+        if np is not None:
+            entropy = seed if seed is not None else np.random.SeedSequence().entropy
+            self._generator = np.random.Generator(
+                np.random.PCG64(np.random.SeedSequence(entropy, spawn_key=(_stream_key(name),))))
+            self._fallback = None
+        else:
+            self._generator = None
+            self._fallback = random.Random(f"{seed}:{name}" if seed is not None else None)
+        self.draws = 0
+
+    def _refill(self):
+        self._buffer = self._generator.random(self.block_size).tolist()
+        self._pos = 0
+
+    def random(self) -> float:
+        """[0, 1) 均匀分布"""
+        self.draws += 1
+        if self._generator is None:
+            return self._fallback.random()
+        if self._pos >= len(self._buffer):
+            self._refill()
+        value = self._buffer[self._pos]
+        self._pos += 1
+        return value
+
+    def uniform(self, a: float, b: float) -> float:
+        return a + (b - a) * self.random()
+
+    def randint(self, a: int, b: int) -> int:
+        """[a, b] 闭区间整数"""
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq: Sequence):
+        return seq[int(self.random() * len(seq))]
+
+    def random_array(self, n: int):
+        """
+        连续取 n 个均匀分布随机数（NumPy 数组，无 NumPy 时为列表）
+        与逐个调用 random() n 次得到的序列完全相同，批量路径与逐条路径可以互相对照
+        """
+        self.draws += n
+        if self._generator is None:
+            return [self._fallback.random() for _ in range(n)]
+        values = []
+        remaining = n
+        while remaining > 0:
+            if self._pos >= len(self._buffer):
+                self._refill()
+            take = min(remaining, len(self._buffer) - self._pos)
+            values.extend(self._buffer[self._pos:self._pos + take])
+            self._pos += take
+            remaining -= take
+        return np.array(values, dtype=np.float64)
+
+
+class EngineRandom:
+    """
+    引擎级随机数源
+    seed 相同则每个命名随机流的序列相同；seed 为 None 时从系统熵源取种子（仍保持流之间相互独立）
+    """
+
+    def __init__(self, seed: Optional[int] = None, block_size: int = 1024):
+        if seed is None and np is not None:
+            seed = np.random.SeedSequence().entropy
+        elif seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        self.seed = seed
+        self.block_size = block_size
+        self._streams: Dict[str, RandomStream] = {}
+
+    def stream(self, name: str) -> RandomStream:
+        """按名称取随机流（同名返回同一个对象）"""
+        stream = self._streams.get(name)
+        if stream is None:
+            stream = RandomStream(name, self.seed, self.block_size)
+            self._streams[name] = stream
+        return stream
+
+    def stats(self) -> Dict:
+        return {'seed': self.seed, 'draws': {name: s.draws for name, s in self._streams.items()}}
+
+
+class _GlobalRandom:
+    """未注入随机数源时的默认值：所有命名流都直接使用 random 模块（保持原有行为）"""
+
+    seed = None
+
+    def stream(self, name: str):
+        return random
+
+    def stats(self) -> Dict:
+        return {'seed': None, 'draws': {}}
+
+
+GLOBAL_RANDOM = _GlobalRandom()
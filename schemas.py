@@ -2,41 +2,427 @@
 白盒化广告交易数据协议定义
 定义 WhiteboxTrace 类用于记录所有决策点的详细信息
 """
-from dataclasses import dataclass, field, asdict
-from typing import Dict, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Union
 from datetime import datetime
+import hashlib
 import json
+import os
+
+try:
+    import orjson  # 可选的高性能 JSON 后端
+except ImportError:
+    orjson = None
+
+
+class LazyReasoning:
+    """
+    延迟渲染的推理说明
+    保存模板与参数（或一个返回字符串的可调用对象），仅在序列化或显式读取时才格式化
+    """
+    __slots__ = ('template', 'args', '_text')
+    
+    def __init__(self, template: Union[str, Callable[[], str]], args: Optional[Dict] = None):
+        self.template = template
+        self.args = args
+        self._text: Optional[str] = None
+    
+    def render(self) -> str:
+        """渲染推理说明（结果会被缓存）"""
+        if self._text is None:
+            if callable(self.template):
+                self._text = self.template()
+            elif self.args is None:
+                self._text = self.template
+            else:
+                self._text = self.template.format(**self.args)
+        return self._text
+    
+    def __str__(self) -> str:
+        return self.render()
+    
+    def __repr__(self) -> str:
+        return repr(self.render())
+    
+    def __eq__(self, other) -> bool:
+        return str(self) == str(other)
+    
+    def __hash__(self) -> int:
+        return hash(self.render())
+    
+    def __deepcopy__(self, memo) -> str:
+        # 深拷贝时直接物化为字符串，避免复制模板参数
+        return self.render()
+
+
+def render_reasoning(reasoning: Union[str, LazyReasoning, None]) -> str:
+    """将推理说明渲染为字符串"""
+    if reasoning is None:
+        return ""
+    if isinstance(reasoning, str):
+        return reasoning
+    return reasoning.render()
+
+
+# 追踪记录字段（顺序即日志行中的字段顺序）
+TRACE_FIELDS = (
+    'request_id', 'timestamp', 'node', 'action', 'decision', 'reason_code',
+    'internal_variables', 'reasoning',
+    'pCTR', 'pCVR', 'eCPM', 'latency_ms', 'second_best_bid', 'actual_paid_price', 'saved_amount'
+)
+
+# 广告请求字段（顺序即序列化后的字段顺序）
+AD_REQUEST_FIELDS = (
+    'request_id', 'device_id', 'app_id', 'app_name', 'platform', 'ad_size',
+    'latency_ms', 'postback_delay_hours', 'postback_delay_seconds', 'timestamp'
+)
+
+
+class AdRequest:
+    """
+    SSP 生成的广告请求（__slots__ 紧凑存储，生成后不再修改）
+    提供与字典相同的只读访问（get / [] / in），追踪可以直接引用而不必复制；
+    出价相关字段写入各 DSP 的 BidRequest 覆盖层
+    """
+    __slots__ = AD_REQUEST_FIELDS
+    
+    def __init__(self, request_id: str, device_id: str, app_id: str, app_name: str, platform: str,
+                 ad_size: tuple, latency_ms: float, postback_delay_hours: Optional[float],
+                 postback_delay_seconds: Optional[float], timestamp: str):
+        self.request_id = request_id
+        self.device_id = device_id
+        self.app_id = app_id
+        self.app_name = app_name
+        self.platform = platform
+        self.ad_size = ad_size
+        self.latency_ms = latency_ms
+        self.postback_delay_hours = postback_delay_hours
+        self.postback_delay_seconds = postback_delay_seconds
+        self.timestamp = timestamp
+    
+    def __getitem__(self, key: str):
+        if key not in AD_REQUEST_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key: str, value):
+        raise TypeError("AdRequest 不可修改，出价相关字段请写入 BidRequest")
+    
+    def __contains__(self, key) -> bool:
+        return key in AD_REQUEST_FIELDS
+    
+    def __iter__(self):
+        return iter(AD_REQUEST_FIELDS)
+    
+    def __len__(self) -> int:
+        return len(AD_REQUEST_FIELDS)
+    
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (AdRequest, BidRequest, dict)):
+            return self.to_dict() == (other if isinstance(other, dict) else other.to_dict())
+        return NotImplemented
+    
+    def __repr__(self) -> str:
+        return f"AdRequest({self.to_dict()!r})"
+    
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in AD_REQUEST_FIELDS else default
+    
+    def keys(self):
+        return AD_REQUEST_FIELDS
+    
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in AD_REQUEST_FIELDS}
+    
+    def copy(self) -> Dict:
+        """可修改的字典副本（兼容按字典使用请求的调用方）"""
+        return self.to_dict()
+
+
+class BidRequest:
+    """
+    单个 DSP 的出价请求：共享 AdRequest 基础字段的写时复制覆盖层
+    读取时先查覆盖层再查基础请求，写入只进入覆盖层（dsp_id、pctr、pcvr、bid_price 等），
+    每个 DSP 只分配一个小字典，而不是复制整个请求
+    """
+    __slots__ = ('base', 'overlay')
+    
+    def __init__(self, base, **fields):
+        self.base = base
+        self.overlay = fields
+    
+    def __getitem__(self, key: str):
+        overlay = self.overlay
+        if key in overlay:
+            return overlay[key]
+        return self.base[key]
+    
+    def __setitem__(self, key: str, value):
+        self.overlay[key] = value
+    
+    def __contains__(self, key) -> bool:
+        return key in self.overlay or key in self.base
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self) -> int:
+        return len(self.keys())
+    
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (AdRequest, BidRequest, dict)):
+            return self.to_dict() == (other if isinstance(other, dict) else other.to_dict())
+        return NotImplemented
+    
+    def __repr__(self) -> str:
+        return f"BidRequest({self.to_dict()!r})"
+    
+    def get(self, key: str, default=None):
+        overlay = self.overlay
+        if key in overlay:
+            return overlay[key]
+        return self.base.get(key, default)
+    
+    def keys(self) -> List[str]:
+        return list(self.base.keys()) + [key for key in self.overlay if key not in self.base]
+    
+    def to_dict(self) -> Dict:
+        """合并后的字典：基础字段在前（被覆盖的字段保持原位置），新增字段按写入顺序在后"""
+        data = self.base.to_dict() if isinstance(self.base, (AdRequest, BidRequest)) else dict(self.base)
+        data.update(self.overlay)
+        return data
+    
+    def copy(self) -> Dict:
+        return self.to_dict()
+
+
+def json_default(obj):
+    """JSON 序列化钩子：追踪中直接引用的 AdRequest / BidRequest 按合并后的字典写出"""
+    if isinstance(obj, (AdRequest, BidRequest)):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+# 标准库编码器：与 json.dumps(obj, ensure_ascii=False) 的输出逐字节一致
+_stdlib_encode = json.JSONEncoder(ensure_ascii=False, default=json_default).encode
+
+# 当前使用的 JSON 后端：默认标准库；orjson 需通过 set_json_backend("orjson") 显式启用
+_json_backend = "json"
+
+
+def set_json_backend(name: str):
+    """
+    切换日志行序列化后端
+    - json（默认）: 标准库，输出与历史日志逐字节一致
+    - orjson: 更快，但输出格式不同（无空格、浮点数表示可能不同），json.loads 解析结果相同；
+      按字节比较或对日志做 diff 的下游需要注意
+    """
+    global _json_backend
+    if name not in ("json", "orjson"):
+        raise ValueError(f"未知的 JSON 后端：{name}")
+    if name == "orjson" and orjson is None:
+        raise ImportError("orjson 未安装，请执行 pip install orjson")
+    _json_backend = name
+
+
+def get_json_backend() -> str:
+    """当前使用的 JSON 后端"""
+    return _json_backend
 
 
-@dataclass
 class WhiteboxTrace:
-    """白盒追踪记录，记录每个决策点的完整信息"""
-    request_id: str
-    timestamp: str
-    node: str  # SSP/ADX/DSP
-    action: str  # 操作类型，如 REQUEST/BID/FILTER/DECISION
-    decision: str  # PASS/REJECT
-    reason_code: str  # 原因代码
-    internal_variables: Dict = field(default_factory=dict)  # 内部变量快照
-    reasoning: str = ""  # 推理过程说明
-    # 新增字段（全部为 float 类型，允许为空）
-    pCTR: Optional[float] = None  # 预估点击率
-    pCVR: Optional[float] = None  # 预估转化率
-    eCPM: Optional[float] = None  # 有效千次展示费用
-    latency_ms: Optional[float] = None  # 处理耗时，毫秒
-    second_best_bid: Optional[float] = None  # 第二高出价，用于二价结算
-    actual_paid_price: Optional[float] = None  # 实际成交价
-    saved_amount: Optional[float] = None  # 因二价机制节省的金额
+    """白盒追踪记录，记录每个决策点的完整信息（__slots__ 紧凑存储）"""
+    __slots__ = TRACE_FIELDS
+    
+    def __init__(self, request_id: str, timestamp: str,
+                 node: str,  # SSP/ADX/DSP
+                 action: str,  # 操作类型，如 REQUEST/BID/FILTER/DECISION
+                 decision: str,  # PASS/REJECT
+                 reason_code: str,  # 原因代码
+                 internal_variables: Optional[Dict] = None,  # 内部变量快照
+                 reasoning: Union[str, LazyReasoning] = "",  # 推理过程说明（可延迟渲染）
+                 # 新增字段（全部为 float 类型，允许为空）
+                 pCTR: Optional[float] = None,  # 预估点击率
+                 pCVR: Optional[float] = None,  # 预估转化率
+                 eCPM: Optional[float] = None,  # 有效千次展示费用
+                 latency_ms: Optional[float] = None,  # 处理耗时，毫秒
+                 second_best_bid: Optional[float] = None,  # 第二高出价，用于二价结算
+                 actual_paid_price: Optional[float] = None,  # 实际成交价
+                 saved_amount: Optional[float] = None):  # 因二价机制节省的金额
+        self.request_id = request_id
+        self.timestamp = timestamp
+        self.node = node
+        self.action = action
+        self.decision = decision
+        self.reason_code = reason_code
+        self.internal_variables = internal_variables if internal_variables is not None else {}
+        self.reasoning = reasoning
+        self.pCTR = pCTR
+        self.pCVR = pCVR
+        self.eCPM = eCPM
+        self.latency_ms = latency_ms
+        self.second_best_bid = second_best_bid
+        self.actual_paid_price = actual_paid_price
+        self.saved_amount = saved_amount
+    
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in TRACE_FIELDS)
+    
+    def __repr__(self) -> str:
+        fields_repr = ", ".join(f"{name}={getattr(self, name)!r}" for name in TRACE_FIELDS)
+        return f"WhiteboxTrace({fields_repr})"
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'WhiteboxTrace':
+        """从日志字典构造追踪记录（缺失字段使用默认值）"""
+        return cls(
+            request_id=data.get('request_id', ''),
+            timestamp=data.get('timestamp', ''),
+            node=data.get('node', ''),
+            action=data.get('action', ''),
+            decision=data.get('decision', ''),
+            reason_code=data.get('reason_code', ''),
+            internal_variables=data.get('internal_variables', {}),
+            reasoning=data.get('reasoning', ''),
+            pCTR=data.get('pCTR'),
+            pCVR=data.get('pCVR'),
+            eCPM=data.get('eCPM'),
+            latency_ms=data.get('latency_ms'),
+            second_best_bid=data.get('second_best_bid'),
+            actual_paid_price=data.get('actual_paid_price'),
+            saved_amount=data.get('saved_amount')
+        )
     
     def to_dict(self) -> Dict:
-        """转换为字典格式"""
-        return asdict(self)
+        """转换为字典格式（按字段顺序，推理说明已渲染；不深拷贝内部变量）"""
+        data = {name: getattr(self, name) for name in TRACE_FIELDS}
+        data['reasoning'] = render_reasoning(self.reasoning)
+        return data
     
     def to_json(self) -> str:
         """转换为 JSON 字符串"""
-        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2, default=json_default)
     
     def to_log_line(self) -> str:
         """转换为日志行格式（单行 JSON）"""
-        return json.dumps(self.to_dict(), ensure_ascii=False)
+        if _json_backend == "orjson":
+            try:
+                return orjson.dumps(self.to_dict(), default=json_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+            except TypeError:
+                # orjson 不支持的类型（如超大整数）回退到标准库
+                pass
+        # 按固定字段顺序直接拼接，省去中间字典和深拷贝
+        encode = _stdlib_encode
+        return ''.join((
+            '{"request_id": ', encode(self.request_id),
+            ', "timestamp": ', encode(self.timestamp),
+            ', "node": ', encode(self.node),
+            ', "action": ', encode(self.action),
+            ', "decision": ', encode(self.decision),
+            ', "reason_code": ', encode(self.reason_code),
+            ', "internal_variables": ', encode(self.internal_variables),
+            ', "reasoning": ', encode(render_reasoning(self.reasoning)),
+            ', "pCTR": ', _encode_optional(self.pCTR),
+            ', "pCVR": ', _encode_optional(self.pCVR),
+            ', "eCPM": ', _encode_optional(self.eCPM),
+            ', "latency_ms": ', _encode_optional(self.latency_ms),
+            ', "second_best_bid": ', _encode_optional(self.second_best_bid),
+            ', "actual_paid_price": ', _encode_optional(self.actual_paid_price),
+            ', "saved_amount": ', _encode_optional(self.saved_amount),
+            '}'
+        ))
+
+
+def _encode_optional(value) -> str:
+    """编码可为空的数值字段"""
+    if value is None:
+        return 'null'
+    return _stdlib_encode(value)
+
+
+def blacklist_version(entries: Iterable[str]) -> str:
+    """黑名单内容版本号：排序后条目的 SHA1 摘要（前 16 位），内容相同则版本相同"""
+    digest = hashlib.sha1()
+    for entry in sorted(entries):
+        digest.update(entry.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()[:16]
+
+
+def blacklist_sidecar_path(log_file: str) -> str:
+    """黑名单快照旁路文件路径：与日志文件同名，后缀为 .blacklist.jsonl"""
+    return os.path.splitext(log_file)[0] + '.blacklist.jsonl'
+
+
+# 聚合记录标识：一行 = 一个请求的全部决策点
+RECORD_TYPE_REQUEST = "REQUEST"
+
+# 聚合记录中 steps 可省略的字段（为空时不写出）
+_OPTIONAL_STEP_FIELDS = ('pCTR', 'pCVR', 'eCPM', 'latency_ms', 'second_best_bid', 'actual_paid_price', 'saved_amount')
+
+
+class WhiteboxRequestRecord:
+    """
+    单请求聚合记录：一次竞价产生的全部追踪按发生顺序写入 steps 数组
+    request_id 只在记录头出现一次；与记录头相同的 timestamp、为空的数值字段均省略
+    """
+    __slots__ = ('request_id', 'traces')
+    
+    def __init__(self, request_id: str, traces: List[WhiteboxTrace]):
+        self.request_id = request_id
+        self.traces = traces
+    
+    def to_dict(self) -> Dict:
+        """转换为字典格式"""
+        timestamp = self.traces[0].timestamp if self.traces else ''
+        steps = []
+        for trace in self.traces:
+            step = {
+                'node': trace.node,
+                'action': trace.action,
+                'decision': trace.decision,
+                'reason_code': trace.reason_code,
+                'internal_variables': trace.internal_variables,
+                'reasoning': render_reasoning(trace.reasoning)
+            }
+            if trace.timestamp != timestamp:
+                step['timestamp'] = trace.timestamp
+            for name in _OPTIONAL_STEP_FIELDS:
+                value = getattr(trace, name)
+                if value is not None:
+                    step[name] = value
+            steps.append(step)
+        return {
+            'record_type': RECORD_TYPE_REQUEST,
+            'request_id': self.request_id,
+            'timestamp': timestamp,
+            'steps': steps
+        }
+    
+    def to_log_line(self) -> str:
+        """转换为日志行格式（单行 JSON）"""
+        data = self.to_dict()
+        if _json_backend == "orjson":
+            try:
+                return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+            except TypeError:
+                pass
+        return _stdlib_encode(data)
+
 
+def flatten_log_record(data: Dict) -> List[Dict]:
+    """
+    日志展平适配器：把一行日志（逐条追踪或单请求聚合记录）统一展开为逐条追踪字典列表
+    """
+    if data.get('record_type') != RECORD_TYPE_REQUEST:
+        return [data]
+    request_id = data.get('request_id', '')
+    timestamp = data.get('timestamp', '')
+    flattened = []
+    for step in data.get('steps', []):
+        flat = dict(step)
+        flat['request_id'] = request_id
+        flat.setdefault('timestamp', timestamp)
+        flattened.append(flat)
+    return flattened
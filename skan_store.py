@@ -0,0 +1,206 @@
+"""
+按广告活动（或应用）存放的 SKAN 转化值分布
+活动数 × 64 的稠密矩阵，行级累积表缓存，批量 postback 更新与向量化采样，支持 .npy 检查点（可内存映射加载）
+依赖 NumPy
+"""
+import json
+import os
+import random
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+
+SKAN_CONVERSION_VALUES = 64
+# 采样越界（浮点误差）时返回的中值，与全局分布采样保持一致
+_FALLBACK_CONVERSION_VALUE = 31
+
+
+class SKANDistributionStore:
+    """
+    SKAN 转化值分布矩阵
+    - 每行一个活动，存未归一化权重与行总和，概率 = 权重 / 行总和
+    - 新活动以先验分布（prior）初始化
+    - 累积表按行缓存，行被更新后标记失效，下次采样时批量重建
+    """
+
+    def __init__(self, prior: Sequence[float], initial_capacity: int = 64):
+        prior = np.asarray(prior, dtype=np.float64)
+        if prior.shape != (SKAN_CONVERSION_VALUES,):
+            raise ValueError(f"先验分布必须包含 {SKAN_CONVERSION_VALUES} 个转化值：{prior.shape}")
+        self.prior = prior / prior.sum()
+        capacity = max(1, initial_capacity)
+        self._weights = np.empty((capacity, SKAN_CONVERSION_VALUES), dtype=np.float64)
+        self._totals = np.empty(capacity, dtype=np.float64)
+        self._cdf = np.empty((capacity, SKAN_CONVERSION_VALUES), dtype=np.float64)
+        self._stale = np.ones(capacity, dtype=bool)
+        self._size = 0
+        self._rows: Dict[str, int] = {}
+        self.campaigns: List[str] = []
+
+        # 监控计数：批量更新次数、累计 postback 数
+        self.update_batches = 0
+        self.postbacks_applied = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, campaign_id: str) -> bool:
+        return campaign_id in self._rows
+
+    def _grow(self, capacity: int):
+        """扩容（加倍），内存映射加载的矩阵在此时复制到内存"""
+        weights = np.empty((capacity, SKAN_CONVERSION_VALUES), dtype=np.float64)
+        weights[:self._size] = self._weights[:self._size]
+        totals = np.empty(capacity, dtype=np.float64)
+        totals[:self._size] = self._totals[:self._size]
+        cdf = np.empty((capacity, SKAN_CONVERSION_VALUES), dtype=np.float64)
+        cdf[:self._size] = self._cdf[:self._size]
+        stale = np.ones(capacity, dtype=bool)
+        stale[:self._size] = self._stale[:self._size]
+        self._weights, self._totals, self._cdf, self._stale = weights, totals, cdf, stale
+
+    def row(self, campaign_id: str) -> int:
+        """活动对应的行号，不存在时以先验分布新建"""
+        index = self._rows.get(campaign_id)
+        if index is not None:
+            return index
+        index = self._size
+        if index >= len(self._totals):
+            self._grow(2 * len(self._totals))
+        self._weights[index] = self.prior
+        self._totals[index] = 1.0
+        self._stale[index] = True
+        self._rows[campaign_id] = index
+        self.campaigns.append(campaign_id)
+        self._size += 1
+        return index
+
+    def _refresh_cdf(self, rows: np.ndarray):
+        """重建给定行中已失效的累积表"""
+        stale_rows = rows[self._stale[rows]]
+        if len(stale_rows):
+            self._cdf[stale_rows] = np.cumsum(self._weights[stale_rows], axis=1)
+            self._stale[stale_rows] = False
+
+    def probability(self, campaign_id: str, conversion_value: int) -> float:
+        index = self.row(campaign_id)
+        return float(self._weights[index, conversion_value] / self._totals[index])
+
+    def distribution(self, campaign_id: str) -> np.ndarray:
+        """活动的概率分布（副本）"""
+        index = self.row(campaign_id)
+        return self._weights[index] / self._totals[index]
+
+    def sample(self, campaign_id: str, rng=random) -> int:
+        """按活动分布采样一个转化值；rng 为随机流（默认 random 模块）"""
+        index = self.row(campaign_id)
+        if self._stale[index]:
+            self._refresh_cdf(np.array([index]))
+        value = int(np.searchsorted(self._cdf[index], rng.random() * self._totals[index], side='left'))
+        return value if value < SKAN_CONVERSION_VALUES else _FALLBACK_CONVERSION_VALUE
+
+    def sample_batch(self, requests: Iterable[Tuple[str, int]], rng=None) -> List[np.ndarray]:
+        """
+        批量采样：requests 为 (campaign_id, n) 列表，返回与之对应的转化值数组列表
+        rng 为随机流（rng.RandomStream），默认使用 NumPy 全局随机数
+        各行归一化累积表加上行序号偏移后拼成一个单调数组，一次 searchsorted 完成全部采样
+        """
+        requests = list(requests)
+        if not requests:
+            return []
+        rows = np.array([self.row(campaign_id) for campaign_id, _ in requests], dtype=np.intp)
+        counts = np.array([n for _, n in requests], dtype=np.intp)
+        self._refresh_cdf(np.unique(rows))
+
+        positions = np.arange(len(rows))
+        table = self._cdf[rows] / self._totals[rows][:, None] + positions[:, None]
+        owner = np.repeat(positions, counts)
+        uniforms = rng.random_array(len(owner)) if rng is not None else np.random.random_sample(len(owner))
+        draws = uniforms + owner
+        values = np.searchsorted(table.ravel(), draws, side='left') - owner * SKAN_CONVERSION_VALUES
+        values[values >= SKAN_CONVERSION_VALUES] = _FALLBACK_CONVERSION_VALUE
+        return np.split(values.astype(np.int64), np.cumsum(counts)[:-1])
+
+    def apply_postbacks(self, campaign_ids: Sequence[str], conversion_values: Sequence[int], weight: float = 0.1):
+        """
+        批量 EMA 更新，结果与按给定顺序逐条执行 p' = (1 - weight) * p + weight * e_v 完全相同
+        （与 SKANOptimizer.update_conversion_distribution 的规则一致）
+        同一活动在本批收到 k 个 postback 时，第 i 个（从 1 开始）的转化值 v_i 对结果的贡献为
+            weight * (1 - weight)^(k - i)
+        即 p' = (1 - weight)^k * p + Σ_i weight * (1 - weight)^(k - i) * e_{v_i}，一次矩阵运算完成所有活动
+        """
+        if len(campaign_ids) != len(conversion_values):
+            raise ValueError("campaign_ids 与 conversion_values 长度不一致")
+        if not len(campaign_ids):
+            return
+        rows = np.array([self.row(campaign_id) for campaign_id in campaign_ids], dtype=np.intp)
+        values = np.asarray(conversion_values, dtype=np.intp)
+        valid = (values >= 0) & (values < SKAN_CONVERSION_VALUES)
+        rows, values = rows[valid], values[valid]
+        if not len(rows):
+            return
+
+        touched, inverse = np.unique(rows, return_inverse=True)
+        k = np.bincount(inverse, minlength=len(touched))
+        # 每个 postback 在所属活动内的序号（1..k，保持输入顺序）
+        order = np.argsort(inverse, kind='stable')
+        sorted_inverse = inverse[order]
+        rank = np.empty(len(rows), dtype=np.intp)
+        rank[order] = np.arange(len(rows)) - np.searchsorted(sorted_inverse, sorted_inverse, side='left') + 1
+        contribution = np.zeros((len(touched), SKAN_CONVERSION_VALUES), dtype=np.float64)
+        np.add.at(contribution, (inverse, values), weight * (1.0 - weight) ** (k[inverse] - rank))
+        decay = (1.0 - weight) ** k
+        current = self._weights[touched] / self._totals[touched][:, None]
+        self._weights[touched] = decay[:, None] * current + contribution
+        self._totals[touched] = 1.0
+        self._stale[touched] = True
+        self.update_batches += 1
+        self.postbacks_applied += int(len(rows))
+
+    def save(self, path: str):
+        """
+        写检查点：<path>.npy 存归一化后的分布矩阵，<path>.campaigns.json 存活动 ID 与先验
+        先写临时文件再替换
+        """
+        base = path[:-4] if path.endswith('.npy') else path
+        matrix = self._weights[:self._size] / self._totals[:self._size][:, None]
+        tmp_matrix = base + '.tmp.npy'
+        np.save(tmp_matrix, matrix)
+        os.replace(tmp_matrix, base + '.npy')
+        tmp_meta = base + '.campaigns.json.tmp'
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump({'campaigns': self.campaigns, 'prior': self.prior.tolist()}, f, ensure_ascii=False)
+        os.replace(tmp_meta, base + '.campaigns.json')
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "SKANDistributionStore":
+        """
+        读取检查点
+        - mmap: 以写时复制方式内存映射 .npy，多个进程共享未修改的页；更新只影响本进程
+        """
+        base = path[:-4] if path.endswith('.npy') else path
+        with open(base + '.campaigns.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        matrix = np.load(base + '.npy', mmap_mode='c' if mmap else None)
+        store = cls(meta['prior'], initial_capacity=1)
+        size = len(meta['campaigns'])
+        if matrix.shape != (size, SKAN_CONVERSION_VALUES):
+            raise ValueError(f"检查点矩阵形状与活动数不一致：{matrix.shape}")
+        if size:
+            store._weights = matrix
+            store._totals = np.ones(size, dtype=np.float64)
+            store._cdf = np.empty((size, SKAN_CONVERSION_VALUES), dtype=np.float64)
+            store._stale = np.ones(size, dtype=bool)
+        store._size = size
+        store.campaigns = list(meta['campaigns'])
+        store._rows = {campaign_id: i for i, campaign_id in enumerate(store.campaigns)}
+        return store
+
+    def stats(self) -> Dict:
+        return {
+            'campaigns': self._size,
+            'capacity': len(self._totals),
+            'update_batches': self.update_batches,
+            'postbacks_applied': self.postbacks_applied,
+        }
@@ -0,0 +1,278 @@
+"""
+流量质量概率数据结构
+固定内存的频次 / 基数估计，用于全量流量的反欺诈特征（不再为每个 IP / 设备保存精确状态）
+- CountMinSketch: 按键估计出现次数（只会高估，误差 ≤ epsilon × 总次数，置信度 1 - delta）
+- HyperLogLog: 估计不同元素个数（标准误差约 1.04 / sqrt(2^precision)）
+- CountMinHLL: 按键估计不同元素个数（Count-Min 的每个单元是一个小 HyperLogLog）
+- WindowedSketch: 按时间分代轮换，实现滑动窗口衰减
+所有结构支持 merge，多个引擎进程的同构草图可以合并
+哈希使用 blake2b，跨进程、跨机器稳定（不依赖 PYTHONHASHSEED）
+"""
+import copy
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+_MASK32 = 0xFFFFFFFF
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _row_columns(key: str, width: int, depth: int) -> List[int]:
+    """双重哈希：由一次 64 位哈希派生每一行的列下标"""
+    h = _hash64(key)
+    h1 = h & _MASK32
+    h2 = (h >> 32) | 1
+    return [(h1 + row * h2) % width for row in range(depth)]
+
+
+def _check_same_shape(a, b, fields):
+    for field in fields:
+        if getattr(a, field) != getattr(b, field):
+            raise ValueError(f"草图参数不一致，无法合并：{field} {getattr(a, field)} != {getattr(b, field)}")
+
+
+class CountMinSketch:
+    """Count-Min 频次草图"""
+
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._table: List[int] = [0] * (width * depth)
+
+    @classmethod
+    def from_error(cls, epsilon: float = 0.001, delta: float = 0.01) -> "CountMinSketch":
+        """按误差 epsilon（相对总次数）与失败概率 delta 计算宽度和深度"""
+        return cls(width=int(math.ceil(math.e / epsilon)), depth=int(math.ceil(math.log(1 / delta))))
+
+    def add(self, key: str, count: int = 1) -> int:
+        """累加计数，返回该键当前的估计值"""
+        table, width = self._table, self.width
+        estimate = None
+        for row, col in enumerate(_row_columns(key, width, self.depth)):
+            index = row * width + col
+            table[index] += count
+            if estimate is None or table[index] < estimate:
+                estimate = table[index]
+        self.total += count
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        table, width = self._table, self.width
+        return min(table[row * width + col] for row, col in enumerate(_row_columns(key, width, self.depth)))
+
+    def merge(self, other: "CountMinSketch"):
+        _check_same_shape(self, other, ('width', 'depth'))
+        table = self._table
+        for i, value in enumerate(other._table):
+            table[i] += value
+        self.total += other.total
+
+    @staticmethod
+    def estimate_union(sketches: List["CountMinSketch"], key: str) -> int:
+        """多代草图的合计估计（窗口内各代计数之和）"""
+        return sum(s.estimate(key) for s in sketches)
+
+    def memory_bytes(self) -> int:
+        """计数表的近似内存（按每个计数 8 字节计）"""
+        return len(self._table) * 8
+
+
+def _hll_alpha(m: int) -> float:
+    if m <= 16:
+        return 0.673
+    if m <= 32:
+        return 0.697
+    if m <= 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+def _hll_position(item: str, precision: int):
+    """元素 -> (寄存器下标, 前导零个数 + 1)"""
+    h = _hash64(item)
+    rest_bits = 64 - precision
+    rest = h & ((1 << rest_bits) - 1)
+    return h >> rest_bits, rest_bits - rest.bit_length() + 1
+
+
+# 2^-rank 查表（rank 最大为 64 - precision + 1）
+_INV_POW2 = [2.0 ** -i for i in range(66)]
+
+
+def _hll_estimate(registers, m: int) -> float:
+    harmonic = sum(_INV_POW2[value] for value in registers)
+    zeros = registers.count(0)
+    estimate = _hll_alpha(m) * m * m / harmonic
+    if estimate <= 2.5 * m and zeros:
+        # 小基数修正：线性计数
+        estimate = m * math.log(m / zeros)
+    return estimate
+
+
+class HyperLogLog:
+    """HyperLogLog 基数草图"""
+
+    def __init__(self, precision: int = 12):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"HyperLogLog 精度必须在 4-16 之间：{precision}")
+        self.precision = precision
+        self.m = 1 << precision
+        self._registers = bytearray(self.m)
+
+    def add(self, item: str):
+        index, rank = _hll_position(item, self.precision)
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def count(self) -> float:
+        return _hll_estimate(self._registers, self.m)
+
+    def merge(self, other: "HyperLogLog"):
+        _check_same_shape(self, other, ('precision',))
+        registers = self._registers
+        for i, value in enumerate(other._registers):
+            if value > registers[i]:
+                registers[i] = value
+
+    def memory_bytes(self) -> int:
+        return self.m
+
+
+class CountMinHLL:
+    """
+    按键的基数草图：Count-Min 结构，每个单元是一个 2^precision 个寄存器的小 HyperLogLog
+    键映射到每行一个单元，估计值取各行估计的最小值（哈希冲突只会让基数偏大）
+    """
+
+    def __init__(self, width: int = 1024, depth: int = 3, precision: int = 6):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"HyperLogLog 精度必须在 4-16 之间：{precision}")
+        self.width = width
+        self.depth = depth
+        self.precision = precision
+        self.m = 1 << precision
+        self._registers = bytearray(width * depth * self.m)
+
+    def _offsets(self, key: str) -> List[int]:
+        width, m = self.width, self.m
+        return [(row * width + col) * m for row, col in enumerate(_row_columns(key, width, self.depth))]
+
+    def add(self, key: str, item: str):
+        index, rank = _hll_position(item, self.precision)
+        registers = self._registers
+        for offset in self._offsets(key):
+            if rank > registers[offset + index]:
+                registers[offset + index] = rank
+
+    def estimate(self, key: str) -> float:
+        m = self.m
+        return min(_hll_estimate(self._registers[offset:offset + m], m) for offset in self._offsets(key))
+
+    def merge(self, other: "CountMinHLL"):
+        _check_same_shape(self, other, ('width', 'depth', 'precision'))
+        registers = self._registers
+        for i, value in enumerate(other._registers):
+            if value > registers[i]:
+                registers[i] = value
+
+    @staticmethod
+    def estimate_union(sketches: List["CountMinHLL"], key: str) -> float:
+        """多代草图的并集基数：逐行合并寄存器后估计，同一元素跨代出现只计一次"""
+        if len(sketches) == 1:
+            return sketches[0].estimate(key)
+        m = sketches[0].m
+        best = None
+        for row_offsets in zip(*(s._offsets(key) for s in sketches)):
+            cells = [sketch._registers[offset:offset + m] for sketch, offset in zip(sketches, row_offsets)]
+            merged = bytes(map(max, *cells))
+            estimate = _hll_estimate(merged, m)
+            if best is None or estimate < best:
+                best = estimate
+        return best
+
+    def memory_bytes(self) -> int:
+        return len(self._registers)
+
+
+class WindowedSketch:
+    """
+    滑动窗口草图：窗口切分为 generations 代，每代一个草图，过期的代整体丢弃
+    代编号按 时间 // 每代时长 对齐，不同进程的同一代可以直接合并
+    窗口边界误差不超过一代的时长
+    clock 为取时函数（Unix 秒）；未指定时使用 time.time，可在写入前通过 bind_clock 绑定到引擎时钟
+    """
+
+    def __init__(self, factory: Callable[[], object], window_seconds: float = 300,
+                 generations: int = 5, clock: Optional[Callable[[], float]] = None):
+        if generations < 1 or window_seconds <= 0:
+            raise ValueError(f"无效的窗口配置：window={window_seconds}s, generations={generations}")
+        self.factory = factory
+        self.window_seconds = window_seconds
+        self.generations = generations
+        self.generation_seconds = window_seconds / generations
+        self._clock = clock if clock is not None else time.time
+        self._clock_explicit = clock is not None
+        self._sketches: "OrderedDict[int, object]" = OrderedDict()
+        self.rotations = 0
+
+    def bind_clock(self, clock: Callable[[], float]):
+        """未显式指定时钟时改用 clock（应在写入数据之前调用）"""
+        if not self._clock_explicit:
+            self._clock = clock
+            self._clock_explicit = True
+
+    def _generation(self) -> int:
+        return int(self._clock() // self.generation_seconds)
+
+    def _expire(self, generation: int):
+        oldest = generation - self.generations
+        while self._sketches and next(iter(self._sketches)) <= oldest:
+            self._sketches.popitem(last=False)
+
+    def current(self):
+        """当前代的草图（必要时轮换新一代并丢弃过期代）"""
+        generation = self._generation()
+        sketch = self._sketches.get(generation)
+        if sketch is None:
+            self._expire(generation)
+            sketch = self.factory()
+            self._sketches[generation] = sketch
+            self.rotations += 1
+        return sketch
+
+    def add(self, *args):
+        return self.current().add(*args)
+
+    def estimate(self, key: str):
+        self._expire(self._generation())
+        live = list(self._sketches.values())
+        if not live:
+            return 0
+        return type(live[0]).estimate_union(live, key)
+
+    def merge(self, other: "WindowedSketch"):
+        """按代合并另一个进程的窗口草图"""
+        for generation, sketch in other._sketches.items():
+            if generation in self._sketches:
+                self._sketches[generation].merge(sketch)
+            else:
+                self._sketches[generation] = copy.deepcopy(sketch)
+        self._sketches = OrderedDict(sorted(self._sketches.items()))
+        self._expire(self._generation())
+
+    def memory_bytes(self) -> int:
+        return sum(s.memory_bytes() for s in self._sketches.values())
+
+    def stats(self) -> Dict:
+        return {
+            'generations': len(self._sketches),
+            'window_seconds': self.window_seconds,
+            'rotations': self.rotations,
+            'memory_bytes': self.memory_bytes(),
+        }
@@ -0,0 +1,144 @@
+"""
+分层时间轮
+用于调度大量延迟事件（如 24-48 小时后到达的 SKAN postback）：插入 O(1)，到期处理均摊 O(1)
+"""
+import math
+from typing import Any, List, Sequence, Tuple
+
+from clock import SystemClock
+
+
+class HierarchicalTimingWheel:
+    """
+    分层时间轮（Linux 内核定时器式）
+    - 第 0 层每槽 1 个 tick，第 i 层每槽覆盖前 i 层的全部跨度；默认 (8, 6, 6, 6) 位，
+      1 秒 tick 时可覆盖约 776 天，更远的事件进入溢出列表
+    - 每跨过第 0 层边界时，把上层对应槽中的事件重新放入下层（级联），由高层到低层依次处理
+    - 低层全部为空时直接跳到下一个需要级联的边界，长时间空闲的推进不逐 tick 循环
+    - 调度时间早于当前时间的事件在下一次 advance 时立即到期
+    """
+
+    def __init__(self, tick_seconds: float = 1.0, level_bits: Sequence[int] = (8, 6, 6, 6), clock=None):
+        if tick_seconds <= 0 or not level_bits:
+            raise ValueError(f"无效的时间轮配置：tick={tick_seconds}, levels={level_bits}")
+        self.tick_seconds = tick_seconds
+        self.clock = clock if clock is not None else SystemClock()
+        self._origin = self.clock.now()
+        self._tick = 0
+        self._bits = list(level_bits)
+        self._shifts = []
+        shift = 0
+        for bits in self._bits:
+            self._shifts.append(shift)
+            shift += bits
+        self._total_bits = shift
+        self._masks = [(1 << bits) - 1 for bits in self._bits]
+        self._wheels: List[List[List[Tuple[int, Any]]]] = [[[] for _ in range(1 << bits)] for bits in self._bits]
+        self._counts = [0] * len(self._bits)
+        self._overflow: List[Tuple[int, Any]] = []
+        self._ready: List[Any] = []
+
+        # 监控计数：调度数、到期数、级联搬移次数
+        self.scheduled_count = 0
+        self.expired_count = 0
+        self.cascaded_count = 0
+
+    def __len__(self) -> int:
+        return sum(self._counts) + len(self._overflow) + len(self._ready)
+
+    def _time_to_tick(self, timestamp: float) -> int:
+        return int(math.ceil((timestamp - self._origin) / self.tick_seconds - 1e-9))
+
+    def _place(self, tick: int, item):
+        """按距当前 tick 的差值选择层级与槽位"""
+        delta = tick - self._tick
+        if delta <= 0:
+            self._ready.append(item)
+            return
+        for level, shift in enumerate(self._shifts):
+            if delta < (1 << (shift + self._bits[level])):
+                self._wheels[level][(tick >> shift) & self._masks[level]].append((tick, item))
+                self._counts[level] += 1
+                return
+        self._overflow.append((tick, item))
+
+    def schedule_at(self, timestamp: float, item):
+        """在指定时间点到期"""
+        self._place(self._time_to_tick(timestamp), item)
+        self.scheduled_count += 1
+
+    def schedule(self, delay_seconds: float, item):
+        """在 delay_seconds 秒后到期"""
+        self.schedule_at(self.clock.now() + delay_seconds, item)
+
+    def _cascade(self, level: int):
+        """把第 level 层当前槽中的事件重新放入下层"""
+        slot_index = (self._tick >> self._shifts[level]) & self._masks[level]
+        entries = self._wheels[level][slot_index]
+        if not entries:
+            return
+        self._wheels[level][slot_index] = []
+        self._counts[level] -= len(entries)
+        self.cascaded_count += len(entries)
+        for tick, item in entries:
+            self._place(tick, item)
+
+    def _refill_from_overflow(self):
+        overflow, self._overflow = self._overflow, []
+        for tick, item in overflow:
+            self._place(tick, item)
+
+    def _next_event_boundary(self) -> int:
+        """
+        最早可能有事件到期或需要级联的 tick
+        第 0 层非空时为下一个 tick；否则为最低非空层的下一个槽边界
+        """
+        for level, shift in enumerate(self._shifts):
+            if self._counts[level]:
+                if level == 0:
+                    return self._tick + 1
+                return ((self._tick >> shift) + 1) << shift
+        if self._overflow:
+            return ((self._tick >> self._total_bits) + 1) << self._total_bits
+        return -1
+
+    def advance(self) -> List[Any]:
+        """推进到时钟当前时间，返回期间到期的全部事件（按到期 tick 顺序）"""
+        target = int(math.floor((self.clock.now() - self._origin) / self.tick_seconds + 1e-9))
+        expired, self._ready = self._ready, []
+        level0 = self._wheels[0]
+        while self._tick < target:
+            boundary = self._next_event_boundary()
+            if boundary < 0 or boundary > target:
+                self._tick = target
+                break
+            self._tick = boundary
+            tick = boundary
+            if (tick & self._masks[0]) == 0:
+                # 跨过第 0 层边界：由高到低级联所有槽边界对齐的层，溢出列表在最高层边界重新放入
+                if self._overflow and (tick & ((1 << self._total_bits) - 1)) == 0:
+                    self._refill_from_overflow()
+                for level in range(len(self._shifts) - 1, 0, -1):
+                    if (tick & ((1 << self._shifts[level]) - 1)) == 0:
+                        self._cascade(level)
+                if self._ready:
+                    # 级联后恰好在当前 tick 到期的事件
+                    expired.extend(self._ready)
+                    self._ready = []
+            slot = level0[tick & self._masks[0]]
+            if slot:
+                level0[tick & self._masks[0]] = []
+                self._counts[0] -= len(slot)
+                expired.extend(item for _, item in slot)
+        self.expired_count += len(expired)
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self),
+            'per_level': list(self._counts),
+            'overflow': len(self._overflow),
+            'scheduled': self.scheduled_count,
+            'expired': self.expired_count,
+            'cascaded': self.cascaded_count,
+        }
@@ -0,0 +1,75 @@
+"""
+验证异步扇出的截止时间
+- 响应时间超过 tmax_ms 的 DSP 被记录为 DSP_BID_TIMEOUT，且不参与竞价（不会获胜，也不出现在 all_bids 中）
+- 按时返回的 DSP 并发等待：单个请求的等待时间接近最慢的按时 DSP，而不是各 DSP 响应时间之和
+"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from engine import AdExchangeEngine
+
+SEED = 20240101
+NUM_REQUESTS = 20
+TMAX_MS = 60
+
+
+async def run_requests(engine):
+    results, elapsed = [], []
+    for i in range(NUM_REQUESTS):
+        started = time.perf_counter()
+        results.append(await engine.run_auction_async(
+            request_id=f'req_{i}', device_id=f'device_{i}', app_id='app_us_002', app_name='app_us_002',
+            platform='Android', ad_size=(320, 50), tmax_ms=TMAX_MS))
+        elapsed.append((time.perf_counter() - started) * 1000)
+    return results, elapsed
+
+
+def run(log_file, with_slow_dsp):
+    engine = AdExchangeEngine(log_file=log_file, seed=SEED)
+    for dsp_id in ('dsp_fast_1', 'dsp_fast_2', 'dsp_fast_3'):
+        engine.register_dsp(dsp_id, base_price=0.5, response_latency_ms=(15, 20))
+    if with_slow_dsp:
+        # 出价最高但总是超时的 DSP
+        engine.register_dsp('dsp_slow', base_price=50.0, response_latency_ms=(150, 200))
+    results, elapsed = asyncio.run(run_requests(engine))
+    engine.close()
+    with open(log_file, 'r', encoding='utf-8') as f:
+        logs = [json.loads(line) for line in f if line.strip()]
+    return results, elapsed, logs
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        results, _, logs = run(os.path.join(tmp, 'slow.log'), True)
+        fast_results, elapsed, _ = run(os.path.join(tmp, 'fast.log'), False)
+
+    timeouts = {}
+    for log in logs:
+        if log.get('reason_code') == 'DSP_BID_TIMEOUT':
+            timeouts.setdefault(log['internal_variables']['dsp_id'], 0)
+            timeouts[log['internal_variables']['dsp_id']] += 1
+    fanned_out = [r for r in results if r.get('filter_stage') != 'pre_bid']
+    accepted = [r for r in results if r['status'] == 'ACCEPTED']
+    slow_bids = [bid for r in accepted for bid in r['all_bids'] if bid['dsp_id'] == 'dsp_slow']
+    ok = True
+
+    timeout_ok = timeouts == {'dsp_slow': len(fanned_out)} and len(fanned_out) > 0
+    ok = ok and timeout_ok
+    print(f"超时记录: {timeouts}（扇出请求 {len(fanned_out)} 个） {'✓' if timeout_ok else '✗'}")
+
+    excluded_ok = not slow_bids and all(r['winner'] != 'dsp_slow' for r in accepted) and len(accepted) > 0
+    ok = ok and excluded_ok
+    print(f"超时 DSP 不参与竞价: 成交 {len(accepted)} 个，获胜方 {sorted({r['winner'] for r in accepted})} "
+          f"{'✓' if excluded_ok else '✗'}")
+
+    waits = sorted(ms for r, ms in zip(fast_results, elapsed) if r.get('filter_stage') != 'pre_bid')
+    # 3 个 DSP 各 15-20ms：并发等待约 20ms，依次等待至少 45ms
+    median = waits[len(waits) // 2]
+    concurrent_ok = median < 40
+    ok = ok and concurrent_ok
+    print(f"并发等待: 3 个 DSP（各 15-20ms）每个请求中位数 {median:.1f}ms {'✓' if concurrent_ok else '✗'}")
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,79 @@
+"""
+验证增量点击坐标统计与原始实现判定一致
+原始实现：保留最近 20 次点击，至少 5 次时重新计算均值与方差，X 或 Y 方差 < 100 判定为坐标固定
+"""
+import random
+from fractions import Fraction
+
+from quality_counters import ClickDispersionTracker
+
+
+def reference_is_fixed(history, x, y):
+    """原始实现（逐次重算），同时返回精确有理数判定用于区分浮点边界误差"""
+    history.append((x, y))
+    if len(history) > 20:
+        history[:] = history[-20:]
+    if len(history) < 5:
+        return False, False
+    x_coords = [c[0] for c in history]
+    y_coords = [c[1] for c in history]
+    x_mean = sum(x_coords) / len(x_coords)
+    y_mean = sum(y_coords) / len(y_coords)
+    x_variance = sum((v - x_mean) ** 2 for v in x_coords) / len(x_coords)
+    y_variance = sum((v - y_mean) ** 2 for v in y_coords) / len(y_coords)
+    float_result = x_variance < 100 or y_variance < 100
+
+    n = len(history)
+    exact_x = Fraction(n * sum(v * v for v in x_coords) - sum(x_coords) ** 2, n * n)
+    exact_y = Fraction(n * sum(v * v for v in y_coords) - sum(y_coords) ** 2, n * n)
+    exact_result = exact_x < 100 or exact_y < 100
+    return float_result, exact_result
+
+
+def random_click(rng, mode):
+    """生成不同分布的点击：全屏随机 / 固定点附近抖动 / 落在方差阈值附近"""
+    if mode == 'uniform':
+        return rng.randint(0, 1080), rng.randint(0, 1920)
+    if mode == 'fixed':
+        return 540 + rng.randint(-3, 3), 960 + rng.randint(-3, 3)
+    return 500 + rng.randint(-17, 17), rng.randint(0, 1920)
+
+
+if __name__ == "__main__":
+    rng = random.Random(20240101)
+    modes = ['uniform', 'fixed', 'boundary']
+    tracker = ClickDispersionTracker(max_keys=150)
+    histories = {}
+    checks = mismatches = float_boundary = flagged = 0
+
+    for step in range(200000):
+        # 每个键固定一种点击分布，键空间略大于容量以覆盖 LRU 淘汰
+        device = rng.randint(0, 39)
+        key = f"device_{device}_app_{rng.randint(0, 4)}"
+        mode = modes[device % 3]
+        x, y = random_click(rng, mode)
+
+        history = histories.setdefault(key, [])
+        float_result, exact_result = reference_is_fixed(history, x, y)
+        result = tracker.add(key, x, y)
+        checks += 1
+        flagged += result
+        if result != exact_result:
+            mismatches += 1
+        if float_result != exact_result:
+            float_boundary += 1
+
+        # 与 LRU 淘汰保持一致：被淘汰的键在参考实现中同样清空历史
+        if key not in tracker._rings:
+            raise AssertionError(f"刚写入的键被淘汰：{key}")
+        for evicted in [k for k in histories if k not in tracker._rings]:
+            del histories[evicted]
+
+    print(f"校验次数: {checks}")
+    print(f"判定为坐标固定: {flagged}")
+    print(f"与精确判定不一致: {mismatches}")
+    print(f"原始浮点实现在阈值边界的舍入差异: {float_boundary}")
+    print(f"LRU 淘汰键数: {tracker.stats()['evictions']}")
+    print(f"判定一致: {'✓' if mismatches == 0 else '✗'}")
+    if mismatches:
+        raise SystemExit(1)
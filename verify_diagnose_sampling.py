@@ -0,0 +1,108 @@
+"""
+验证尾部采样与日志详细程度不改变诊断结论
+相同种子与时钟下分别写出完整日志、尾部采样日志与仅记录拒绝（verbosity="rejects"）的日志，
+diagnose 报告的异常（类型、标题、描述与数值）应完全相同；
+去掉出价信息的旧格式日志应在 unavailable_detectors 中说明出价类检测器无法运行
+"""
+import json
+import os
+import tempfile
+import time
+
+from agent import DiagnosticAgent
+from clock import SimulatedClock
+from engine import AdExchangeEngine, FilterRule
+
+SEED = 20240101
+NUM_REQUESTS = 600
+
+
+class AppRejectFilter(FilterRule):
+    """竞价后拒绝指定应用的请求，制造出价正常但胜率极低的应用"""
+
+    def __init__(self, app_id: str, logger):
+        super().__init__("AppRejectFilter", logger)
+        self.app_id = app_id
+
+    def apply(self, request_id, ad_request):
+        if ad_request.get('app_id') == self.app_id:
+            internal_vars = {'app_id': self.app_id, 'filter_name': self.name}
+            self.logger.log_decision(request_id=request_id, node="ADX", action="APP_CHECK", decision="REJECT",
+                                     reason_code="APP_BLOCKED", internal_variables=internal_vars,
+                                     reasoning="应用 {app_id} 被竞价后规则拒绝", reasoning_args=internal_vars)
+            return False, "APP_BLOCKED", internal_vars
+        return True, "APP_ALLOWED", {}
+
+
+def build_requests(n):
+    apps = ['app_brazil_001', 'app_us_002', 'app_china_003', 'app_brazil_blocked']
+    platforms = ['iOS', 'Android', 'iOS']
+    return [
+        {
+            'request_id': f'req_{i}',
+            'device_id': 'device_blacklist_001' if i % 23 == 0 else f'device_{i % 50}',
+            'app_id': apps[i % len(apps)],
+            'app_name': apps[i % len(apps)],
+            'platform': platforms[i % 3],
+            'ad_size': (320, 50) if i % 13 else (300, 250),
+        }
+        for i in range(n)
+    ]
+
+
+def run(log_file, start, logger_options, strip_bids=False):
+    engine = AdExchangeEngine(log_file=log_file, seed=SEED, clock=SimulatedClock(start),
+                              logger_options=logger_options)
+    engine.setup_adx_filters(blacklist=['device_blacklist_001'])
+    engine.adx.add_filter(AppRejectFilter('app_brazil_blocked', engine.logger))
+    engine.setup_dsp(base_price=0.5)
+    for request in build_requests(NUM_REQUESTS):
+        engine.run_auction(**request)
+    engine.close()
+    with open(log_file, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    if strip_bids:
+        # 模拟旧版本 rejects 级别日志：没有出价摘要，竞价结果也不带 all_bids
+        stripped = []
+        for line in lines:
+            record = json.loads(line)
+            if record.get('action') == 'BID_SUMMARY':
+                continue
+            record.get('internal_variables', {}).pop('all_bids', None)
+            stripped.append(json.dumps(record, ensure_ascii=False) + '\n')
+        lines = stripped
+        with open(log_file, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+    report = DiagnosticAgent(log_file).diagnose(max_logs=1_000_000)
+    anomalies = sorted(json.dumps(anomaly, ensure_ascii=False, sort_keys=True, default=str)
+                       for anomaly in report['anomalies'])
+    return len(lines), anomalies, report['statistics']['win_rate'], report['unavailable_detectors']
+
+
+if __name__ == "__main__":
+    os.environ.pop('OPENAI_API_KEY', None)
+    start = time.time()
+    with tempfile.TemporaryDirectory() as tmp:
+        full = run(os.path.join(tmp, 'full.log'), start, {})
+        variants = {
+            '尾部采样': run(os.path.join(tmp, 'tail.log'), start, {'tail_sampling': True}),
+            '仅记录拒绝': run(os.path.join(tmp, 'rejects.log'), start, {'verbosity': 'rejects'}),
+        }
+        legacy = run(os.path.join(tmp, 'legacy.log'), start, {'verbosity': 'rejects'}, strip_bids=True)
+    print(f"完整日志 {full[0]} 行，异常 {len(full[1])} 个：")
+    for anomaly in full[1]:
+        print('  ', json.loads(anomaly)['type'], json.loads(anomaly)['title'])
+    ok = not full[3]
+    for name, result in variants.items():
+        same = result[1] == full[1] and result[2] == full[2] and not result[3]
+        ok = ok and same
+        print(f"{name}: {result[0]} 行，异常 {len(result[1])} 个，诊断结论一致 {'✓' if same else '✗'}")
+        if not same:
+            for anomaly in sorted(set(full[1]) ^ set(result[1])):
+                print('  差异：', anomaly[:300])
+    reported = [item['detector'] for item in legacy[3]]
+    legacy_ok = 'P8_HIGH_BID_LOW_WIN_RATE' in reported and 'COMPETITIVENESS_MISSING' in reported
+    ok = ok and legacy_ok
+    print(f"无出价信息的旧日志: 报告无法运行的检测器 {reported} {'✓' if legacy_ok else '✗'}")
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,141 @@
+"""
+验证 DSP 注册表的预算、QPS 上限与匀速投放
+- 预算软上限：对账之间的超支不超过 reconcile_every 笔成交；多线程累加对账后不丢花费
+- QPS 上限：每个整秒窗口内向 DSP 发出的出价请求不超过 qps_limit
+- 匀速投放：需求远超预算时，未节流的 DSP 很快花完预算，节流的 DSP 花费贴近按时间线性的目标
+- 引擎：被跳过的 DSP 以真实 DSP ID 记录 DSP_SELECTION 追踪
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from clock import SimulatedClock
+from dsp_registry import SKIP_BUDGET_EXHAUSTED, SKIP_PACING_THROTTLED, SKIP_QPS_LIMITED, DSPRegistry, ShardedBudget
+from engine import AdExchangeEngine
+from rng import EngineRandom
+
+SEED = 20240101
+START = 1_700_000_000.0
+
+
+def check(name, ok, detail=''):
+    print(f"{name}: {detail} {'✓' if ok else '✗'}")
+    return ok
+
+
+def budget_overshoot():
+    """单线程：预算耗尽后不再扇出，超支不超过 reconcile_every × 最高成交价"""
+    reconcile_every, price = 8, 0.3
+    registry = DSPRegistry(reconcile_every=reconcile_every, reconcile_interval_seconds=3600)
+    entry = registry.register('dsp_a', object(), budget=10.0)
+    for i in range(1000):
+        selected, _ = registry.select(START + i * 0.001)
+        if selected:
+            registry.record_win('dsp_a', price)
+    spent = entry.budget.reconcile()
+    overshoot = spent - entry.budget.total
+    return check('预算软上限', 0 <= overshoot <= reconcile_every * price and entry.budget_skips > 0,
+                 f"花费 {spent:.2f} / 预算 {entry.budget.total:.2f}，超支 {overshoot:.2f} "
+                 f"≤ {reconcile_every} × {price}，跳过 {entry.budget_skips} 次")
+
+
+def sharded_spend():
+    """多线程各自累加分片，对账汇总不丢花费"""
+    budget = ShardedBudget(total=1e9, reconcile_every=16)
+    threads = [threading.Thread(target=lambda: [budget.spend(0.5) for _ in range(5000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    spent = budget.reconcile()
+    return check('分片对账', spent == 4 * 5000 * 0.5, f"4 线程 × 5000 笔 × 0.5 = {spent:.1f}")
+
+
+def qps_cap():
+    """每秒 100 个请求、QPS 上限 20：每个整秒窗口恰好扇出 20 次"""
+    registry = DSPRegistry()
+    entry = registry.register('dsp_q', object(), qps_limit=20)
+    per_window = {}
+    for i in range(500):
+        now = START + i / 100
+        selected, skipped = registry.select(now)
+        if selected:
+            per_window[int(now)] = per_window.get(int(now), 0) + 1
+        else:
+            assert skipped[0][1] == SKIP_QPS_LIMITED
+    counts = sorted(set(per_window.values()))
+    return check('QPS 上限', counts == [20] and entry.qps_skips == 400,
+                 f"每秒扇出 {counts}，跳过 {entry.qps_skips} 次")
+
+
+def simulate_pacing(pacing_seconds, budget=100.0, duration=60, rps=100, price=0.1):
+    """每次扇出都以固定价格成交（需求 10/秒，远超 100 / 60 秒的预算速度），返回 (各秒末花费, 最后一次成交时刻)"""
+    registry = DSPRegistry(reconcile_every=16)
+    entry = registry.register('dsp_p', object(), budget=budget, pacing_seconds=pacing_seconds,
+                              rng=EngineRandom(SEED))
+    spent_at, last_win = {}, None
+    for i in range((duration + 10) * rps):
+        now = START + i / rps
+        selected, skipped = registry.select(now)
+        if selected:
+            registry.record_win('dsp_p', price)
+            last_win = now - START
+        elif pacing_seconds is not None and skipped[0][1] not in (SKIP_PACING_THROTTLED, SKIP_BUDGET_EXHAUSTED):
+            raise AssertionError(skipped)
+        if (i + 1) % rps == 0:
+            spent_at[(i + 1) // rps] = entry.budget.reconcile()
+    return spent_at, last_win, entry
+
+
+def pacing():
+    duration = 60
+    unpaced, unpaced_last, _ = simulate_pacing(None, duration=duration)
+    paced, paced_last, entry = simulate_pacing(duration, duration=duration)
+    ok = check('未节流', unpaced_last < duration / 4, f"预算在第 {unpaced_last:.1f} 秒花完")
+    half = paced[duration // 2]
+    ok = check('匀速投放：投放中点', abs(half - 50.0) <= 15.0,
+               f"第 {duration // 2} 秒花费 {half:.1f}（线性目标 50.0）") and ok
+    ok = check('匀速投放：预算覆盖整个周期', paced_last >= 0.9 * duration and paced[duration + 10] >= 95.0,
+               f"最后一次成交在第 {paced_last:.1f} 秒，总花费 {paced[duration + 10]:.1f}，"
+               f"节流 {entry.pacing_skips} 次") and ok
+    return ok
+
+
+def engine_skip_traces():
+    """引擎注册 DSP 后按真实 DSP ID 记录跳过原因"""
+    clock = SimulatedClock(START)
+    with tempfile.TemporaryDirectory() as tmp:
+        log_file = os.path.join(tmp, 'registry.log')
+        engine = AdExchangeEngine(log_file=log_file, seed=SEED, clock=clock)
+        engine.setup_adx_filters()
+        engine.register_dsp('dsp_budget', base_price=0.5, budget=0.2)
+        engine.register_dsp('dsp_qps', base_price=0.5, qps_limit=3)
+        engine.register_dsp('dsp_paced', base_price=0.5, budget=5.0, pacing_seconds=30)
+        for i in range(300):
+            engine.run_auction(request_id=f'req_{i}', device_id=f'device_{i % 50}', app_id='app_us_002',
+                               app_name='app_us_002', platform='iOS', ad_size=(320, 50))
+            clock.advance(0.1)
+        stats = engine.dsp_registry.stats()
+        engine.close()
+        with open(log_file, 'r', encoding='utf-8') as f:
+            logs = [json.loads(line) for line in f if line.strip()]
+    skips = {}
+    for log in logs:
+        if log.get('action') == 'DSP_SELECTION':
+            dsp_id = log['internal_variables']['dsp_id']
+            skips.setdefault(dsp_id, set()).add(log['reason_code'])
+    expected = {'dsp_budget': {SKIP_BUDGET_EXHAUSTED}, 'dsp_qps': {SKIP_QPS_LIMITED},
+                'dsp_paced': {SKIP_PACING_THROTTLED}}
+    ok = all(expected[dsp_id] <= skips.get(dsp_id, set()) for dsp_id in expected)
+    ok = ok and stats['dsp_qps']['requests'] <= 3 * 30
+    return check('引擎跳过追踪', ok, f"{ {dsp_id: sorted(codes) for dsp_id, codes in skips.items()} }")
+
+
+if __name__ == "__main__":
+    started = time.process_time()
+    results = [budget_overshoot(), sharded_spend(), qps_cap(), pacing(), engine_skip_traces()]
+    print(f"耗时 {time.process_time() - started:.2f}s")
+    if not all(results):
+        raise SystemExit(1)
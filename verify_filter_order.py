@@ -0,0 +1,129 @@
+"""
+验证自适应过滤顺序
+- 排序：样本足够后独立规则按 耗时 / 拒绝概率 升序执行，预期耗时下降
+- 非独立规则固定在原位置，只在其分隔的区段内重排
+- 稳定性：两条规则的排序指标只差约 2% 时，min_improvement=0.05 不会让顺序来回切换
+- 规则集合变化时回到给定顺序
+规则耗时用注入的计时器模拟，结果与机器负载无关
+"""
+import random
+
+from filter_order import AdaptiveFilterOrder, expected_cost
+
+SEED = 20240101
+
+
+class FakeTimer:
+    """模拟计时器：规则执行时手动推进"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeRule:
+    """耗时固定、按概率拒绝的过滤规则"""
+
+    def __init__(self, name, cost, reject_rate, timer, rng, independent=True):
+        self.name = name
+        self.cost = cost
+        self.reject_rate = reject_rate
+        self.timer = timer
+        self.rng = rng
+        self.independent = independent
+
+    def apply(self, request_id, ad_request):
+        self.timer.now += self.cost
+        if self.rng.random() < self.reject_rate:
+            return False, f"{self.name}_REJECT", {}
+        return True, f"{self.name}_PASS", {}
+
+
+def run_chain(order_manager, filters, n):
+    """模拟 n 个请求执行过滤链（首个拒绝即停止），返回每次使用的顺序"""
+    orders = []
+    for i in range(n):
+        order = order_manager.order('pre_bid', filters)
+        orders.append([rule.name for rule in order])
+        for rule in order:
+            passed, _, _ = order_manager.evaluate(rule, f'req_{i}', {})
+            if not passed:
+                break
+    return orders
+
+
+def check(name, ok, detail=''):
+    print(f"{name}: {detail} {'✓' if ok else '✗'}")
+    return ok
+
+
+def ranking():
+    timer, rng = FakeTimer(), random.Random(SEED)
+    filters = [
+        FakeRule('slow_rare', 10e-6, 0.01, timer, rng),
+        FakeRule('mid_common', 5e-6, 0.5, timer, rng),
+        FakeRule('cheap_common', 1e-6, 0.5, timer, rng),
+    ]
+    manager = AdaptiveFilterOrder(reorder_interval=200, min_samples=50, timer=timer)
+    orders = run_chain(manager, filters, 2000)
+    final = orders[-1]
+    by_name = {rule.name: rule for rule in filters}
+    before = expected_cost(filters, manager._stats)
+    after = expected_cost([by_name[name] for name in final], manager._stats)
+    ok = final == ['cheap_common', 'mid_common', 'slow_rare'] and after < before
+    return check('按 耗时 / 拒绝概率 排序', ok,
+                 f"{orders[0]} -> {final}，预期耗时 {before * 1e6:.2f}us -> {after * 1e6:.2f}us，重排 {manager.reorders} 次")
+
+
+def pinned():
+    timer, rng = FakeTimer(), random.Random(SEED)
+    filters = [
+        FakeRule('a_slow', 10e-6, 0.1, timer, rng),
+        FakeRule('b_cheap', 1e-6, 0.3, timer, rng),
+        FakeRule('fixed', 1e-6, 0.05, timer, rng, independent=False),
+        FakeRule('c_slow', 10e-6, 0.1, timer, rng),
+        FakeRule('d_cheap', 1e-6, 0.3, timer, rng),
+    ]
+    manager = AdaptiveFilterOrder(reorder_interval=200, min_samples=50, timer=timer)
+    final = run_chain(manager, filters, 4000)[-1]
+    ok = final == ['b_cheap', 'a_slow', 'fixed', 'd_cheap', 'c_slow']
+    return check('非独立规则固定位置', ok, f"{final}")
+
+
+def stability():
+    results = {}
+    for min_improvement in (0.05, 0.0):
+        timer, rng = FakeTimer(), random.Random(SEED)
+        filters = [
+            FakeRule('rule_a', 1.00e-6, 0.3, timer, rng),
+            FakeRule('rule_b', 1.02e-6, 0.3, timer, rng),
+            FakeRule('tail', 5e-6, 0.0, timer, rng),
+        ]
+        manager = AdaptiveFilterOrder(reorder_interval=100, min_samples=50, min_improvement=min_improvement,
+                                      timer=timer)
+        orders = run_chain(manager, filters, 20000)
+        switches = sum(1 for prev, cur in zip(orders, orders[1:]) if prev != cur)
+        results[min_improvement] = (switches, manager.checks)
+    ok = results[0.05][0] == 0
+    return check('min_improvement 防抖', ok,
+                 f"指标相差约 2%：min_improvement=0.05 切换 {results[0.05][0]} 次（检查 {results[0.05][1]} 次），"
+                 f"min_improvement=0 切换 {results[0.0][0]} 次")
+
+
+def reset_on_change():
+    timer, rng = FakeTimer(), random.Random(SEED)
+    filters = [FakeRule('slow', 10e-6, 0.01, timer, rng), FakeRule('cheap', 1e-6, 0.5, timer, rng)]
+    manager = AdaptiveFilterOrder(reorder_interval=100, min_samples=50, timer=timer)
+    reordered = run_chain(manager, filters, 1000)[-1]
+    extended = filters + [FakeRule('new', 1e-6, 0.1, timer, rng)]
+    reset = [rule.name for rule in manager.order('pre_bid', extended)]
+    ok = reordered == ['cheap', 'slow'] and reset == ['slow', 'cheap', 'new']
+    return check('规则集合变化时回到给定顺序', ok, f"{reordered} -> {reset}")
+
+
+if __name__ == "__main__":
+    results = [ranking(), pinned(), stability(), reset_on_change()]
+    if not all(results):
+        raise SystemExit(1)
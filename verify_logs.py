@@ -42,9 +42,13 @@ for log in auction_logs[:2]:
 
 # 查找延迟超时记录
 print("\n延迟超时记录:")
-timeout_logs = [log for log in logs if log['reason_code'] == 'LATENCY_TIMEOUT']
+# SSP 延迟检查与 LatencyTimeoutFilter 的 LATENCY_CHECK 追踪字段相同，过滤规则另带 filter_name
+timeout_logs = [log for log in logs if log['action'] == 'LATENCY_CHECK' and log['decision'] == 'REJECT']
 for log in timeout_logs[:2]:
-    print(f"\n延迟: {log.get('latency_ms')}ms")
-    print(f"  潜在最高 eCPM 损失: {log['internal_variables'].get('max_potential_ecpm', 0):.4f}")
+    print(f"\n延迟: {log.get('latency_ms')}ms（{log['internal_variables'].get('filter_name', 'SSP')}）")
+    print(f"  超时阈值: {log['internal_variables'].get('timeout_threshold')}ms")
+    if 'max_potential_ecpm' in log['internal_variables']:
+        # SSP 延迟检查在收集出价后进行，记录潜在收入损失
+        print(f"  潜在最高 eCPM 损失: {log['internal_variables']['max_potential_ecpm']:.4f}")
 
 
@@ -0,0 +1,72 @@
+"""
+验证 SKAN 转化值分布的在线更新规则一致
+- 按活动分布矩阵：一次批量 apply_postbacks 与逐条 apply_postbacks 的结果相同（批内多个活动、不同转化值混合）
+- 全局分布与单个活动的分布：先验相同、收到相同的 postback 序列时结果相同（覆盖全局权重的缩放）
+"""
+import random
+
+from engine import SKAN_CONVERSION_VALUES, SKANOptimizer, WhiteboxLogger, MemorySink
+from skan_store import SKANDistributionStore
+
+SEED = 20240101
+WEIGHT = 0.1
+TOLERANCE = 1e-9
+
+
+def postbacks(n, campaigns):
+    rng = random.Random(SEED)
+    return [rng.choice(campaigns) for _ in range(n)], [rng.choice([0, 0, 5, 17, 42, 63]) for _ in range(n)]
+
+
+def max_diff(a, b):
+    return max(abs(x - y) for x, y in zip(a, b))
+
+
+def check(name, diff):
+    ok = diff <= TOLERANCE
+    print(f"{name}: 最大偏差 {diff:.2e} {'✓' if ok else '✗'}")
+    return ok
+
+
+def batch_matches_sequential():
+    logger = WhiteboxLogger(sink=MemorySink())
+    prior = SKANOptimizer(logger).historical_conversion_distribution
+    prior = [prior[value] for value in range(SKAN_CONVERSION_VALUES)]
+    logger.close()
+    campaigns = ['campaign_a', 'campaign_b', 'campaign_c']
+    campaign_ids, values = postbacks(400, campaigns)
+
+    batched = SKANDistributionStore(prior)
+    rng = random.Random(SEED)
+    start = 0
+    while start < len(values):
+        end = min(len(values), start + rng.randint(1, 60))
+        batched.apply_postbacks(campaign_ids[start:end], values[start:end], WEIGHT)
+        start = end
+    sequential = SKANDistributionStore(prior)
+    for campaign_id, value in zip(campaign_ids, values):
+        sequential.apply_postbacks([campaign_id], [value], WEIGHT)
+    diff = max(max_diff(batched.distribution(c), sequential.distribution(c)) for c in campaigns)
+    return check('批量与逐条更新一致', diff)
+
+
+def global_matches_campaign():
+    logger = WhiteboxLogger(sink=MemorySink())
+    global_optimizer = SKANOptimizer(logger)
+    campaign_optimizer = SKANOptimizer(logger, per_campaign=True)
+    _, values = postbacks(600, ['campaign_a'])
+    for start in range(0, len(values), 50):
+        chunk = values[start:start + 50]
+        global_optimizer.apply_postbacks(['campaign_a'] * len(chunk), chunk, WEIGHT)
+        campaign_optimizer.apply_postbacks(['campaign_a'] * len(chunk), chunk, WEIGHT)
+    global_distribution = global_optimizer.historical_conversion_distribution
+    global_distribution = [global_distribution[value] for value in range(SKAN_CONVERSION_VALUES)]
+    campaign_distribution = campaign_optimizer.distribution_store.distribution('campaign_a')
+    logger.close()
+    return check('全局分布与活动分布一致', max_diff(global_distribution, campaign_distribution))
+
+
+if __name__ == "__main__":
+    results = [batch_matches_sequential(), global_matches_campaign()]
+    if not all(results):
+        raise SystemExit(1)
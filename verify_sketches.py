@@ -0,0 +1,125 @@
+"""
+验证流量质量草图的误差界与合并
+- CountMinSketch: 只高估；超出 epsilon × 总次数的键比例不超过 delta
+- HyperLogLog / CountMinHLL: 相对误差在标准误差（1.04 / sqrt(2^precision)）的 3 倍以内
+- merge: 两个进程各处理一半流量后合并，与单个草图处理全部流量的结果完全相同
+- WindowedSketch: 按注入的时钟分代过期，超过窗口的计数被丢弃；按代合并
+"""
+import math
+import random
+
+from clock import SimulatedClock
+from sketches import CountMinHLL, CountMinSketch, HyperLogLog, WindowedSketch
+
+SEED = 20240101
+START = 1_700_000_000.0
+
+
+def check(name, ok, detail=''):
+    print(f"{name}: {detail} {'✓' if ok else '✗'}")
+    return ok
+
+
+def skewed_stream(n, keys):
+    """长尾分布的键流（少数键出现次数很多）"""
+    rng = random.Random(SEED)
+    return [f"ip_{int(keys * rng.random() ** 3)}" for _ in range(n)]
+
+
+def count_min_bound():
+    epsilon, delta = 0.001, 0.01
+    sketch = CountMinSketch.from_error(epsilon, delta)
+    stream = skewed_stream(50000, 5000)
+    truth = {}
+    for key in stream:
+        sketch.add(key)
+        truth[key] = truth.get(key, 0) + 1
+    errors = [sketch.estimate(key) - count for key, count in truth.items()]
+    violations = sum(1 for error in errors if error > epsilon * sketch.total)
+    ok = min(errors) >= 0 and violations <= delta * len(truth)
+    return check('Count-Min 误差界', ok,
+                 f"{len(truth)} 个键，最大高估 {max(errors)}（界 {epsilon * sketch.total:.0f}），"
+                 f"超界 {violations} 个，低估 {sum(1 for e in errors if e < 0)} 个")
+
+
+def hll_bound():
+    precision = 12
+    limit = 3 * 1.04 / math.sqrt(1 << precision)
+    ok, details = True, []
+    for n in (100, 5000, 50000):
+        hll = HyperLogLog(precision)
+        for i in range(n):
+            hll.add(f"device_{i}")
+        error = abs(hll.count() - n) / n
+        ok = ok and error <= limit
+        details.append(f"{n}: {error:.2%}")
+    return check('HyperLogLog 相对误差', ok, f"{', '.join(details)}（界 {limit:.2%}）")
+
+
+def count_min_hll_bound():
+    precision = 6
+    limit = 3 * 1.04 / math.sqrt(1 << precision)
+    sketch = CountMinHLL(width=1024, depth=3, precision=precision)
+    truth = {f"ip_{k}": 20 + 40 * k for k in range(10)}
+    for key, distinct in truth.items():
+        for i in range(distinct):
+            sketch.add(key, f"device_{key}_{i}")
+    errors = [abs(sketch.estimate(key) - n) / n for key, n in truth.items()]
+    return check('Count-Min HLL 相对误差', max(errors) <= limit,
+                 f"最大 {max(errors):.2%}（界 {limit:.2%}）")
+
+
+def merges_match_single():
+    stream = skewed_stream(20000, 2000)
+    single_cm, parts_cm = CountMinSketch(1024, 4), [CountMinSketch(1024, 4), CountMinSketch(1024, 4)]
+    single_hll, parts_hll = HyperLogLog(10), [HyperLogLog(10), HyperLogLog(10)]
+    single_cmh, parts_cmh = CountMinHLL(256, 3, 6), [CountMinHLL(256, 3, 6), CountMinHLL(256, 3, 6)]
+    for i, key in enumerate(stream):
+        item = f"device_{i % 700}"
+        single_cm.add(key)
+        single_hll.add(item)
+        single_cmh.add(key, item)
+        part = i % 2
+        parts_cm[part].add(key)
+        parts_hll[part].add(item)
+        parts_cmh[part].add(key, item)
+    parts_cm[0].merge(parts_cm[1])
+    parts_hll[0].merge(parts_hll[1])
+    parts_cmh[0].merge(parts_cmh[1])
+    ok = (parts_cm[0]._table == single_cm._table and parts_cm[0].total == single_cm.total
+          and parts_hll[0]._registers == single_hll._registers
+          and parts_cmh[0]._registers == single_cmh._registers)
+
+    try:
+        CountMinSketch(1024, 4).merge(CountMinSketch(512, 4))
+        shape_ok = False
+    except ValueError:
+        shape_ok = True
+    return check('合并与单个草图一致', ok and shape_ok, "Count-Min / HyperLogLog / Count-Min HLL，形状不同时拒绝合并")
+
+
+def windowed():
+    clock = SimulatedClock(START)
+    window = WindowedSketch(lambda: CountMinSketch(512, 4), window_seconds=60, generations=6)
+    window.bind_clock(clock.now)
+    other = WindowedSketch(lambda: CountMinSketch(512, 4), window_seconds=60, generations=6, clock=clock.now)
+    for second in range(30):
+        window.add('ip_a')
+        other.add('ip_a')
+        clock.advance(1)
+    in_window = window.estimate('ip_a')
+    window.merge(other)
+    merged = window.estimate('ip_a')
+    clock.advance(45)
+    partly_expired = window.estimate('ip_a')
+    clock.advance(60)
+    expired = window.estimate('ip_a')
+    ok = in_window == 30 and merged == 60 and 0 < partly_expired < merged and expired == 0
+    return check('滑动窗口（模拟时钟）', ok,
+                 f"窗口内 {in_window}，合并后 {merged}，45 秒后 {partly_expired}，窗口外 {expired}")
+
+
+if __name__ == "__main__":
+    results = [count_min_bound(), hll_bound(), count_min_hll_bound(), merges_match_single(), windowed()]
+    if not all(results):
+        raise SystemExit(1)
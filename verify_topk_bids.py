@@ -0,0 +1,71 @@
+"""
+验证竞价的流式 Top-K 选择
+- TopKBids: 排名与按 eCPM 稳定降序排序的前 k 名一致（含 eCPM 相同的出价），保留的出价数不超过 k
+- ADX.run_auction: 获胜者、第二名与成交价与 trace_top_n 无关；all_bids 默认最多 10 个，
+  trace_top_n=None 时为按 eCPM 降序的全部出价，0 时不包含该字段
+"""
+import random
+
+from engine import ADX, MemorySink, TopKBids, WhiteboxLogger
+
+SEED = 20240101
+NUM_BIDS = 500
+
+
+def check(name, ok, detail=''):
+    print(f"{name}: {detail} {'✓' if ok else '✗'}")
+    return ok
+
+
+def make_bids(rng, n):
+    # 出价取少数几个值，制造大量 eCPM 相同的出价
+    return [{'dsp_id': f'dsp_{i}', 'bid_price': rng.choice([0.5, 1.0, 1.5, 2.0]), 'pctr': 0.01, 'pcvr': 0.05,
+             'q_factor': 1.0, 'floor_price': 0.1} for i in range(n)]
+
+
+def ecpm(bid):
+    return bid['bid_price'] * bid['pctr'] * bid['pcvr'] * bid['q_factor'] * 1000
+
+
+def topk_matches_sort():
+    rng = random.Random(SEED)
+    ok, peak = True, 0
+    for k in (1, 2, 10, None):
+        bids = make_bids(rng, NUM_BIDS)
+        top = TopKBids(k)
+        for bid in bids:
+            top.push(ecpm(bid), bid)
+            peak = max(peak, len(top._heap)) if k is not None else peak
+        expected = sorted(bids, key=ecpm, reverse=True)[:k]
+        ok = ok and top.ranked() == expected
+    return check('TopKBids 与稳定排序一致', ok and peak <= 10, f"{NUM_BIDS} 个出价，有界时最多保留 {peak} 个")
+
+
+def run(trace_top_n, bids):
+    logger = WhiteboxLogger(sink=MemorySink())
+    adx = ADX(logger) if trace_top_n == 'default' else ADX(logger, trace_top_n=trace_top_n)
+    result = adx.run_auction([dict(bid) for bid in bids], 'req_0')
+    logger.close()
+    return result
+
+
+def auction_independent_of_trace():
+    bids = make_bids(random.Random(SEED), NUM_BIDS)
+    results = {n: run(n, bids) for n in ('default', None, 2, 0)}
+    keys = ('winner_bid', 'second_best_bid', 'second_highest_ecpm', 'actual_paid_price')
+    same = all(results[n]['winner']['dsp_id'] == results[None]['winner']['dsp_id']
+               and all(results[n][key] == results[None][key] for key in keys) for n in results)
+    ranked = [bid['dsp_id'] for bid in sorted(bids, key=ecpm, reverse=True)]
+    lists_ok = ([bid['dsp_id'] for bid in results['default']['all_bids']] == ranked[:10]
+                and [bid['dsp_id'] for bid in results[None]['all_bids']] == ranked
+                and [bid['dsp_id'] for bid in results[2]['all_bids']] == ranked[:2]
+                and 'all_bids' not in results[0])
+    return check('获胜者与 trace_top_n 无关', same and lists_ok,
+                 f"获胜者 {results[None]['winner']['dsp_id']}，all_bids 长度 "
+                 f"{ {str(n): len(r.get('all_bids', [])) for n, r in results.items()} }")
+
+
+if __name__ == "__main__":
+    results = [topk_matches_sort(), auction_independent_of_trace()]
+    if not all(results):
+        raise SystemExit(1)